@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Benchmark de transferência ponta a ponta
+####################################################
+"""
+Mede send_file/receive_file de verdade (client_new e server_new) sobre
+o loopback de transporte.py, com as falhas de canal.py, variando tamanho
+do arquivo, payload inicial e máximo, baud rate e taxa de erro. Cada combinação roda num processo
+separado, com seu próprio diretório temporário, e o resultado sai em
+JSON para comparar entre versões.
+
+Uso:
+  python benchmark.py --sizes 2000,20000 --payloads 50 --max-payloads 50,1024 --bauds 115200 \\
+                      --errors 0,0.0001 --windows 1,8 -o resultado.json
+  python benchmark.py --impair latency=0.005,jitter=0.002,frameLossRate=0.01
+  python benchmark.py --content text --compression none,zlib,lzma
+  python benchmark.py --errors 0.0002 --windows 8 --fec 0,4
+  python benchmark.py --sizes 200000 --cables 0,460800,3000000
+"""
+
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def percentile(values, p):
+    if not values:
+        return(None)
+    values = sorted(values)
+    k = min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))
+    return(values[k])
+
+def make_content(size, kind, seed):
+    if kind == 'text':
+        with open(os.path.join(HERE, 'arquivo.txt'), 'rb') as f:
+            sample = f.read()
+        return((sample * (size // len(sample) + 1))[:size])
+    rng = random.Random(seed)
+    return(bytes(rng.getrandbits(8) for _ in range(size)))
+
+def run_one(params):
+    """ Executa uma transferência no processo atual e retorna as métricas
+    """
+    sys.path.insert(0, HERE)
+    import client_new
+    import server_new
+    import transporte
+    from canal import CanalRuidoso
+    from enlace import enlace
+
+    content = make_content(params['file_size'], params['content'], params['seed'])
+    with open('arquivo.txt', 'wb') as f:
+        f.write(content)
+
+    # Com cable, o cliente sobe a velocidade até o que o cabo emulado aguenta
+    a, b = transporte.loopbackPair(params['baudrate'], params['cable'] or None)
+    wire = {'bytes': 0}
+    for port in (a.loopPort, b.loopPort):
+        port.write = counting_write(port.write, wire)
+
+    # Falhas nas duas direções, poupando handshake + pedido de retomada
+    # (cliente) e as respostas do handshake e da retomada (servidor)
+    impair = dict(params['impair'], bitErrorRate=params['error_rate'])
+    canalA = CanalRuidoso(a, seed=params['seed'], warmup=2, **impair)
+    canalB = CanalRuidoso(b, seed=params['seed'] + 1, warmup=2, **impair)
+    client_new.com1 = enlace(a.name, canalA)
+    server_new.com2 = enlace(b.name, canalB)
+    client_new.PAYLOAD_SIZE = params['payload_size']
+    client_new.MAX_PAYLOAD = params['max_payload']
+    client_new.WINDOW_SIZE = params['window']
+    client_new.BINARY_WIRE = params['encoding'] == 'binary'
+    client_new.COMPRESSION = params['compression']
+    client_new.FEC_GROUP = params['fec']
+    client_new.TUNE_BAUD = bool(params['cable'])
+
+    stats = instrument(client_new)
+
+    server = threading.Thread(target=server_new.main, daemon=True)
+    server.start()
+    cpu0 = time.process_time()
+    client_new.main()
+    server.join(params['timeout'])
+    cpu = time.process_time() - cpu0
+
+    with open('arquivo_recebido.txt', 'rb') as f:
+        received = f.read()
+    elapsed = stats['end'] - stats['start']
+    mb = len(content) / 1e6
+    return({
+        'ok': received == content,
+        'transfer_s': elapsed,
+        'goodput_Bps': len(content) / elapsed if elapsed > 0 else None,
+        'wire_bytes': wire['bytes'],
+        'packets': stats['packets'],
+        'sends': stats['sends'],
+        'retransmissions': stats['sends'] - stats['packets'],
+        'rtt_ms': {'p50': ms(percentile(stats['rtts'], 50)),
+                   'p90': ms(percentile(stats['rtts'], 90)),
+                   'p99': ms(percentile(stats['rtts'], 99)),
+                   'max': ms(max(stats['rtts']) if stats['rtts'] else None)},
+        'cpu_s': cpu,
+        'cpu_s_per_mb': cpu / mb if mb else None,
+        'compression': client_new.compression_stats,
+        'metrics': {'client': client_new.com1.metrics.snapshot(),
+                    'server': server_new.com2.metrics.snapshot()},
+        'channel': {'client_to_server': canalA.stats, 'server_to_client': canalB.stats},
+    })
+
+def ms(seconds):
+    return(None if seconds is None else seconds * 1000)
+
+def counting_write(write, wire):
+    def wrapper(data):
+        wire['bytes'] += len(data)
+        return(write(data))
+    return(wrapper)
+
+def instrument(client_new):
+    """ Mede RTT e reenvios observando sendData/receive_response do cliente
+
+    O RTT só é amostrado para pacotes enviados uma única vez (regra
+    de Karn), já que não dá para saber a qual envio o ACK responde.
+    """
+    stats = {'start': None, 'end': None, 'packets': 0, 'sends': 0, 'rtts': []}
+    sent_at = {}
+    sends = {}
+    com1 = client_new.com1
+    send_data, receive_response = com1.sendData, client_new.receive_response
+    HEAD = client_new.protocolo.HEAD
+
+    def sendData(data):
+        n, _, _, _, message_type = HEAD.unpack_from(data)[:5] if len(data) > 15 else (0,)*5
+        if message_type == 3:
+            sent_at[n] = time.perf_counter()
+            sends[n] = sends.get(n, 0) + 1
+            stats['sends'] += 1
+            stats['packets'] = len(sends)
+        return(send_data(data))
+
+    def timed_receive_response(timeout=5):
+        data = receive_response(timeout)
+        if data and len(data) >= HEAD.size:
+            packet, _, _, _, message_type = HEAD.unpack_from(data)[:5]
+            if message_type == 4 and sends.get(packet) == 1 and packet in sent_at:
+                stats['rtts'].append(time.perf_counter() - sent_at.pop(packet))
+        return(data)
+
+    com1.sendData = sendData
+    client_new.receive_response = timed_receive_response
+
+    send_file = client_new.send_file
+    def timed_send_file(file_path, offset=0):
+        stats['start'] = time.perf_counter()
+        send_file(file_path, offset)
+        stats['end'] = time.perf_counter()
+    client_new.send_file = timed_send_file
+    return(stats)
+
+def sweep(args):
+    cases = []
+    for file_size in args.sizes:
+        for payload_size in args.payloads:
+            for max_payload in args.max_payloads:
+                for baudrate in args.bauds:
+                    for error_rate in args.errors:
+                        for window in args.windows:
+                            for compression in args.compression:
+                                for fec_group in args.fec:
+                                    for cable in args.cables:
+                                        cases.append({'file_size': file_size, 'payload_size': payload_size,
+                                                      'max_payload': max_payload,
+                                                      'baudrate': baudrate or None, 'error_rate': error_rate,
+                                                      'window': window, 'encoding': args.encoding,
+                                                      'compression': compression, 'fec': fec_group,
+                                                      'cable': cable,
+                                                      'content': args.content, 'seed': args.seed,
+                                                      'impair': args.impair,
+                                                      'timeout': args.timeout})
+    results = []
+    for case in cases:
+        print("benchmark: {}".format(case), file=sys.stderr)
+        result = dict(case)
+        with tempfile.TemporaryDirectory() as tmp:
+            try:
+                out = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-one', json.dumps(case)],
+                                     cwd=tmp, capture_output=True, text=True, timeout=args.timeout)
+                result.update(json.loads(out.stdout.strip().splitlines()[-1]))
+            except subprocess.TimeoutExpired:
+                result.update({'ok': False, 'error': 'timeout'})
+            except (IndexError, ValueError):
+                result.update({'ok': False, 'error': out.stderr.strip().splitlines()[-1:]})
+        results.append(result)
+    return(results)
+
+def int_list(text):
+    return([int(float(v)) for v in text.split(',')])
+
+def impair_options(text):
+    from canal import CanalRuidoso
+    options = {}
+    for item in filter(None, text.split(',')):
+        key, value = item.split('=')
+        if key not in CanalRuidoso.PARAMS:
+            raise argparse.ArgumentTypeError("falha desconhecida: {}".format(key))
+        options[key] = int(value) if key in ('burstLen', 'warmup') else float(value)
+    return(options)
+
+def codec_list(text):
+    from compressao import CODECS
+    codecs = []
+    for name in text.split(','):
+        if name != 'none' and name not in CODECS:
+            raise argparse.ArgumentTypeError("codec desconhecido: {}".format(name))
+        codecs.append(None if name == 'none' else name)
+    return(codecs)
+
+def float_list(text):
+    return([float(v) for v in text.split(',')])
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark de send_file/receive_file")
+    parser.add_argument('--sizes', type=int_list, default=[2000, 20000], help="tamanhos de arquivo (bytes)")
+    parser.add_argument('--payloads', type=int_list, default=[50], help="payload inicial por pacote (bytes)")
+    parser.add_argument('--max-payloads', type=int_list, default=[1024],
+                        help="payload máximo proposto no handshake (igual ao inicial = tamanho fixo)")
+    parser.add_argument('--bauds', type=int_list, default=[115200], help="baud rates (0 = sem limite)")
+    parser.add_argument('--errors', type=float_list, default=[0.0], help="probabilidade de inverter cada bit (CanalRuidoso.bitErrorRate)")
+    parser.add_argument('--impair', type=impair_options, default={},
+                        help="outras falhas do CanalRuidoso, ex.: latency=0.01,frameLossRate=0.02")
+    parser.add_argument('--windows', type=int_list, default=[8], help="janelas propostas pelo cliente")
+    parser.add_argument('--encoding', choices=('hex', 'binary'), default='binary')
+    parser.add_argument('--content', choices=('random', 'text'), default='random')
+    parser.add_argument('--compression', type=codec_list, default='zlib',
+                        help="codecs propostos no handshake: none,zlib,lzma")
+    parser.add_argument('--fec', type=int_list, default=[0],
+                        help="pacotes por paridade do FEC (0 = desligado)")
+    parser.add_argument('--cables', type=int_list, default=[0],
+                        help="maior baud rate do cabo emulado; o cliente negocia a velocidade (0 = sem troca)")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=120, help="limite por execução (s)")
+    parser.add_argument('-o', '--output', help="arquivo JSON de saída (padrão: stdout)")
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one:
+        # Processo filho: a saída do cliente/servidor não polui o JSON
+        params = json.loads(args.run_one)
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        result = run_one(params)
+        sys.stdout = stdout
+        print(json.dumps(result))
+        os._exit(0)
+
+    results = sweep(args)
+    report = json.dumps({'python': sys.version.split()[0], 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Camada de Enlace - várias portas como um só enlace
+####################################################
+"""
+Bond junta várias portas (qualquer Transporte, ex.: fisica) num único
+Transporte. enlace(nome, Bond([...])) roda client_new/server_new sem
+mudança, espalhando os datagramas de uma transferência por todas as
+portas:
+
+  envio    : os datagramas vão para uma fila comum e cada porta pega o
+             próximo assim que termina o anterior, então portas mais
+             rápidas levam mais tráfego
+  recepção : cada porta tem seu Deframer; datagramas inteiros entram na
+             ordem de chegada num buffer único, e a remontagem fica com
+             o protocolo de cima, pelo número do pacote (janela
+             seletiva do servidor)
+
+Saúde de cada porta: a cada HEARTBEAT segundos, com ou sem tráfego,
+cada porta em uso manda um quadro de controle (tipo 9) com quantos
+quadros bons e ruins recebeu do outro lado. Uma porta sai de uso por
+COOLDOWN segundos se:
+  - a escrita travar por mais de STALL_TIMEOUT;
+  - nada chegar por ela em DEAD_AFTER segundos;
+  - o outro lado relatar mais de ERROR_LIMIT de quadros ruins;
+  - o outro lado relatar que nenhum dos quadros escritos entre os dois
+    relatos anteriores chegou (perda numa direção só: as respostas
+    continuam chegando e DEAD_AFTER não percebe).
+Uma porta fora de uso também para de mandar heartbeats, então uma falha
+numa direção só tira a porta de uso nos dois lados. Passado o COOLDOWN
+ela volta só com heartbeats, e só volta a levar datagramas quando um
+relato do outro lado mostrar que eles chegaram: uma porta que continua
+com defeito não perde mais uma rajada de datagramas a cada tentativa.
+O datagrama perdido numa porta que caiu é reenviado pelo ACK/NACK do
+protocolo, já pelas portas que restaram.
+
+Escritas que não são um datagrama só (o handshake com o preâmbulo
+SYNC) vão dentro de um quadro de controle, para não desalinhar o
+Deframer do outro lado.
+
+Uso:
+  python bonding.py [n] [baud]   # transferência por 1 e por n loopbacks
+  python bonding.py 3 115200 falha  # porta 0 para no meio da transferência
+"""
+
+# Importa pacote de tempo
+import time
+
+# Threads
+import threading
+
+import collections
+
+from interfaceFisica import Transporte, EmHex
+from deframer import Deframer
+from enlace import enlace
+import protocolo
+
+EOP = protocolo.EOP
+
+MESSAGE_TYPE  = 9       # Quadro de controle do Bond
+HEARTBEAT     = 0.5     # Segundos entre heartbeats de cada porta
+DEAD_AFTER    = 2.0     # Segundos sem receber nada para considerar a porta caída
+STALL_TIMEOUT = 1.0     # Escrita mais longa que isso: porta travada
+ERROR_LIMIT   = 0.5     # Fração de quadros ruins relatada pelo outro lado
+COOLDOWN      = 3.0     # Segundos fora de uso depois de uma falha
+QUEUE_LIMIT   = 4       # Datagramas na fila comum por porta
+
+# Byte 9 dos quadros de controle
+KIND_HEARTBEAT = 1      # payload: quadros bons e ruins recebidos (4 + 4 bytes)
+KIND_RAW       = 2      # payload: bytes escritos que não eram datagrama
+
+def create_frame(kind, payload=b""):
+    return(protocolo.encode(0, 0, MESSAGE_TYPE, payload, byte9=kind, protect=True))
+
+class Membro(object):
+    """ Uma porta do Bond e sua saúde
+    """
+    def __init__(self, transporte, maxPayload):
+        self.link       = enlace(transporte.name, transporte)
+        self.name       = transporte.name
+        self.deframer   = Deframer(self.link.rx, maxPayload)
+        self.up         = True
+        self.probing    = False   # De volta, esperando o outro lado confirmar
+        self.downUntil  = 0.0
+        self.reason     = None
+        self.lastRx     = time.time()
+        self.lastBeat   = 0.0
+        self.sent       = 0     # Datagramas enviados por esta porta
+        self.written    = 0     # Quadros escritos nela, com os heartbeats
+        self.marks      = (0, 0)  # written nos dois últimos relatos do outro lado
+        self.good       = 0     # Quadros bons recebidos por ela
+        self.bad        = 0     # Quadros ruins (ou bytes descartados) recebidos
+        self.peerGood   = 0     # Último relato do outro lado
+        self.peerBad    = 0
+        self.failures   = 0
+        self.threads    = []
+
+    def markDown(self, reason, now):
+        if self.up:
+            print("Bond: porta {} fora de uso ({})".format(self.name, reason))
+        self.up        = False
+        self.reason    = reason
+        self.downUntil = now + COOLDOWN
+        self.failures += 1
+
+    def stats(self):
+        return({'up': self.up, 'probing': self.probing, 'sent': self.sent, 'good': self.good, 'bad': self.bad,
+                'failures': self.failures, 'reason': self.reason})
+
+class Bond(Transporte):
+
+    def __init__(self, transportes, maxPayload=4096, name="bond"):
+        self.name       = name
+        self.membros    = [Membro(t, maxPayload) for t in transportes]
+        self.queue      = collections.deque()
+        self.inbox      = bytearray()
+        self.condition  = threading.Condition()
+        self.timeout    = 0.1   # Espera de read, como a porta serial
+        self.threadStop = False
+
+    def open(self):
+        self.threadStop = False
+        for m in self.membros:
+            m.link.enable()
+            m.lastRx = time.time()
+            m.threads = [threading.Thread(target=self.sender, args=(m,), daemon=True),
+                         threading.Thread(target=self.receiver, args=(m,), daemon=True)]
+            for t in m.threads:
+                t.start()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.threadStop = True
+            self.condition.notify_all()
+        for m in self.membros:
+            for t in m.threads:
+                t.join(1)
+            m.link.disable()
+
+    def flush(self):
+        """ Espera a fila comum e as portas esvaziarem
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: not self.queue or self.threadStop, 5)
+        for m in self.membros:
+            m.link.tx.waitDone(STALL_TIMEOUT)
+
+    def inWaiting(self):
+        return(len(self.inbox))
+
+    def setEncoding(self, encoding):
+        self.flush()
+        for m in self.membros:
+            m.link.setEncoding(encoding)
+
+    def setBaudrate(self, baudrate):
+        # Cada porta tem a sua velocidade; baudrates() é vazio
+        raise ValueError("bond sem troca de velocidade: {}".format(baudrate))
+
+    def write(self, txBuffer):
+        data = bytes(txBuffer)
+        if len(data) < protocolo.OVERHEAD or not data.endswith(EOP) or \
+                len(data) != protocolo.OVERHEAD + protocolo.HEAD.unpack_from(data)[2]:
+            data = create_frame(KIND_RAW, data)
+        if isinstance(txBuffer, EmHex):
+            data = EmHex(data)  # Cada porta escreve o quadro em hex
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.queue) < QUEUE_LIMIT * len(self.membros)
+                                    or self.threadStop)
+            self.queue.append(data)
+            self.condition.notify_all()
+        return(len(txBuffer))
+
+    def read(self, nBytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.inbox or self.threadStop, self.timeout)
+            data = bytes(self.inbox[:nBytes])
+            del self.inbox[:nBytes]
+        return(data, len(data))
+
+    def stats(self):
+        return({"{}:{}".format(i, m.name): m.stats() for i, m in enumerate(self.membros)})
+
+    ##############################
+    # Saúde                      #
+    ##############################
+    def checkHealth(self, m, now):
+        """ Atualiza m.up (chamar com condition)
+        """
+        if not m.up and now >= m.downUntil:
+            m.up = True
+            m.probing = True
+            m.lastRx = now  # Nova chance para o heartbeat chegar
+            m.marks = (m.written, m.written)
+        if m.up and now - m.lastRx > DEAD_AFTER:
+            m.markDown("sem receber há {:.1f} s".format(now - m.lastRx), now)
+
+    def healthy(self, m):
+        return(m.up and not m.probing)
+
+    def usable(self, m):
+        """ Se m pode pegar datagramas da fila (chamar com condition)
+
+        Sem nenhuma porta saudável, todas continuam tentando.
+        """
+        return(self.healthy(m) or not any(self.healthy(o) for o in self.membros))
+
+    ##############################
+    # Envio                      #
+    ##############################
+    def sender(self, m):
+        while True:
+            with self.condition:
+                while not self.threadStop:
+                    now = time.time()
+                    self.checkHealth(m, now)
+                    if now - m.lastBeat >= HEARTBEAT and (m.up or self.usable(m)):
+                        # Antes dos datagramas: o relato sai mesmo com a fila cheia
+                        frame = create_frame(KIND_HEARTBEAT, (m.good % 2**32).to_bytes(4, 'big') +
+                                             (m.bad % 2**32).to_bytes(4, 'big'))
+                        m.lastBeat = now
+                        break
+                    if self.queue and self.usable(m):
+                        frame = self.queue.popleft()
+                        m.sent += 1
+                        break
+                    self.condition.wait(max(0.05, HEARTBEAT - (now - m.lastBeat)))
+                if self.threadStop:
+                    return
+                m.written += 1
+                self.condition.notify_all()
+            m.link.sendData(frame)
+            if not m.link.tx.waitDone(STALL_TIMEOUT):
+                with self.condition:
+                    m.markDown("escrita travada", time.time())
+                # Só volta a pegar datagramas quando a porta destravar
+                m.link.tx.waitDone()
+
+    ##############################
+    # Recepção                   #
+    ##############################
+    def receiver(self, m):
+        errors = 0
+        while not self.threadStop:
+            frame = m.deframer.getFrame(0.2)
+            # Resync (HEAD incoerente) ou, no modo binário, escape inválido
+            if m.deframer.resyncs + m.deframer.badEscapes != errors:
+                m.bad += m.deframer.resyncs + m.deframer.badEscapes - errors
+                errors = m.deframer.resyncs + m.deframer.badEscapes
+            if frame is None:
+                continue
+            if not frame.endswith(EOP) or len(frame) < protocolo.OVERHEAD:
+                m.bad += 1
+                continue
+            _, _, size, _, message_type = protocolo.HEAD.unpack_from(frame)[:5]
+            if len(frame) != protocolo.OVERHEAD + size:
+                m.bad += 1
+                continue
+            m.good += 1
+            with self.condition:
+                m.lastRx = time.time()
+                if message_type == MESSAGE_TYPE:
+                    self.control(m, frame)
+                else:
+                    self.inbox += frame
+                self.condition.notify_all()
+
+    def control(self, m, frame):
+        """ Trata um quadro de controle recebido por m (chamar com condition)
+        """
+        fields = protocolo.HEAD.unpack_from(frame)
+        payload = protocolo.payload(frame)
+        if fields[3] != protocolo.frame_crc(fields, payload, True):
+            m.good -= 1
+            m.bad += 1
+            return
+        kind = fields[5]
+        if kind == KIND_RAW:
+            self.inbox += payload
+        elif kind == KIND_HEARTBEAT and len(payload) == 8:
+            good = int.from_bytes(payload[0:4], 'big')
+            bad = int.from_bytes(payload[4:8], 'big')
+            dGood, dBad = (good - m.peerGood) % 2**32, (bad - m.peerBad) % 2**32
+            m.peerGood, m.peerBad = good, bad
+            # Os quadros escritos entre os dois relatos anteriores já
+            # tiveram um intervalo inteiro para chegar
+            expected = m.marks[1] - m.marks[0]
+            m.marks = (m.marks[1], m.written)
+            if m.up and dBad >= 2 and dBad > ERROR_LIMIT * (dGood + dBad):
+                m.markDown("{} de {} quadros ruins do outro lado".format(dBad, dGood + dBad), time.time())
+            elif m.up and expected >= 2 and dGood + dBad == 0:
+                m.markDown("{} quadros sem chegar ao outro lado".format(expected), time.time())
+            elif m.probing and dGood > 0:
+                m.probing = False
+                print("Bond: porta {} de volta".format(m.name))
+                self.condition.notify_all()
+
+FAILURE_AT = 1.0    # Segundos de transferência até a falha da porta 0 no demo
+
+def demo(nLinks=3, baudrate=115200, failure=False, fileSize=100000):
+    """ Mesma transferência por uma porta e por nLinks portas
+    """
+    import os
+    import client_new
+    import server_new
+    import transporte
+    from canal import CanalRuidoso
+
+    content = os.urandom(fileSize)
+    for n in sorted({1, nLinks}):
+        timing = {}
+        send_file = client_new.send_file
+        def timed_send_file(*args):
+            timing['start'] = time.time()
+            if failure and n > 1:
+                # A porta 0 para de entregar no meio da transferência
+                threading.Timer(FAILURE_AT, setattr, (canais[0], 'frameLossRate', 1.0)).start()
+            send_file(*args)
+            timing['end'] = time.time()
+        settings = {'MAX_PAYLOAD': 1024, 'WINDOW_SIZE': 4 * n, 'send_file': timed_send_file}
+
+        with transporte.demoSession(content, settings) as received:
+            pairs = [transporte.loopbackPair(baudrate) for _ in range(n)]
+            canais = [CanalRuidoso(a, seed=i) for i, (a, b) in enumerate(pairs)]
+            bondA = Bond(canais, name="bondA")
+            bondB = Bond([b for a, b in pairs], name="bondB")
+            client_new.com1 = enlace(bondA.name, bondA)
+            server_new.com2 = enlace(bondB.name, bondB)
+
+            server = threading.Thread(target=server_new.main, daemon=True)
+            server.start()
+            client_new.main()
+            server.join()
+
+            with open(received, 'rb') as f:
+                same = f.read() == content
+
+        elapsed = timing['end'] - timing['start']
+        print("{} porta(s): {:.2f} s, {:.0f} B/s, arquivo igual: {}".format(
+            n, elapsed, fileSize / elapsed, same))
+        for name, s in bondA.stats().items():
+            print("  {}: {}".format(name, s))
+
+if __name__ == "__main__":
+    import sys
+    nLinks = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    baudrate = int(sys.argv[2]) if len(sys.argv) > 2 else 115200
+    demo(nLinks, baudrate, failure=len(sys.argv) > 3 and sys.argv[3] == 'falha')
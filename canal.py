@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Simulador de canal com falhas
+####################################################
+"""
+CanalRuidoso fica entre o enlace e um Transporte qualquer e estraga o
+que é escrito de forma reproduzível (mesma semente e mesma sequência de
+escritas = mesmas falhas):
+
+  bitErrorRate  : probabilidade de inverter cada bit
+  burstRate     : probabilidade, por byte, de começar uma rajada que
+                  troca burstLen bytes por lixo
+  byteDropRate  : probabilidade de perder cada byte
+  frameLossRate : probabilidade de perder a escrita inteira
+  truncateRate  : probabilidade de cortar a escrita num ponto aleatório
+  latency       : atraso fixo de entrega (s)
+  jitter        : atraso extra uniforme em [0, jitter] (s)
+  reorderRate   : probabilidade de uma escrita ser entregue depois das
+                  seguintes (atrasada em reorderDelay s)
+  bandwidth     : limite em bytes/s; a escrita bloqueia como numa UART
+  warmup        : escritas iniciais que passam sem falhas (handshake)
+
+Exemplo, só na direção cliente -> servidor:
+  a, b = transporte.loopbackPair()
+  com1 = enlace(a.name, CanalRuidoso(a, seed=7, bitErrorRate=1e-4, warmup=2))
+  com2 = enlace(b.name, b)
+"""
+
+# Importa pacote de tempo
+import time
+
+# Threads
+import threading
+
+import heapq
+import math
+import random
+
+from interfaceFisica import Transporte, EmHex
+
+class CanalRuidoso(Transporte):
+
+    PARAMS = ('bitErrorRate', 'burstRate', 'burstLen', 'byteDropRate', 'frameLossRate',
+              'truncateRate', 'latency', 'jitter', 'reorderRate', 'reorderDelay',
+              'bandwidth', 'warmup')
+
+    def __init__(self, transporte, seed=0, bitErrorRate=0.0, burstRate=0.0, burstLen=8,
+                 byteDropRate=0.0, frameLossRate=0.0, truncateRate=0.0, latency=0.0,
+                 jitter=0.0, reorderRate=0.0, reorderDelay=0.05, bandwidth=None, warmup=0):
+        self.transporte    = transporte
+        self.name          = transporte.name
+        self.metrics       = transporte.metrics  # Contados pela fisica de baixo
+        self.rng           = random.Random(seed)
+        self.bitErrorRate  = bitErrorRate
+        self.burstRate     = burstRate
+        self.burstLen      = burstLen
+        self.byteDropRate  = byteDropRate
+        self.frameLossRate = frameLossRate
+        self.truncateRate  = truncateRate
+        self.latency       = latency
+        self.jitter        = jitter
+        self.reorderRate   = reorderRate
+        self.reorderDelay  = reorderDelay
+        self.bandwidth     = bandwidth
+        self.warmup        = warmup
+        self.stats         = {'writes': 0, 'bitFlips': 0, 'bursts': 0, 'byteDrops': 0,
+                              'framesLost': 0, 'truncations': 0, 'reordered': 0}
+
+        # Linha de atraso: (instante de entrega, sequência, dados)
+        self.delayed     = []
+        self.seq         = 0
+        self.txFree      = 0.0
+        self.lastDeliver = 0.0
+        self.inFlight    = False
+        self.condition   = threading.Condition()
+        self.threadStop  = False
+        self.thread      = None
+
+    def usesDelayLine(self):
+        return(bool(self.latency or self.jitter or self.reorderRate or self.bandwidth))
+
+    def open(self):
+        self.transporte.open()
+        if self.usesDelayLine():
+            self.threadStop = False
+            self.thread = threading.Thread(target=self.deliver, daemon=True)
+            self.thread.start()
+
+    def close(self):
+        self.drain()
+        with self.condition:
+            self.threadStop = True
+            self.condition.notify_all()
+        if self.thread is not None:
+            self.thread.join(1)
+        self.transporte.close()
+
+    def flush(self):
+        self.transporte.flush()
+
+    def inWaiting(self):
+        return(self.transporte.inWaiting())
+
+    def setEncoding(self, encoding):
+        # O que ainda está na linha de atraso sai na codificação antiga
+        self.drain()
+        self.transporte.setEncoding(encoding)
+
+    def realign(self):
+        self.transporte.realign()
+
+    def stuffed(self):
+        return(self.transporte.stuffed())
+
+    @property
+    def baudrate(self):
+        return(self.transporte.baudrate)
+
+    def baudrates(self):
+        return(self.transporte.baudrates())
+
+    def setBaudrate(self, baudrate):
+        # O que ainda está na linha de atraso sai na velocidade antiga
+        self.drain()
+        self.transporte.setBaudrate(baudrate)
+
+    def read(self, nBytes):
+        return(self.transporte.read(nBytes))
+
+    def write(self, txBuffer):
+        self.stats['writes'] += 1
+        data = txBuffer
+        if self.stats['writes'] > self.warmup:
+            data = self.impair(txBuffer)
+            if data and isinstance(txBuffer, EmHex):
+                data = EmHex(data)
+        if not self.usesDelayLine():
+            if data:
+                self.transporte.write(data)
+            return(len(txBuffer))
+
+        now = time.perf_counter()
+        if self.bandwidth:
+            # Bloqueia o tempo de serialização, como a UART faria
+            self.txFree = max(now, self.txFree) + len(txBuffer) / self.bandwidth
+            if self.txFree > now:
+                time.sleep(self.txFree - now)
+            now = self.txFree
+        deliverAt = now + self.latency + self.rng.uniform(0, self.jitter)
+        with self.condition:
+            if self.rng.random() < self.reorderRate:
+                self.stats['reordered'] += 1
+                deliverAt += self.reorderDelay
+            else:
+                # Sem reordenação o canal continua FIFO mesmo com jitter
+                deliverAt = max(deliverAt, self.lastDeliver)
+                self.lastDeliver = deliverAt
+            if data:
+                # Sem falhas data é o próprio txBuffer, que quem chamou pode reusar
+                heapq.heappush(self.delayed, (deliverAt, self.seq,
+                                              data if isinstance(data, bytes) else bytes(data)))
+                self.seq += 1
+                self.condition.notify_all()
+        return(len(txBuffer))
+
+    def impair(self, txBuffer):
+        """ Aplica as falhas configuradas e retorna os bytes a entregar
+        """
+        rng = self.rng
+        if rng.random() < self.frameLossRate:
+            self.stats['framesLost'] += 1
+            return(b"")
+        data = bytearray(txBuffer)
+        if data and rng.random() < self.truncateRate:
+            self.stats['truncations'] += 1
+            del data[rng.randrange(len(data)):]
+        if self.byteDropRate:
+            drops = list(self.positions(len(data), self.byteDropRate))
+            for i in reversed(drops):
+                del data[i]
+            self.stats['byteDrops'] += len(drops)
+        for i in self.positions(len(data), self.burstRate):
+            self.stats['bursts'] += 1
+            for j in range(i, min(i + self.burstLen, len(data))):
+                data[j] = rng.getrandbits(8)
+        for bit in self.positions(len(data) * 8, self.bitErrorRate):
+            self.stats['bitFlips'] += 1
+            data[bit // 8] ^= 1 << (bit % 8)
+        return(bytes(data))
+
+    def positions(self, n, rate):
+        """ Sorteia as posições em [0, n) atingidas com probabilidade rate
+
+        Pula direto de uma falha à seguinte (distribuição geométrica),
+        então o custo depende do número de falhas e não de n.
+        """
+        if rate <= 0:
+            return
+        if rate >= 1:
+            yield from range(n)
+            return
+        i = -1
+        logq = math.log(1 - rate)
+        while True:
+            i += 1 + int(math.log(1 - self.rng.random()) / logq)
+            if i >= n:
+                return
+            yield i
+
+    def deliver(self):
+        while True:
+            with self.condition:
+                while not self.threadStop:
+                    if self.delayed:
+                        wait = self.delayed[0][0] - time.perf_counter()
+                        if wait <= 0:
+                            break
+                        self.condition.wait(wait)
+                    else:
+                        self.condition.wait()
+                if self.threadStop:
+                    return
+                _, _, data = heapq.heappop(self.delayed)
+                self.inFlight = True
+            self.transporte.write(data)
+            with self.condition:
+                self.inFlight = False
+                self.condition.notify_all()
+
+    def drain(self):
+        """ Bloqueia até a linha de atraso esvaziar
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: (not self.delayed and not self.inFlight) or self.threadStop)
@@ -1,52 +1,299 @@
+import os
+import sys
 import time
-import datetime
 import binascii
 from enlace import *
+from deframer import Deframer
+import registro
+import compressao
+import fec
+import protocolo
+import lote
+import velocidade
 
 # Configurar a porta serial
 serialName = "/dev/tty.usbmodem2101"  # Altere para a porta correta
 com1 = enlace(serialName)
 
+# Registro de eventos: 'text' (client_log.txt), 'binary' (client_log.bin) ou 'jsonl'
+LOG_FORMAT = 'text'
+log = registro.Registro('client_log', LOG_FORMAT)
+
 # Configurações do EOP
-EOP = b'\xAA\xBB\xCC'  # 3 bytes
+EOP = protocolo.EOP  # 3 bytes
+
+PAYLOAD_SIZE = 50       # Payload inicial (e fixo com servidores antigos)
+MAX_PAYLOAD = 1024      # Maior payload proposto no handshake (bytes 2-3)
+MIN_PAYLOAD = 16        # Menor payload ao reduzir por erros
+SHRINK_AFTER = 2        # Falhas seguidas (NACK de CRC/tamanho ou timeout) para reduzir
+GROW_AFTER = 8          # ACKs seguidos sem reenvio para dobrar o payload
+max_payload = PAYLOAD_SIZE  # Payload máximo negociado
+
+# Janela deslizante (selective repeat)
+WINDOW_SIZE = 8         # Pacotes em voo que o cliente propõe no handshake
+window_size = 1         # Janela negociada (1 = stop-and-wait)
+
+# Timeout de retransmissão, estimado pelo RTT medido (ver RTO)
+INITIAL_RTO = 1.0       # Antes da primeira medida
+MIN_RTO = 0.05          # Piso: o ACK pode esperar o TX do servidor
+MAX_RTO = 5.0           # Teto do backoff exponencial
 
-def calculate_crc(payload):
-    crc = binascii.crc_hqx(payload, 0xFFFF)
-    return crc
+# Capacidades anunciadas no byte 10 do handshake
+FLAG_BINARY = 0x01      # Codificação binária com byte-stuffing no fio
+FLAG_HEAD_CRC = 0x02    # CRC cobre também o HEAD (inclusive de ACK/NACK)
+FLAG_RESUME = 0x04      # Pedido de retomada (tipo 6) antes dos dados
+FLAG_COMPRESS = 0x08    # Payloads comprimidos; o codec vai no byte 11
+FLAG_FEC = 0x10         # Paridade XOR a cada k pacotes; k vai no byte 0
+FLAG_BATCH = 0x20       # Manifesto + vários arquivos num fluxo só (ver lote.py)
+FLAG_BAUD = 0x40        # Troca de velocidade; as velocidades vão nos bytes 6-7 (ver velocidade.py)
+FLAG_SYNC = 0x80        # O servidor repete a resposta do handshake até o primeiro pacote
+BINARY_WIRE = True      # Propõe o modo binário (o hex continua como fallback)
+COMPRESSION = 'zlib'    # Codec proposto (ver compressao.CODECS); None desliga
+head_crc = False        # FLAG_HEAD_CRC negociado
+resume_ok = False       # FLAG_RESUME negociado
+codec = 0               # Codec negociado (0 = sem compressão)
+FEC_GROUP = 0           # k proposto para o FEC; 0 desliga (quando compensa: ver fec.py)
+fec_group = 0           # k negociado (só com janela e FLAG_HEAD_CRC)
+compression_stats = None  # compressao.Compressor.stats() do último envio
+RESUME_RETRIES = 3      # Tentativas do pedido de retomada
+HANDSHAKE_RETRIES = 5   # Tentativas do handshake (~9 s ao todo)
+HANDSHAKE_WAIT = 1.2    # Primeira espera pela resposta; as seguintes dobram até HANDSHAKE_MAX_WAIT
+HANDSHAKE_MAX_WAIT = 2.0
+LEGACY_ATTEMPT = 1      # Tentativa sem preâmbulo, para servidores antigos (ver handshake)
+SEND_PATH = 'arquivo.txt'  # Arquivo ou diretório (enviado como lote) a enviar
+
+# Velocidade (ver velocidade.py)
+TUNE_BAUD = True        # Propõe subir a velocidade depois do handshake
+BAUD_WAIT = 0.5         # Espera por ACCEPT/ECHO a cada tentativa
+BAUD_RETRIES = 6        # Tentativas do REQUEST: passam do SWITCH_TIMEOUT de um servidor que já trocou
+PROBE_RETRIES = 3       # Tentativas do PROBE: cabem no SWITCH_TIMEOUT do servidor
+speed = None            # velocidade.Velocidade negociada; None sem FLAG_BAUD
+last_heard = 0.0        # Última resposta íntegra, para velocidade.SILENCE
+
+# Motivo do NACK, no byte 9 (servidores antigos mandam 0)
+NACK_ORDER = 1
+NACK_SIZE = 2
+NACK_CRC = 3
+NACK_NAMES = {NACK_ORDER: 'order', NACK_SIZE: 'size', NACK_CRC: 'crc'}
+
+# Snapshot periódico de com1.metrics (ver metricas.py); None desliga
+METRICS_INTERVAL = None
+METRICS_FILE = 'client_metrics.jsonl'
 
 def create_datagram(packet_number, total_packets, payload, fake_payload_size=None):
-    payload_size = fake_payload_size if fake_payload_size is not None else len(payload)
-    crc = calculate_crc(payload)
+    """Monta o pacote de dados (ver protocolo.encode)"""
     message_type = 3  # Data packet
-    
-    head = (packet_number.to_bytes(2, 'big') +
-            total_packets.to_bytes(2, 'big') +
-            payload_size.to_bytes(2, 'big') +
-            crc.to_bytes(2, 'big') +
-            message_type.to_bytes(1, 'big') +
-            b'\x00'*3)
-    
-    return head + payload + EOP
-
-def handshake():
-    # Enviar byte de sacrifício para eliminar "lixo"
-    time.sleep(0.2)
-    com1.sendData(b'00')  # Byte de sacrifício
-    time.sleep(1)
+    return protocolo.encode(packet_number, total_packets, message_type, payload,
+                            protect=head_crc, size=fake_payload_size)
+
+def receive_response(timeout=5):
+    """Aguarda o próximo datagrama de resposta (HEAD + EOP, sem payload)
+
+    Retorna None no timeout. Bytes perdidos ou corrompidos no caminho
+    de volta não desalinham as respostas seguintes; com FLAG_HEAD_CRC,
+    respostas com o HEAD corrompido são descartadas.
+    """
+    global last_heard
+    deadline = time.time() + timeout
+    # Só a resposta de retomada (12 bytes) e o ECHO têm payload
+    deframer = Deframer(com1.rx, velocidade.PROBE_SIZE)
+    while True:
+        response = deframer.getFrame(max(0, deadline - time.time()))
+        if response is None:
+            watch_speed()
+            return response
+        if not head_crc:
+            return response
+        fields = protocolo.HEAD.unpack_from(response)
+        if fields[3] == protocolo.frame_crc(fields, protocolo.payload(response), True):
+            last_heard = time.time()
+            return response
+        print('Cliente: Resposta com HEAD corrompido descartada')
+        com1.metrics.count('client.corrupt_responses')
+
+class Packets:
+    """Divide o arquivo em pacotes de tamanho variável
+
+    Cada pacote recebe seus limites na primeira vez que é montado, com o
+    tamanho de payload do momento; reenvios usam sempre os mesmos bytes.
+    total_packets é uma estimativa que muda junto com o tamanho, mas só o
+    último pacote sai com total_packets == packet_number.
+
+    O payload é lido do arquivo a cada envio e só os limites dos pacotes
+    ainda sem ACK ficam guardados, então a memória não cresce com o arquivo.
+
+    file pode ser um fluxo que só sabe o tamanho no fim (compressao.Compressor):
+    length é relido a cada pacote novo e o fluxo é avisado (release) do que
+    já foi confirmado.
+    """
+    def __init__(self, file, size, max_size, adaptive, offset=0):
+        self.file = file
+        self.length = file.seek(0, os.SEEK_END)
+        self.release = getattr(file, 'release', None)
+        self.size = min(size, max_size)
+        self.max_size = max_size
+        self.adaptive = adaptive
+        self.bounds = {}    # Pacote sem ACK -> (início, fim)
+        self.count = 0      # Pacotes já numerados
+        self.end = offset   # Fim do último pacote numerado
+        self.failures = 0   # Falhas seguidas
+        self.clean = 0      # ACKs seguidos sem reenvio
+
+    def total(self):
+        """Estimativa do total de pacotes com o tamanho atual"""
+        left = self.length - self.end
+        return self.count + (left + self.size - 1) // self.size
+
+    def has(self, packet_number):
+        return packet_number <= self.total()
+
+    def total_for(self, packet_number):
+        """total_packets a mandar no HEAD do pacote"""
+        if self.bounds[packet_number][1] == self.length:
+            return packet_number
+        return max(self.total(), packet_number + 1)
+
+    def payload(self, packet_number):
+        while self.count < packet_number:
+            self.count += 1
+            self.file.seek(self.end)
+            data = self.file.read(self.size)
+            self.bounds[self.count] = (self.end, self.end + len(data))
+            self.end += len(data)
+            self.length = self.file.seek(0, os.SEEK_END)
+            if self.count == packet_number:
+                return data
+        start, end = self.bounds[packet_number]
+        self.file.seek(start)
+        return self.file.read(end - start)
+
+    def acked(self, packet_number, first_try):
+        """Retorna o tamanho do payload confirmado"""
+        start, end = self.bounds.pop(packet_number, (0, 0))
+        if self.release:
+            self.release(min(self.bounds.values())[0] if self.bounds else self.end)
+        self.failures = 0
+        self.clean = self.clean + 1 if first_try else 0
+        if self.adaptive and self.clean >= GROW_AFTER and self.size < self.max_size:
+            self.size = min(self.max_size, self.size * 2)
+            self.clean = 0
+            print(f'Cliente: Payload aumentado para {self.size} bytes')
+        return end - start
+
+    def failed(self):
+        self.clean = 0
+        self.failures += 1
+        if self.adaptive and self.failures >= SHRINK_AFTER and self.size > MIN_PAYLOAD:
+            self.size = max(MIN_PAYLOAD, self.size // 2)
+            self.failures = 0
+            print(f'Cliente: Payload reduzido para {self.size} bytes')
+
+class RTO:
+    """Timeout de retransmissão a partir do RTT (Jacobson/Karels, RFC 6298)
+
+    srtt e rttvar são médias móveis do RTT e do seu desvio; o timeout é
+    srtt + 4*rttvar, entre MIN_RTO e MAX_RTO. Só entram medidas de
+    pacotes confirmados na primeira tentativa (regra de Karn): o ACK de
+    um pacote reenviado pode ser de qualquer um dos envios. Cada timeout
+    dobra o valor (backoff) até a próxima medida válida.
+    """
+    ALPHA = 1 / 8
+    BETA = 1 / 4
+    K = 4
+    GRANULARITY = 0.01  # Menor folga sobre srtt, em segundos
+
+    def __init__(self, initial=None, min_rto=None, max_rto=None):
+        self.min_rto = MIN_RTO if min_rto is None else min_rto
+        self.max_rto = MAX_RTO if max_rto is None else max_rto
+        self.rto = INITIAL_RTO if initial is None else initial
+        self.srtt = None
+        self.rttvar = None
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt, self.rttvar = rtt, rtt / 2
+        else:
+            self.rttvar = (1 - self.BETA) * self.rttvar + self.BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.ALPHA) * self.srtt + self.ALPHA * rtt
+        self.rto = min(self.max_rto, max(self.min_rto,
+                                         self.srtt + max(self.GRANULARITY, self.K * self.rttvar)))
+
+    def backoff(self):
+        self.rto = min(self.max_rto, self.rto * 2)
+
+rto = RTO()
+
+def handshake(batch=False):
+    global window_size, max_payload, head_crc, resume_ok, codec, fec_group, rto, speed
+
+    # A resposta do handshake não tem CRC no HEAD; o que foi negociado
+    # (e medido) numa sessão anterior não vale mais
+    window_size, max_payload, head_crc, resume_ok, codec, fec_group = 1, PAYLOAD_SIZE, False, False, 0, 0
+    rto = RTO()
+    speed = None
 
     message_type = 1  # Handshake
-    head = (b'\x00'*8 + message_type.to_bytes(1, 'big') + b'\x00'*3)
-    datagram = head + EOP  # Handshake payload vazio
-    com1.sendData(datagram)
-    print("Cliente: Enviando mensagem de handshake...")
-    log_event('envio', message_type, len(datagram))
-    response, _ = com1.getData(15)  # Tamanho total do datagrama esperado (HEAD + EOP)
+    # Os bytes reservados anunciam a janela (9), as capacidades (10) e o
+    # codec de compressão (11), o payload máximo vai no campo
+    # total_packets (2-3), as velocidades no campo de CRC (6-7) e o grupo
+    # do FEC no byte 0; servidores antigos os ignoram. O campo de tamanho
+    # (4-5) fica 0: o handshake não tem payload
+    proposed_codec = compressao.CODECS.get(COMPRESSION, 0)
+    rates = com1.fisica.baudrates() if TUNE_BAUD else []
+    flags = ((FLAG_BINARY if BINARY_WIRE else 0) | FLAG_HEAD_CRC | FLAG_RESUME | FLAG_SYNC |
+             (FLAG_COMPRESS if proposed_codec else 0) | (FLAG_FEC if FEC_GROUP else 0) |
+             (FLAG_BATCH if batch else 0) |
+             (FLAG_BAUD if any(rate > com1.fisica.baudrate for rate in rates) else 0))
+    datagram = protocolo.encode_handshake(message_type, MAX_PAYLOAD, WINDOW_SIZE, flags,
+                                          proposed_codec, FEC_GROUP,
+                                          velocidade.mask_of(rates))  # Handshake payload vazio
+    # O preâmbulo deixa o servidor descartar o lixo da linha, e a resposta
+    # vem com o mesmo preâmbulo; sem resposta, repete com espera dobrada.
+    # Um servidor antigo (stop-and-wait) consome o primeiro byte, limpa o
+    # buffer até ~1.1 s depois e lê 15 bytes exatos: a tentativa
+    # LEGACY_ATTEMPT vai sem preâmbulo para ele, e a resposta dele é
+    # protocolo.LEGACY_REPLY, também sem preâmbulo
+    deframer = Deframer(com1.rx)
+    options = [(protocolo.SYNC, protocolo.OVERHEAD), (protocolo.LEGACY_REPLY, 0)]
+    timeout = max(INITIAL_RTO, HANDSHAKE_WAIT)
+    for attempt in range(HANDSHAKE_RETRIES):
+        com1.sendData(datagram if attempt == LEGACY_ATTEMPT else protocolo.SYNC + datagram)
+        sent_at = time.time()
+        print("Cliente: Enviando mensagem de handshake...")
+        log_event('envio', message_type, len(datagram))
+        discarded = deframer.discarded
+        sync, response = deframer.getSyncedAny(options, timeout)
+        if sync == protocolo.LEGACY_REPLY:
+            response = protocolo.LEGACY_REPLY
+        if response:
+            break
+        if deframer.discarded > discarded:
+            com1.fisica.realign()   # Bytes sem preâmbulo, ver fisica.realign
+        com1.metrics.count('client.handshake_retries')
+        timeout = min(HANDSHAKE_MAX_WAIT, timeout * 2)
     if response:
-        head = response[:12]
-        message_type = head[8]
+        # Primeira medida de RTT, antes dos dados; a resposta de uma
+        # tentativa repetida pode ser de qualquer envio (regra de Karn)
+        if attempt == 0:
+            rto.sample(time.time() - sent_at)
+        group, accepted_payload, accepted_rates, message_type, window, flags, accepted_codec = \
+            protocolo.HANDSHAKE.unpack_from(response)
         log_event('receb', message_type, len(response))
         if message_type == 2:
-            print("Cliente: Handshake bem-sucedido")
+            # Servidor antigo responde com zeros: mantém stop-and-wait
+            window_size = max(1, min(WINDOW_SIZE, window))
+            max_payload = min(MAX_PAYLOAD, accepted_payload) or PAYLOAD_SIZE
+            head_crc = bool(flags & FLAG_HEAD_CRC)
+            resume_ok = bool(flags & FLAG_RESUME)
+            codec = accepted_codec if flags & FLAG_COMPRESS else 0
+            fec_group = group if flags & FLAG_FEC and window_size > 1 else 0
+            if flags & FLAG_BINARY:
+                com1.setEncoding('binary')
+            if flags & FLAG_BAUD and head_crc:
+                speed = velocidade.Velocidade(com1, velocidade.rates_of(accepted_rates))
+            if batch and not flags & FLAG_BATCH:
+                print("Cliente: Servidor sem suporte a lote; o lote vai como um arquivo só (python lote.py separa)")
+            print(f"Cliente: Handshake bem-sucedido (janela {window_size}, payload até {max_payload})")
             return True
         else:
             print("Cliente: Resposta inesperada no handshake")
@@ -55,18 +302,163 @@ def handshake():
         print("Cliente: Handshake falhou")
         return False
 
-def send_file(file_path):
-    """Envia um arquivo fragmentado em pacotes"""
-    with open(file_path, 'rb') as file:
-        content = file.read()
+def tune_baud():
+    """Sobe a velocidade uma por vez enquanto o padrão de teste passar"""
+    global last_heard
+    last_heard = time.time()
+    for rate in speed.higher():
+        if not switch_baud(rate):
+            break
+    print(f'Cliente: Transferência a {speed.rate()} baud')
+
+def switch_baud(rate):
+    """Troca os dois lados para rate (ver velocidade.py)
+
+    Repete o REQUEST até o ACCEPT, troca e repete o PROBE até o padrão
+    voltar íntegro no ECHO. Se não voltar, retorna False já de volta à
+    velocidade anterior.
+    """
+    global rto
+    previous = speed.rate()
+    index = velocidade.RATES.index(rate)
+    if not baud_exchange(velocidade.REQUEST, velocidade.ACCEPT, index, b'', BAUD_RETRIES):
+        print(f'Cliente: Servidor não confirmou a troca para {rate} baud')
+        return False
+    accepted_at = time.time()
+    speed.set(rate)
+    pattern = velocidade.probe_pattern()[:max_payload]
+    if baud_exchange(velocidade.PROBE, velocidade.ECHO, index, pattern, PROBE_RETRIES):
+        print(f'Cliente: Velocidade {rate} baud')
+        rto = RTO()  # O RTT medido era de outra velocidade
+        return True
+    print(f'Cliente: Padrão de teste não passou a {rate} baud, voltando para {previous}')
+    speed.set(previous)
+    # O servidor só volta depois de esperar o PROBE por SWITCH_TIMEOUT
+    time.sleep(max(0, accepted_at + velocidade.SWITCH_TIMEOUT - time.time()))
+    return False
+
+def baud_exchange(operation, reply, index, payload, attempts):
+    """Envia um datagrama de velocidade até chegar reply com o mesmo
+    índice e payload; outras respostas (ACKs atrasados) são descartadas"""
+    datagram = protocolo.encode(0, 0, velocidade.MESSAGE_TYPE, payload, index, operation, protect=True)
+    for _ in range(attempts):
+        com1.sendData(datagram)
+        log_event('envio', velocidade.MESSAGE_TYPE, len(datagram))
+        deadline = time.time() + BAUD_WAIT
+        while True:
+            response = receive_response(max(0, deadline - time.time()))
+            if response is None:
+                break
+            _, _, _, _, message_type, byte9, byte10, _ = protocolo.HEAD.unpack_from(response)
+            if message_type == velocidade.MESSAGE_TYPE and byte9 == index and byte10 == reply and \
+                    protocolo.payload(response) == payload:
+                log_event('receb', message_type, len(response))
+                return True
+    return False
+
+def step_down():
+    """Reenvios demais na velocidade atual: desce uma; retorna True se desceu"""
+    rate = speed.lower()
+    print(f'Cliente: Reenvios demais a {speed.rate()} baud, descendo para {rate}')
+    com1.metrics.count('client.baud_downgrades')
+    if switch_baud(rate):
+        return True
+    speed.reset()  # Só tenta de novo depois de outros ERROR_WINDOW envios
+    return False
+
+def watch_speed():
+    """Fora da velocidade do handshake, volta para ela depois de
+    velocidade.SILENCE sem nenhuma resposta íntegra (o servidor faz o mesmo)"""
+    global last_heard
+    if speed and speed.tuned() and time.time() - last_heard > velocidade.SILENCE:
+        print(f'Cliente: Nada íntegro a {speed.rate()} baud em {velocidade.SILENCE} s, '
+              f'voltando para {speed.base}')
+        speed.fallback()
+        last_heard = time.time()
+
+def create_resume_datagram(file_path, restart=False):
+    """Cria o pedido de retomada: tamanho, data e nome do arquivo (ou lote)"""
+    name, size, mtime = lote.identity(file_path)
+    payload = protocolo.RESUME_REQUEST.pack(size, mtime) + name.encode()
+    message_type = 6  # Pedido de retomada
+    # Byte 9: 1 = descartar o checkpoint
+    return protocolo.encode(0, 0, message_type, payload, byte9=int(restart), protect=head_crc)
+
+def prefix_crc(file_path, size):
+    """CRC-32 dos primeiros size bytes do arquivo"""
+    digest = 0
+    with lote.open_source(file_path) as file:
+        while size > 0:
+            chunk = file.read(min(size, 64 * 1024))
+            if not chunk:
+                break
+            digest = binascii.crc32(chunk, digest)
+            size -= len(chunk)
+    return digest
+
+def resume(file_path):
+    """Pergunta ao servidor quantos bytes de file_path ele já tem
+
+    Retorna o byte a partir do qual enviar, ou None se o servidor não
+    responder. Se o prefixo guardado no servidor não bater com o arquivo
+    local, pede para recomeçar do zero.
+    """
+    restart = False
+    for _ in range(RESUME_RETRIES):
+        datagram = create_resume_datagram(file_path, restart)
+        com1.sendData(datagram)
+        log_event('envio', 6, len(datagram))
+        response = receive_response()
+        if not response or protocolo.HEAD.unpack_from(response)[4] != 7 or \
+                len(response) != protocolo.OVERHEAD + protocolo.RESUME.size:
+            continue
+        log_event('receb', 7, len(response))
+        offset, digest = protocolo.RESUME.unpack_from(response, protocolo.HEAD_SIZE)
+        if offset and prefix_crc(file_path, offset) != digest:
+            print('Cliente: Arquivo parcial no servidor é diferente, recomeçando')
+            restart = True
+            continue
+        if offset:
+            print(f'Cliente: Retomando a partir do byte {offset}')
+        return offset
+    return None
+
+def send_file(file_path, offset=0):
+    """Envia um arquivo fragmentado em pacotes, lendo-o aos poucos
+
+    Com offset, envia só a partir desse byte (transferência retomada).
+    Com compressão negociada, os pacotes saem do fluxo comprimido do
+    arquivo a partir de offset. file_path pode ser um lote.Lote.
+    """
+    global compression_stats
+    with lote.open_source(file_path) as file:
+        source = file
+        if codec:
+            source = compressao.Compressor(file, codec, offset)
+            offset = 0
+        # Sem FLAG_HEAD_CRC o servidor usa o total do primeiro pacote: tamanho fixo
+        packets = Packets(source, PAYLOAD_SIZE, max_payload, head_crc, offset)
+        send_packets(packets)
+        if source is not file:
+            compression_stats = source.stats()
+            print('Cliente: {} -> {} bytes comprimidos (razão {:.2f}, {} de {} blocos comprimidos)'.format(
+                source.raw, source.stored, source.ratio(), source.compressed, source.blocks))
+            source.close()
+
+def send_packets(packets):
+    """Envia os pacotes, com janela deslizante ou stop-and-wait"""
+    if window_size > 1:
+        send_file_window(packets)
+        return
 
-    total_packets = (len(content) + 49) // 50  # Calcula o número total de pacotes
     packet_index = 0
+    first_try = True
 
-    while packet_index < total_packets:
-        start = packet_index * 50
-        end = min((packet_index + 1) * 50, len(content))
-        payload = content[start:end]
+    while packets.has(packet_index + 1):
+        if speed and speed.degraded():
+            step_down()
+        payload = packets.payload(packet_index + 1)
+        total_packets = packets.total_for(packet_index + 1)
 
         erro_payload = False
         
@@ -79,56 +471,198 @@ def send_file(file_path):
             datagram = create_datagram(packet_index + 1, total_packets, payload)
 
         com1.sendData(datagram)
+        sent_at = time.time()
+        count_send(not first_try)
         size = len(datagram)
-        crc_value = calculate_crc(payload)
+        crc_value = protocolo.HEAD.unpack_from(datagram)[3]
         log_event('envio', 3, size, packet_index + 1, total_packets, crc_value)
         print(f'Cliente: Pacote {packet_index + 1} enviado \n\n')
 
-        # Aguardar ACK ou NACK
-        response, _ = com1.getData(15)  # 15 bytes para o datagrama do ACK/NACK
+        # Aguardar ACK ou NACK até o RTO
+        deadline = sent_at + rto.rto
+        response = receive_response(max(0, deadline - time.time()))
+
+        # ACK atrasado de um pacote anterior (reenvio duplicado): espera o próximo
+        while response:
+            acked_number, _, _, _, message_type = protocolo.HEAD.unpack_from(response)[:5]
+            if message_type != 4 or acked_number == packet_index + 1:
+                break
+            log_event('receb', 4, len(response))
+            print(f'Cliente: ACK atrasado do pacote {acked_number} ignorado')
+            response = receive_response(max(0, deadline - time.time()))
 
         # Verifica se é ACK ou NACK
         if response:
-            head = response[:12]
-            message_type = head[8]  # O 9º byte é message_type
+            _, _, _, _, message_type, cause, _, _ = protocolo.HEAD.unpack_from(response)
             log_event('receb', message_type, len(response))
             if message_type == 4:  # ACK
                 print(f'Cliente: ACK recebido para pacote {packet_index + 1}')
+                count_ack(packets.acked(packet_index + 1, first_try), sent_at if first_try else None)
                 packet_index += 1  # Prossegue para o próximo pacote
+                first_try = True
             elif message_type == 5:  # NACK
                 print(f'Cliente: NACK recebido para pacote {packet_index + 1}. Reenviando...')
+                count_nack(cause)
+                if cause in (NACK_SIZE, NACK_CRC):
+                    packets.failed()
+                first_try = False
                 # Não incrementa o índice, reenvia o mesmo pacote
         else:
             print(f'Cliente: Erro no pacote {packet_index + 1}, tentando novamente...')
+            com1.metrics.count('client.timeouts')
+            rto.backoff()
+            packets.failed()
+            first_try = False
             continue
 
+def send_packet(packets, packet_number, retransmission=False):
+    """Monta e envia o pacote packet_number; retorna (total_packets, payload)"""
+    payload = packets.payload(packet_number)
+    total_packets = packets.total_for(packet_number)
+    datagram = create_datagram(packet_number, total_packets, payload)
+    com1.sendData(datagram)
+    count_send(retransmission)
+    log_event('envio', 3, len(datagram), packet_number, total_packets, protocolo.HEAD.unpack_from(datagram)[3])
+    return total_packets, payload
+
+def create_parity_datagram(first, count, payload):
+    """Cria o pacote de paridade do grupo que começa em first (ver fec.py)"""
+    return protocolo.encode(first, count, fec.MESSAGE_TYPE, payload, protect=True)
+
+def add_to_parity(parities, packet_number, total_packets, payload):
+    """Acumula o primeiro envio de um pacote na paridade do seu grupo e
+    envia a paridade quando o grupo fecha (k pacotes ou o último do arquivo)"""
+    first = fec.group_of(packet_number, fec_group)
+    parity = parities.setdefault(first, fec.Paridade())
+    parity.add(total_packets, payload)
+    if parity.count == fec_group or total_packets == packet_number:
+        del parities[first]
+        datagram = create_parity_datagram(first, parity.count, parity.payload())
+        com1.sendData(datagram)
+        com1.metrics.count('client.fec_parity')
+        log_event('envio', fec.MESSAGE_TYPE, len(datagram))
+
+def send_file_window(packets):
+    """Envia os pacotes com janela deslizante e repetição seletiva"""
+    base = 1            # Pacote mais antigo ainda sem ACK
+    next_packet = 1     # Próximo pacote ainda não enviado
+    sent_at = {}        # Pacote em voo -> instante do último envio
+    resent = set()      # Pacotes em voo já reenviados
+    acked = set()
+    parities = {}       # Grupo do FEC -> paridade dos pacotes já enviados
+
+    while packets.has(base):
+        if speed and speed.degraded() and step_down():
+            # O que estava em voo se perdeu ou teve o ACK descartado na
+            # troca: reenvia já, na velocidade nova
+            for packet_number in sorted(sent_at):
+                send_packet(packets, packet_number, retransmission=True)
+                sent_at[packet_number] = time.time()
+                resent.add(packet_number)
+            speed.reset()
+        # Preenche a janela
+        while next_packet < base + window_size and packets.has(next_packet):
+            total_packets, payload = send_packet(packets, next_packet)
+            sent_at[next_packet] = time.time()
+            if fec_group:
+                add_to_parity(parities, next_packet, total_packets, payload)
+            print(f'Cliente: Pacote {next_packet} enviado')
+            next_packet += 1
+
+        # Aguarda um ACK/NACK até o próximo timer vencer
+        deadline = min(sent_at.values()) + rto.rto
+        response = receive_response(max(0, deadline - time.time()))
+        while response:
+            if response.endswith(EOP):
+                packet_number, _, _, _, message_type, cause, _, _ = protocolo.HEAD.unpack_from(response)
+                log_event('receb', message_type, len(response))
+                if message_type == 4 and packet_number in sent_at:  # ACK
+                    print(f'Cliente: ACK recebido para pacote {packet_number}')
+                    first_try = packet_number not in resent
+                    sent = sent_at.pop(packet_number)
+                    count_ack(packets.acked(packet_number, first_try), sent if first_try else None)
+                    resent.discard(packet_number)
+                    acked.add(packet_number)
+                    while base in acked:
+                        acked.remove(base)
+                        base += 1
+                elif message_type == 5 and packet_number in sent_at:  # NACK
+                    print(f'Cliente: NACK recebido para pacote {packet_number}. Reenviando...')
+                    count_nack(cause)
+                    if cause in (NACK_SIZE, NACK_CRC):
+                        packets.failed()
+                    send_packet(packets, packet_number, retransmission=True)
+                    sent_at[packet_number] = time.time()
+                    resent.add(packet_number)
+            # Trata as respostas que já chegaram antes de olhar os timers
+            response = receive_response(0)
+
+        # Reenvia apenas os pacotes cujo timer expirou
+        now = time.time()
+        expired = [n for n, sent in sorted(sent_at.items()) if now - sent >= rto.rto]
+        for packet_number in expired:
+            print(f'Cliente: Timeout no pacote {packet_number}, reenviando...')
+            com1.metrics.count('client.timeouts')
+            packets.failed()
+            send_packet(packets, packet_number, retransmission=True)
+            sent_at[packet_number] = now
+            resent.add(packet_number)
+        if expired:
+            rto.backoff()  # Uma vez por rodada, não por pacote vencido
+
+def count_send(retransmission):
+    com1.metrics.count('client.sends')
+    if retransmission:
+        com1.metrics.count('client.retransmissions')
+    if speed:
+        speed.sent(retransmission)
+
+def count_ack(payload_size, sent_at=None):
+    """Conta um ACK e alimenta o RTO; sent_at só quando o pacote não foi
+    reenviado (regra de Karn)"""
+    com1.metrics.count('client.packets')
+    com1.metrics.count('client.payload_bytes', payload_size)
+    if sent_at is not None:
+        rtt = time.time() - sent_at
+        com1.metrics.observe('client.rtt_s', rtt)
+        rto.sample(rtt)
+
+def count_nack(cause):
+    com1.metrics.count('client.nack.' + NACK_NAMES.get(cause, 'other'))
+
 def log_event(event_type, message_type, size, packet_number=None, total_packets=None, crc=None):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    with open('client_log.txt', 'a') as log_file:
-        line = f"{timestamp} / {event_type} / {message_type} / {size}"
-        if packet_number is not None and total_packets is not None and crc is not None:
-            line += f" / {packet_number} / {total_packets} / {crc:04X}"
-        log_file.write(line + "\n")
+    """Registra o evento em segundo plano (ver registro.py)"""
+    log.event(event_type, message_type, size, packet_number, total_packets, crc)
 
 def main():
     try:
         com1.enable()
+        com1.metrics.gauge('client.rto_s', lambda: rto.rto)
+        com1.metrics.gauge('client.srtt_s', lambda: rto.srtt)
+        if METRICS_INTERVAL:
+            com1.metrics.startDump(METRICS_INTERVAL, METRICS_FILE)
         
-        handshake_successful = False
-
-        while not handshake_successful:
-            if handshake():
-                handshake_successful = True
-                file_path = 'arquivo.txt'  # Altere para o caminho correto do arquivo
-                send_file(file_path)
-            else:
-                print("Servidor inativo. Tentar novamente? S/N")
-                retry = input().lower()
-                if retry != 's':
-                    com1.disable()  # Desabilitar comunicação antes de sair
-                    return
-                else:
-                    print("Tentando novamente o handshake...")
+        file_path = SEND_PATH
+        if os.path.isdir(file_path):
+            # Um diretório vai inteiro numa sessão só
+            file_path = lote.Lote(file_path)
+            print(f'Cliente: Lote com {len(file_path.entries)} arquivos, {file_path.length} bytes')
+
+        # handshake já repete sozinho, com espera crescente
+        if not handshake(isinstance(file_path, lote.Lote)):
+            print("Cliente: Servidor inativo, desistindo")
+            com1.disable()  # Desabilitar comunicação antes de sair
+            return
+        offset = resume(file_path) if resume_ok else 0
+        if offset is None:
+            print("Cliente: Servidor não respondeu ao pedido de retomada")
+            com1.disable()
+            return
+        if speed:
+            # Depois da retomada, que tem poucas tentativas: os pacotes
+            # de dados são repetidos até passar, mesmo numa troca que falhe
+            tune_baud()
+        send_file(file_path, offset)
 
         com1.disable()
         print("Arquivo enviado com sucesso!")
@@ -136,6 +670,16 @@ def main():
     except Exception as e:
         print("Cliente: Ocorreu um erro:", e)
         com1.disable()
+    finally:
+        if speed and speed.tuned():
+            speed.set(speed.base)  # A próxima sessão começa na velocidade do handshake
+        com1.metrics.stopDump()
+        log.close()  # Grava os eventos que ainda estão na fila
 
 if __name__ == "__main__":
+    # Porta opcional na linha de comando, ex.: um pty criado por transporte.py
+    if len(sys.argv) > 1:
+        com1 = enlace(sys.argv[1])
+    if len(sys.argv) > 2:
+        SEND_PATH = sys.argv[2]
     main()
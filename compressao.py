@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Compressão do arquivo antes do enquadramento
+####################################################
+"""
+Compressão negociada no handshake (FLAG_COMPRESS + codec no byte 11).
+
+O arquivo é lido em blocos de BLOCK_SIZE bytes e cada bloco vira um
+registro:
+
+  modo (1 byte) + tamanho (3 bytes) + dados
+
+modo RAW guarda o bloco como está, quando comprimir não reduziria nada
+(dados já comprimidos ou aleatórios); modo COMPRESSED guarda a saída do
+codec. Com zlib, um único compressor atravessa o arquivo e cada bloco
+termina com Z_FULL_FLUSH: nenhum bloco depende de um anterior, então
+pular a saída de um bloco RAW não desalinha o descompressor. lzma não
+tem esse flush e comprime cada bloco separadamente.
+
+Os pacotes são recortados do fluxo de registros, não do arquivo; o
+servidor, que grava em ordem, passa cada payload por Descompressor e
+só grava blocos completos. Por isso uma transferência interrompida é
+retomada do fim do último bloco completo, e BLOCK_SIZE fica pequeno
+(uns poucos segundos de enlace a 115200 baud).
+"""
+
+import os
+import zlib
+
+try:
+    import lzma
+except ImportError:     # Python compilado sem liblzma
+    lzma = None
+
+BLOCK_SIZE  = 16 * 1024     # Bytes do arquivo por registro (o tamanho vai em 3 bytes)
+RECORD_HEAD = 4
+
+# Modos de registro
+RAW        = 0
+COMPRESSED = 1
+
+# Codecs do byte 11 do handshake
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {'zlib': CODEC_ZLIB}
+if lzma is not None:
+    CODECS['lzma'] = CODEC_LZMA
+
+LZMA_FILTERS = [{'id': lzma.FILTER_LZMA2, 'preset': 6}] if lzma is not None else None
+
+class Compressor(object):
+    """ Fluxo de registros de um arquivo, a partir de offset
+
+    Os blocos são comprimidos conforme Packets lê o fluxo, um de cada
+    vez, e só os registros a partir do que release() ainda não liberou
+    ficam na memória, para os reenvios. O tamanho do fluxo só é conhecido
+    quando o arquivo acaba; antes disso seek(0, SEEK_END) retorna uma
+    estimativa pela razão até aqui, sempre além do que já foi gerado.
+    """
+
+    def __init__(self, file, codec, offset=0, level=6):
+        self.codec      = codec
+        self.level      = level
+        self.file       = file
+        self.raw        = 0     # Bytes do arquivo lidos
+        self.stored     = 0     # Bytes de registros gerados
+        self.blocks     = 0
+        self.compressed = 0     # Blocos guardados comprimidos
+        self.done       = False  # O arquivo acabou: stored é o tamanho do fluxo
+        self.window     = bytearray()   # Registros gerados a partir de base
+        self.base       = 0
+        self.position   = 0
+        if codec == CODEC_ZLIB:
+            self.zlib = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.total      = file.seek(0, os.SEEK_END) - offset   # Bytes a comprimir, para a estimativa
+        file.seek(offset)
+        self.fill(0)
+
+    def fill(self, end):
+        """ Comprime blocos até o fluxo passar de end ou o arquivo acabar
+
+        Passar de end, e não só chegar, garante que um pacote que termina
+        no fim do fluxo já sai sabendo que é o último.
+        """
+        while not self.done and self.stored <= end:
+            block = self.file.read(BLOCK_SIZE)
+            if not block:
+                self.done = True
+                break
+            self.add(block)
+
+    def add(self, block):
+        packed = self.pack(block)
+        if len(packed) < len(block):
+            mode, data = COMPRESSED, packed
+            self.compressed += 1
+        else:
+            mode, data = RAW, block
+        self.window += bytes([mode]) + len(data).to_bytes(3, 'big') + data
+        self.raw += len(block)
+        self.stored += RECORD_HEAD + len(data)
+        self.blocks += 1
+
+    def pack(self, block):
+        if self.codec == CODEC_ZLIB:
+            return(self.zlib.compress(block) + self.zlib.flush(zlib.Z_FULL_FLUSH))
+        return(lzma.compress(block, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS))
+
+    def length(self):
+        """ Tamanho do fluxo: exato quando o arquivo acabou, senão estimado
+        """
+        if self.done:
+            return(self.stored)
+        estimate = self.stored + int((self.total - self.raw) * self.ratio())
+        return(max(estimate, self.stored + 1))
+
+    def release(self, offset):
+        """ Os bytes antes de offset não serão mais lidos (já confirmados)
+        """
+        if offset > self.base:
+            del self.window[:offset - self.base]
+            self.base = offset
+
+    # Interface de arquivo usada por Packets
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length()
+        self.position = max(0, offset)
+        return(self.position)
+
+    def read(self, size=-1):
+        if size < 0:
+            self.fill(float('inf'))
+            size = self.stored - self.position
+        self.fill(self.position + size)
+        if self.position < self.base:
+            raise ValueError("posição {} já liberada".format(self.position))
+        data = bytes(self.window[self.position - self.base:self.position - self.base + size])
+        self.position += len(data)
+        return(data)
+
+    def close(self):
+        self.window = bytearray()
+
+    def ratio(self):
+        """ Bytes enviados por byte do arquivo (menor é melhor)
+        """
+        return(self.stored / self.raw if self.raw else 1.0)
+
+    def stats(self):
+        return({'raw': self.raw, 'stored': self.stored, 'ratio': self.ratio(),
+                'blocks': self.blocks, 'compressed_blocks': self.compressed})
+
+class Descompressor(object):
+    """ Reconstrói o arquivo a partir dos payloads, na ordem
+    """
+
+    def __init__(self, codec):
+        self.codec   = codec
+        self.pending = bytearray()
+        if codec == CODEC_ZLIB:
+            self.zlib = zlib.decompressobj(-15)
+
+    def feed(self, payload):
+        """ Retorna os bytes do arquivo dos registros que payload completou
+        """
+        self.pending += payload
+        out = bytearray()
+        while len(self.pending) >= RECORD_HEAD:
+            size = int.from_bytes(self.pending[1:RECORD_HEAD], 'big')
+            if len(self.pending) < RECORD_HEAD + size:
+                break
+            mode = self.pending[0]
+            data = bytes(self.pending[RECORD_HEAD:RECORD_HEAD + size])
+            del self.pending[:RECORD_HEAD + size]
+            out += data if mode == RAW else self.unpack(data)
+        return(bytes(out))
+
+    def unpack(self, data):
+        if self.codec == CODEC_ZLIB:
+            return(self.zlib.decompress(data))
+        return(lzma.decompress(data, format=lzma.FORMAT_RAW, filters=LZMA_FILTERS))
+
+    def complete(self):
+        """ Se nenhum registro ficou pela metade
+        """
+        return(not self.pending)
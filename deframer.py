@@ -0,0 +1,264 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Camada de Enlace - separação de datagramas
+####################################################
+
+# Importa pacote de tempo
+import time
+
+# Byte-stuffing do modo binário
+from interfaceFisica import unstuff
+
+EOP      = b'\xAA\xBB\xCC'  # 3 bytes
+HEAD_LEN = 12
+
+def remaining(deadline):
+    if deadline is None:
+        return(None)
+    return(max(0, deadline - time.time()))
+
+# Class
+class Deframer(object):
+    """ Separa datagramas (HEAD + PAYLOAD + EOP) do fluxo do RX
+
+    O tamanho do payload vem do HEAD, então cada datagrama é entregue
+    assim que o último byte chega, sem esperar um tamanho fixo. Se o
+    EOP não estiver onde o HEAD indica (HEAD ou payload corrompido),
+    avança até o próximo EOP e entrega esse trecho como está: quem
+    recebe vê o tamanho errado e pode pedir o reenvio. Lixo sem EOP
+    é descartado byte a byte até achar um HEAD coerente.
+
+    No modo binário (rx.fisica.stuffed()) o buffer guarda o fluxo com
+    byte-stuffing, onde o EOP só aparece cru no fim de um datagrama: os
+    datagramas são separados pelo EOP e só então perdem o stuffing, ver
+    parseStuffed.
+
+    Só a espera pelo resto de um datagrama já começado tem limite
+    (stallTimeout sem bytes novos); esperar o próximo não tem.
+    """
+
+    def __init__(self, rx, maxPayload=1009, stallTimeout=0.5):
+        self.rx           = rx
+        self.stallTimeout = stallTimeout
+        self.maxPayload   = maxPayload
+        self.maxFrame     = HEAD_LEN + maxPayload + len(EOP)
+        self.maxStuffed   = 2*(HEAD_LEN + maxPayload) + len(EOP)  # Todo byte escapado
+        self.resyncs      = 0   # Quantas vezes foi preciso procurar o EOP
+        self.discarded    = 0   # Bytes descartados procurando um HEAD válido
+        self.badEscapes   = 0   # Datagramas descartados por um escape inválido
+        self.searchFrom   = None  # Em resync: de onde procurar o EOP
+
+    def getFrame(self, timeout=None):
+        """ Retorna o próximo datagrama completo
+
+        Bloqueia até ele chegar; com timeout, retorna None se o prazo
+        vencer ou o RX for parado.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            frame, need = self.parse()
+            if frame is not None:
+                return(frame)
+            if not self.inFrame(need):
+                if not self.rx.waitNData(need, remaining(deadline)):
+                    return(None)
+                continue
+            status = self.waitFor(need, deadline)
+            if status == 'timeout':
+                return(None)
+            if status == 'stall':
+                self.stall()
+
+    def parse(self):
+        """ Separa um datagrama do que já está no buffer, sem esperar
+
+        Retorna (datagrama, 0) ou (None, n) se for preciso ter n bytes
+        no buffer para continuar. Quem espera é getFrame (ou outro laço,
+        como o de enlaceAsync), que chama stall() se a espera por um
+        datagrama já começado passar de stallTimeout.
+
+        Se o EOP não estiver onde o HEAD indica, entra em resync: entrega
+        tudo até o próximo EOP. Sem EOP dentro de um datagrama de tamanho
+        máximo, descarta o primeiro byte e lê o HEAD uma posição adiante.
+        """
+        if self.rx.fisica.stuffed():
+            return(self.parseStuffed())
+        while True:
+            have = self.rx.getBufferLen()
+            if self.searchFrom is None:
+                if have < HEAD_LEN:
+                    return(None, HEAD_LEN)
+                payloadSize = int.from_bytes(self.peek(HEAD_LEN)[4:6], 'big')
+                if payloadSize <= self.maxPayload:
+                    frameLen = HEAD_LEN + payloadSize + len(EOP)
+                    if have < frameLen:
+                        return(None, frameLen)
+                    frame = self.peek(frameLen)
+                    if frame.endswith(EOP):
+                        self.rx.consumeBuffer(frameLen)
+                        return(frame, 0)
+                self.resyncs += 1
+                self.searchFrom = HEAD_LEN
+
+            data = self.peek(min(have, self.maxFrame))
+            pos = data.find(EOP, self.searchFrom)
+            if pos >= 0:
+                self.searchFrom = None
+                return(self.rx.getBuffer(pos + len(EOP)), 0)
+            if len(data) >= self.maxFrame:
+                self.rx.consumeBuffer(1)
+                self.discarded += 1
+                self.searchFrom = None
+                continue
+            # O EOP pode estar dividido entre o que chegou e o que falta
+            self.searchFrom = max(HEAD_LEN, len(data) - len(EOP) + 1)
+            return(None, len(data) + 1)
+
+    def parseStuffed(self):
+        """ parse() no modo binário
+
+        Cada datagrama vai até o próximo EOP do fluxo com stuffing, que
+        não aparece dentro de payloads. Sem o stuffing, o tamanho tem que
+        bater com o do HEAD; se não bater (HEAD ou payload corrompido,
+        bytes perdidos), conta um resync e entrega o trecho como está,
+        como parse: quem recebe vê o tamanho errado e pode pedir o
+        reenvio. Um escape inválido descarta só o datagrama em que está,
+        e um trecho curto demais para ter um HEAD também. Sem EOP em
+        maxStuffed bytes, o que chegou é lixo e é descartado.
+        """
+        while True:
+            have = self.rx.getBufferLen()
+            if have == 0:
+                self.searchFrom = None
+                return(None, 1)
+            data = self.peek(min(have, self.maxStuffed))
+            pos = data.find(EOP, self.searchFrom or 0)
+            if pos >= 0:
+                self.searchFrom = None
+                stuffedFrame = self.rx.getBuffer(pos + len(EOP))
+                try:
+                    frame = unstuff(stuffedFrame[:pos]) + EOP
+                except ValueError:
+                    self.badEscapes += 1
+                    self.discarded += len(stuffedFrame)
+                    continue
+                if len(frame) < HEAD_LEN + len(EOP):
+                    self.discarded += len(stuffedFrame)
+                    continue
+                if len(frame) != HEAD_LEN + int.from_bytes(frame[4:6], 'big') + len(EOP):
+                    self.resyncs += 1
+                return(frame, 0)
+            if len(data) >= self.maxStuffed:
+                # Guarda o fim, que pode ser o começo de um EOP
+                self.discarded += self.rx.consumeBuffer(len(data) - len(EOP) + 1)
+                self.searchFrom = None
+                continue
+            # O EOP pode estar dividido entre o que chegou e o que falta
+            self.searchFrom = max(0, len(data) - len(EOP) + 1)
+            return(None, len(data) + 1)
+
+    def inFrame(self, need):
+        """ Se a espera por need bytes é no meio de um datagrama
+        """
+        return(self.searchFrom is not None or need > HEAD_LEN)
+
+    def stall(self):
+        """ O fluxo parou no meio de um datagrama
+
+        Se o HEAD indicava um tamanho, procura um EOP no que chegou; se
+        já estava procurando, o que chegou é descartado.
+
+        No modo binário não há EOP completo no buffer (parseStuffed já o
+        teria separado), mas um primeiro byte do EOP cru só pode ser de
+        um EOP estragado: descarta até o fim dele e guarda o que vem
+        depois, o começo do próximo datagrama. Sem ele, descarta tudo.
+        """
+        if self.rx.fisica.stuffed():
+            data = self.peek(min(self.rx.getBufferLen(), self.maxStuffed))
+            pos = data.find(EOP[:1])
+            drop = len(data) if pos < 0 else min(pos + len(EOP), len(data))
+            self.resyncs += 1
+            self.discarded += self.rx.consumeBuffer(drop)
+            self.searchFrom = None
+            return
+        if self.searchFrom is None:
+            self.resyncs += 1
+            self.searchFrom = HEAD_LEN
+        else:
+            self.discarded += self.rx.consumeBuffer(self.rx.getBufferLen())
+            self.searchFrom = None
+
+    def waitFor(self, nData, deadline):
+        """ Espera nData bytes no meio de um datagrama
+
+        Retorna 'ok', 'timeout' (prazo de getFrame ou RX parado) ou
+        'stall' se nenhum byte novo chegar em stallTimeout: o resto do
+        datagrama se perdeu e não adianta esperar pelo próximo envio.
+        """
+        while True:
+            have = self.rx.getBufferLen()
+            if have >= nData:
+                return('ok')
+            wait = self.stallTimeout
+            if deadline is not None:
+                wait = min(wait, remaining(deadline))
+            if not self.rx.waitNData(have + 1, wait):
+                if self.rx.threadStop or (deadline is not None and time.time() >= deadline):
+                    return('timeout')
+                return('stall')
+
+    def peek(self, nData):
+        return(self.rx.peekBuffer(nData))
+
+    def getSynced(self, sync, size, timeout=None):
+        """ Descarta o que chegar até a sequência sync e retorna os size
+            bytes seguintes, ou None no timeout
+
+        Para o estabelecimento do enlace: lixo na linha antes do
+        handshake (ruído do reset, restos de uma sessão anterior) é
+        descartado assim que chega. Se o que segue um sync parar no
+        meio (stallTimeout), esse sync é descartado e a busca continua.
+        """
+        return(self.getSyncedAny([(sync, size)], timeout)[1])
+
+    def getSyncedAny(self, options, timeout=None):
+        """ getSynced com várias sequências: options é uma lista de
+            (sync, size), e vale a que aparecer primeiro no fluxo
+
+        Retorna (sync achado, os size bytes seguintes) ou (None, None)
+        no timeout. Com size 0 a própria sequência é a mensagem (ex.: o
+        handshake fixo dos pares sem preâmbulo).
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        longest = max(len(sync) for sync, _ in options)
+        while True:
+            have = self.rx.getBufferLen()
+            data = self.peek(have)
+            found = [(data.find(sync), sync, size) for sync, size in options]
+            found = [f for f in found if f[0] >= 0]
+            if not found:
+                # Um sync pode estar dividido entre o que chegou e o que falta
+                drop = max(0, have - longest + 1)
+                self.discarded += self.rx.consumeBuffer(drop)
+                if not self.rx.waitNData(have - drop + 1, remaining(deadline)):
+                    return(None, None)
+                continue
+            pos, sync, size = min(found, key=lambda f: f[0])
+            self.discarded += self.rx.consumeBuffer(pos)
+            status = self.waitFor(len(sync) + size, deadline)
+            if status == 'timeout':
+                return(None, None)
+            self.rx.consumeBuffer(len(sync))
+            if status == 'ok':
+                return(sync, self.rx.getBuffer(size))
+
+    def frames(self):
+        """ Gera os datagramas conforme chegam, até o RX ser parado
+        """
+        while True:
+            frame = self.getFrame()
+            if frame is None:
+                return
+            yield frame
@@ -17,12 +17,21 @@ from interfaceFisica import fisica
 from enlaceRx import RX
 from enlaceTx import TX
 
+# Contadores do enlace
+from metricas import Metricas
+
 class enlace(object):
     
-    def __init__(self, name):
-        self.fisica      = fisica(name)
-        self.rx          = RX(self.fisica)
-        self.tx          = TX(self.fisica)
+    def __init__(self, name, transporte=None):
+        """ transporte: implementação de Transporte a usar no lugar
+            de fisica(name), ver transporte.py
+        """
+        self.fisica      = transporte if transporte is not None else fisica(name)
+        if self.fisica.metrics is None:
+            self.fisica.metrics = Metricas()
+        self.metrics     = self.fisica.metrics  # Também usado pelo protocolo, ver metricas.py
+        self.rx          = RX(self.fisica, metrics=self.metrics)
+        self.tx          = TX(self.fisica, metrics=self.metrics)
         self.connected   = False
 
     def enable(self):
@@ -31,14 +40,30 @@ class enlace(object):
         self.tx.threadStart()
 
     def disable(self):
-        self.rx.threadKill()
+        # TX termina de enviar o que estiver pendente antes de parar
         self.tx.threadKill()
-        time.sleep(1)
+        self.tx.thread.join(1)
+        # A thread de RX pode estar bloqueada na porta até o timeout da fisica
+        self.rx.threadKill()
+        self.rx.thread.join(1)
         self.fisica.close()
 
-    def sendData(self, data):
-        self.tx.sendBuffer(data)
+    def setEncoding(self, encoding):
+        # Espera o TX esvaziar para o último buffer sair na codificação antiga
+        self.tx.waitDone()
+        self.fisica.setEncoding(encoding)
+
+    def setBaudrate(self, baudrate):
+        # Como setEncoding: o que está na fila sai na velocidade antiga
+        self.tx.waitDone()
+        self.fisica.setBaudrate(baudrate)
+
+    def sendData(self, data, priority=False):
+        """ Enfileira data no TX; priority passa à frente dos dados
+            (ACK/NACK). Espera se a fila estiver cheia.
+        """
+        return(self.tx.sendBuffer(data, priority))
         
-    def getData(self, size):
-        data = self.rx.getNData(size)
+    def getData(self, size, timeout=5):
+        data = self.rx.getNData(size, timeout)
         return(data, len(data))
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Camada de Enlace - variante asyncio
+####################################################
+"""
+enlaceAsync faz o papel de enlace (fisica + RX + TX) dentro de um event
+loop, sem threads próprias: a leitura é disparada pelo loop quando o
+descritor da porta serial fica legível e a escrita espera o descritor
+aceitar mais bytes. Um processo pode assim cuidar de muitas portas e
+cancelar esperas com os recursos normais do asyncio.
+
+Transportes sem descritor (loopbackPair, CanalRuidoso) continuam
+funcionando: a leitura e a escrita vão para o executor padrão do loop.
+
+Exemplo:
+  async with enlaceAsync("/dev/ttyACM0") as link:
+      await link.send(datagrama)
+      resposta = await link.recv_frame(timeout=5)
+
+Uso:
+  python enlaceAsync.py [n]   # n pares de pty trocando datagramas num loop só
+"""
+
+import asyncio
+import os
+import sys
+import time
+
+# Interface Física
+from interfaceFisica import fisica
+
+# Buffer circular de recepção
+from ringBuffer import RingBuffer
+
+# Separação de datagramas
+from deframer import Deframer, remaining
+
+# Contadores do enlace
+from metricas import Metricas
+
+class enlaceAsync(object):
+
+    def __init__(self, name, transporte=None, capacity=64*1024, maxPayload=1009):
+        """ transporte: implementação de Transporte a usar no lugar
+            de fisica(name), ver transporte.py
+        """
+        self.fisica     = transporte if transporte is not None else fisica(name)
+        self.READLEN    = 1024
+        self.buffer     = RingBuffer(capacity, capacity - self.READLEN)
+        self.deframer   = Deframer(self, maxPayload)
+        self.loop       = None
+        self.fd         = None
+        self.reader     = None   # Tarefa de leitura sem descritor
+        self.paused     = False  # Leitura parada pelo high-water mark
+        self.threadStop = False  # Mesmo nome do RX, consultado pelo Deframer
+        self.dataEvent  = asyncio.Event()
+        self.sendLock   = asyncio.Lock()
+        if self.fisica.metrics is None:
+            self.fisica.metrics = Metricas()
+        self.metrics    = self.fisica.metrics
+        self.metrics.gauge('rx.buffer_len', lambda: len(self.buffer))
+        self.metrics.gauge('rx.buffer_peak', lambda: self.buffer.peak)
+        self.metrics.gauge('rx.buffer_dropped', lambda: self.buffer.dropped)
+
+    async def __aenter__(self):
+        await self.open()
+        return(self)
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def open(self):
+        self.loop = asyncio.get_running_loop()
+        self.fisica.open()
+        self.threadStop = False
+        self.fd = self.fileno()
+        if self.fd is not None:
+            self.loop.add_reader(self.fd, self.onReadable)
+        else:
+            self.reader = self.loop.create_task(self.readLoop())
+
+    async def close(self):
+        # Envios em andamento terminam antes de fechar a porta
+        async with self.sendLock:
+            self.threadStop = True
+            self.dataEvent.set()
+            if self.fd is not None:
+                self.loop.remove_reader(self.fd)
+            if self.reader is not None:
+                self.reader.cancel()
+                try:
+                    await self.reader
+                except asyncio.CancelledError:
+                    pass
+            self.fisica.close()
+
+    def fileno(self):
+        """ Descritor da porta, se o transporte tiver um (pyserial em POSIX)
+        """
+        port = getattr(self.fisica, 'port', None)
+        try:
+            return(port.fileno())
+        except (AttributeError, OSError, ValueError):
+            return(None)
+
+    ##############################
+    # Recepção                   #
+    ##############################
+    def onReadable(self):
+        try:
+            rxTemp, nRx = self.fisica.read(min(self.READLEN, max(1, self.fisica.inWaiting())))
+        except OSError:
+            # Porta fechada do outro lado: para de ler
+            self.loop.remove_reader(self.fd)
+            self.threadStop = True
+            self.dataEvent.set()
+            return
+        self.received(rxTemp)
+
+    async def readLoop(self):
+        while not self.threadStop:
+            if self.buffer.isAboveHighWater():
+                self.dataEvent.clear()
+                await self.dataEvent.wait()
+                continue
+            nRead = min(self.READLEN, max(1, self.fisica.inWaiting()))
+            rxTemp, nRx = await self.loop.run_in_executor(None, self.fisica.read, nRead)
+            self.received(rxTemp)
+
+    def received(self, data):
+        if data:
+            self.buffer.write(data)
+            self.dataEvent.set()
+        if self.fd is not None and self.buffer.isAboveHighWater() and not self.paused:
+            # Como o RX: para de ler a porta até a aplicação consumir
+            self.loop.remove_reader(self.fd)
+            self.paused = True
+
+    def consumed(self):
+        if self.paused and not self.buffer.isAboveHighWater() and not self.threadStop:
+            self.loop.add_reader(self.fd, self.onReadable)
+            self.paused = False
+        self.dataEvent.set()
+
+    # Mesma interface do RX usada pelo Deframer
+    def getBufferLen(self):
+        return(len(self.buffer))
+
+    def peekBuffer(self, nData):
+        return(self.buffer.peek(nData))
+
+    def getBuffer(self, nData):
+        b = self.buffer.read(nData)
+        self.consumed()
+        return(b)
+
+    def consumeBuffer(self, nData):
+        n = self.buffer.consume(nData)
+        self.consumed()
+        return(n)
+
+    def clearBuffer(self):
+        self.buffer.clear()
+        self.consumed()
+
+    async def waitNData(self, size, timeout=5):
+        """ Espera haver size bytes no buffer; False no timeout ou se fechado
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while len(self.buffer) < size and not self.threadStop:
+            self.dataEvent.clear()
+            try:
+                await asyncio.wait_for(self.dataEvent.wait(), remaining(deadline))
+            except asyncio.TimeoutError:
+                break
+        return(len(self.buffer) >= size)
+
+    async def recv(self, size, timeout=5):
+        """ Como enlace.getData: até size bytes, menos se o timeout vencer
+        """
+        await self.waitNData(size, timeout)
+        return(self.getBuffer(size))
+
+    async def recv_frame(self, timeout=None):
+        """ Próximo datagrama completo, ou None no timeout ou se fechado
+
+        Mesmo laço de Deframer.getFrame, esperando no event loop.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        deframer = self.deframer
+        while True:
+            frame, need = deframer.parse()
+            if frame is not None:
+                return(frame)
+            if not deframer.inFrame(need):
+                if not await self.waitNData(need, remaining(deadline)):
+                    return(None)
+                continue
+            have = len(self.buffer)
+            wait = deframer.stallTimeout if deadline is None else min(deframer.stallTimeout, remaining(deadline))
+            if not await self.waitNData(have + 1, wait):
+                if self.threadStop or (deadline is not None and time.time() >= deadline):
+                    return(None)
+                deframer.stall()
+
+    ##############################
+    # Transmissão                #
+    ##############################
+    async def send(self, data):
+        """ Envia um buffer inteiro; envios concorrentes saem um após o outro
+        """
+        async with self.sendLock:
+            if self.fd is None:
+                await self.loop.run_in_executor(None, self.fisica.write, data)
+                return
+            pending = memoryview(self.fisica.encode(data))
+            # Escrita direta no descritor: conta como fisica.write contaria
+            self.metrics.count('fisica.tx_bytes', len(data))
+            self.metrics.count('fisica.tx_wire_bytes', len(pending))
+            while pending:
+                try:
+                    n = os.write(self.fd, pending)
+                except BlockingIOError:
+                    n = 0
+                pending = pending[n:]
+                if pending:
+                    await self.writable()
+
+    def writable(self):
+        future = self.loop.create_future()
+        def ready():
+            self.loop.remove_writer(self.fd)
+            if not future.done():
+                future.set_result(None)
+        self.loop.add_writer(self.fd, ready)
+        return(future)
+
+    async def setEncoding(self, encoding):
+        # O último envio sai na codificação antiga
+        async with self.sendLock:
+            self.fisica.setEncoding(encoding)
+
+async def demo(nPairs=4, nFrames=50):
+    """ n pares de pty, todos atendidos por um único event loop
+    """
+    from transporte import PtyLink
+    links = [PtyLink() for _ in range(nPairs)]
+
+    async def pair(link, i):
+        async with enlaceAsync(link.nameA) as a, enlaceAsync(link.nameB) as b:
+            t0 = time.perf_counter()
+            for n in range(nFrames):
+                payload = bytes([i, n]) * 20
+                head = (n.to_bytes(2, 'big') + b'\x00'*2 + len(payload).to_bytes(2, 'big') +
+                        b'\x00'*2 + b'\x03' + b'\x00'*3)
+                await a.send(head + payload + b'\xAA\xBB\xCC')
+                frame = await b.recv_frame(timeout=5)
+                assert frame is not None and frame[12:-3] == payload
+            return(time.perf_counter() - t0)
+
+    elapsed = await asyncio.gather(*(pair(link, i) for i, link in enumerate(links)))
+    for link in links:
+        link.close()
+    for i, t in enumerate(elapsed):
+        print("par {}: {} datagramas em {:.3f} s".format(i, nFrames, t))
+
+if __name__ == "__main__":
+    asyncio.run(demo(int(sys.argv[1]) if len(sys.argv) > 1 else 4))
@@ -13,36 +13,71 @@ import time
 # Threads
 import threading
 
+# Buffer circular de recepção
+from ringBuffer import RingBuffer
+
+# Contadores do enlace
+from metricas import Metricas
+
 # Class
 class RX(object):
   
-    def __init__(self, fisica):
+    def __init__(self, fisica, capacity=64*1024, highWater=None, overflow='drop', metrics=None):
+        """ capacity  : tamanho fixo do buffer circular (bytes)
+            highWater : ocupação a partir da qual a thread para de ler
+                        a porta até a aplicação consumir dados
+            overflow  : política do RingBuffer quando a escrita não cabe
+            metrics   : Metricas do enlace (ocupação do buffer)
+        """
         self.fisica      = fisica
-        self.buffer      = bytes(bytearray())
+        self.READLEN     = 1024
+        if highWater is None:
+            highWater = capacity - self.READLEN
+        self.buffer      = RingBuffer(capacity, highWater, overflow)
+        self.lock        = threading.Lock()
+        self.condition   = threading.Condition(self.lock)
         self.threadStop  = False
         self.threadMutex = True
-        self.READLEN     = 1024
+        self.metrics     = metrics if metrics is not None else Metricas()
+        self.metrics.gauge('rx.buffer_len', lambda: len(self.buffer))
+        self.metrics.gauge('rx.buffer_peak', lambda: self.buffer.peak)
+        self.metrics.gauge('rx.buffer_dropped', lambda: self.buffer.dropped)
 
     def thread(self): 
         while not self.threadStop:
-            if(self.threadMutex == True):
-                rxTemp, nRx = self.fisica.read(self.READLEN)
-                if (nRx > 0):
-                    self.buffer += rxTemp  
-                time.sleep(0.01)
+            with self.condition:
+                if self.buffer.isAboveHighWater():
+                    self.metrics.count('rx.highwater_waits')
+                # Dorme enquanto pausado ou acima do high-water mark
+                self.condition.wait_for(lambda: self.threadStop or
+                                        (self.threadMutex and not self.buffer.isAboveHighWater()))
+            if self.threadStop:
+                break
+            # Bloqueia na porta até chegar ao menos 1 byte (ou o timeout da
+            # fisica) e depois leva tudo que já estiver disponível
+            nRead = min(self.READLEN, max(1, self.fisica.inWaiting()))
+            rxTemp, nRx = self.fisica.read(nRead)
+            if (nRx > 0):
+                with self.condition:
+                    self.buffer.write(rxTemp)
+                    self.condition.notify_all()
 
     def threadStart(self):       
         self.thread = threading.Thread(target=self.thread, args=())
         self.thread.start()
 
     def threadKill(self):
-        self.threadStop = True
+        with self.condition:
+            self.threadStop = True
+            self.condition.notify_all()
 
     def threadPause(self):
         self.threadMutex = False
 
     def threadResume(self):
-        self.threadMutex = True
+        with self.condition:
+            self.threadMutex = True
+            self.condition.notify_all()
 
     def getIsEmpty(self):
         if(self.getBufferLen() == 0):
@@ -54,28 +89,51 @@ class RX(object):
         return(len(self.buffer))
 
     def getAllBuffer(self, len):
-        self.threadPause()
-        b = self.buffer[:]
-        self.clearBuffer()
-        self.threadResume()
+        with self.condition:
+            b = self.buffer.read(self.buffer.size)
+            self.condition.notify_all()
         return(b)
 
     def getBuffer(self, nData):
-        self.threadPause()
-        b           = self.buffer[0:nData]
-        self.buffer = self.buffer[nData:]
-        self.threadResume()
+        with self.condition:
+            b = self.buffer.read(nData)
+            self.condition.notify_all()
         return(b)
 
-    def getNData(self, size):
-        start = time.time()
-        while(self.getBufferLen() < size and time.time() - start < 5):
-            print("Tempo restante:", 5 - (time.time() - start))
-            time.sleep(1)                 
+    def peekBuffer(self, nData):
+        """ Cópia dos primeiros nData bytes, sem consumi-los
+
+        A cópia é feita com o lock: views do RingBuffer deixariam de
+        valer assim que a thread escrevesse de novo (overflow='overwrite'
+        sobrescreve os bytes mais antigos).
+        """
+        with self.lock:
+            return(self.buffer.peek(nData))
+
+    def consumeBuffer(self, nData):
+        with self.condition:
+            n = self.buffer.consume(nData)
+            self.condition.notify_all()
+        return(n)
+
+    def waitNData(self, size, timeout=5):
+        """ Bloqueia até haver size bytes no buffer ou o timeout vencer
+
+        Retorna True se os dados chegaram, sem consumi-los. Retorna
+        False também se a thread for parada.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.buffer) >= size or self.threadStop, timeout)
+            return(len(self.buffer) >= size)
+
+    def getNData(self, size, timeout=5):
+        self.waitNData(size, timeout)
         return(self.getBuffer(size))
 
 
     def clearBuffer(self):
-        self.buffer = b""
+        with self.condition:
+            self.buffer.clear()
+            self.condition.notify_all()
 
 
@@ -13,48 +13,146 @@ import time
 # Threads
 import threading
 
+# Fila de transmissão
+from collections import deque
+
+# Contadores do enlace
+from metricas import Metricas
+
+MAX_QUEUE = 16      # Buffers por fila antes de sendBuffer esperar
+COALESCE  = 1024    # Bytes por escrita ao juntar buffers pequenos
+
 # Class
 class TX(object):
- 
-    def __init__(self, fisica):
+    """ Fila de transmissão
+
+    sendBuffer só enfileira: a thread tira da fila e escreve. Há duas
+    filas, a de prioridade (ACK/NACK) sai sempre antes da normal, e
+    cada uma aceita até maxQueue buffers; com a fila cheia sendBuffer
+    espera espaço (ou retorna False com block=False ou no timeout).
+
+    Buffers pequenos enfileirados juntos saem numa só escrita, até
+    COALESCE bytes, e a fisica só faz flush quando a fila esvazia.
+    """
+
+    def __init__(self, fisica, metrics=None, maxQueue=None):
         self.fisica      = fisica
-        self.buffer      = bytes(bytearray())
+        self.metrics     = metrics if metrics is not None else Metricas()
+        self.maxQueue    = maxQueue if maxQueue is not None else MAX_QUEUE
+        self.queue       = deque()   # Buffers normais
+        self.priority    = deque()   # ACK/NACK, passam à frente
+        self.buffer      = bytes(bytearray())   # Último lote escrito
         self.transLen    = 0
         self.empty       = True
-        self.threadMutex = False
+        self.threadMutex = False     # Há buffer na fila ou sendo escrito
         self.threadStop  = False
+        self.paused      = False
+        self.condition   = threading.Condition()
+        self.metrics.gauge('tx.queue_len', lambda: len(self.queue) + len(self.priority))
 
 
     def thread(self):
-        while not self.threadStop:
-            if(self.threadMutex):
-                self.transLen    = self.fisica.write(self.buffer)
-                self.threadMutex = False
+        while True:
+            with self.condition:
+                # Dorme até haver buffer para enviar
+                self.condition.wait_for(lambda: ((self.queue or self.priority) and not self.paused)
+                                                or self.threadStop)
+                if not (self.queue or self.priority):
+                    # Parada pedida e nada pendente; o que estiver na
+                    # fila ainda é enviado para não perder o último ACK
+                    break
+                frames = self.take()
+                # flush só quando não há mais nada para juntar
+                flush = not (self.queue or self.priority)
+                self.condition.notify_all()     # Espaço livre na fila
+            t0 = time.perf_counter()
+            transLen = self.fisica.writeFrames(frames, flush)
+            busy = time.perf_counter() - t0
+            self.metrics.count('tx.busy_s', busy)
+            self.metrics.observe('tx.write_s', busy)
+            self.metrics.observe('tx.batch_frames', len(frames))
+            with self.condition:
+                self.buffer      = frames[-1]
+                self.transLen    = transLen
+                self.threadMutex = bool(self.queue or self.priority)
+                self.condition.notify_all()
+
+    def take(self):
+        """ Próximo lote: toda a prioridade e depois buffers normais
+            enquanto couberem em COALESCE bytes (ao menos um)
+        """
+        frames = list(self.priority)
+        self.priority.clear()
+        total = sum(len(f) for f in frames)
+        while self.queue and (not frames or total + len(self.queue[0]) <= COALESCE):
+            frame = self.queue.popleft()
+            frames.append(frame)
+            total += len(frame)
+        return(frames)
 
     def threadStart(self):
         self.thread = threading.Thread(target=self.thread, args=())
         self.thread.start()
 
     def threadKill(self):
-        self.threadStop = True
+        with self.condition:
+            self.threadStop = True
+            self.condition.notify_all()
 
     def threadPause(self):
-        self.threadMutex = False
+        """ Segura a fila; sendBuffer continua enfileirando
+        """
+        with self.condition:
+            self.paused = True
 
     def threadResume(self):
-        self.threadMutex = True
+        with self.condition:
+            self.paused = False
+            self.condition.notify_all()
+
+    def sendBuffer(self, data, priority=False, block=True, timeout=None):
+        """ Enfileira data; retorna False se a fila continuou cheia
 
-    def sendBuffer(self, data):
-        self.transLen = 0
-        self.buffer = data
-        self.threadMutex  = True
+        A fila guarda uma cópia de tudo que não for bytes (bytearray,
+        memoryview), que quem chamou pode reusar logo depois; bytes e
+        subclasses (interfaceFisica.EmHex) vão como estão.
+        """
+        if not isinstance(data, bytes):
+            data = bytes(data)
+        lane = self.priority if priority else self.queue
+        with self.condition:
+            if len(lane) >= self.maxQueue:
+                if not block:
+                    self.metrics.count('tx.queue_full')
+                    return(False)
+                # Backpressure: quem produz espera a thread escrever
+                self.metrics.count('tx.backpressure_waits')
+                t0 = time.perf_counter()
+                room = self.condition.wait_for(lambda: len(lane) < self.maxQueue or self.threadStop, timeout)
+                self.metrics.count('tx.backpressure_s', time.perf_counter() - t0)
+                if not room or self.threadStop:
+                    self.metrics.count('tx.queue_full')
+                    return(False)
+            self.transLen = 0
+            lane.append(data)
+            self.threadMutex = True
+            self.condition.notify_all()
+            return(True)
+
+    def waitDone(self, timeout=None):
+        """ Bloqueia até a fila esvaziar e o último lote ser escrito na porta
+        """
+        with self.condition:
+            return(self.condition.wait_for(lambda: not self.threadMutex or self.threadStop, timeout))
 
     def getBufferLen(self):
-        return(len(self.buffer))
+        """ Bytes esperando na fila
+        """
+        with self.condition:
+            return(sum(len(f) for f in self.queue) + sum(len(f) for f in self.priority))
 
     def getStatus(self):
         return(self.transLen)
         
     def getIsBussy(self):
         return(self.threadMutex)
-
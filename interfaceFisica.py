@@ -12,10 +12,144 @@ import serial
 # importa pacote para conversão binário ascii
 import binascii
 
+# Interface abstrata dos transportes
+import abc
+
+# Contadores do enlace
+from metricas import Metricas
+
+# Byte-stuffing do modo binário
+EOP     = b'\xAA\xBB\xCC'
+ESC     = b'\x7D'
+ESC_ESC = b'\x7D\x5D'   # ESC escapado
+ESC_EOP = b'\x7D\x8A'   # primeiro byte do EOP escapado
+
+# Velocidades padrão das UARTs, em ordem (negociadas em velocidade.py)
+BAUDRATES    = (9600, 19200, 38400, 57600, 115200, 230400, 460800, 500000,
+                576000, 921600, 1000000, 1500000, 2000000, 3000000)
+MAX_BAUDRATE = 921600   # Maior velocidade oferecida; adaptadores USB-serial comuns vão até aí
+
+class EmHex(bytes):
+    """ Datagrama que vai em hex mesmo com o transporte no modo binário
+
+    Para a resposta do handshake repetida (server_new.expect_handshake):
+    o cliente que não a recebeu ainda lê em hex. Quem só repassa o
+    datagrama (TX, CanalRuidoso, Bond) preserva o tipo.
+    """
+
+def stuff(data):
+    """ Byte-stuffing estilo SLIP/PPP para o modo binário
+
+    ESC e o primeiro byte do EOP viram ESC, byte ^ 0x20. Assim
+    a sequência EOP nunca aparece crua dentro do datagrama; só o
+    EOP final (quando o buffer termina nele) vai sem escape.
+    """
+    body, tail = data, b""
+    if data[-len(EOP):] == EOP:
+        body, tail = data[:-len(EOP)], EOP
+    # data pode ser uma memoryview ou um bytearray: bytes() só copia nesses casos
+    body = bytes(body).replace(ESC, ESC_ESC).replace(EOP[:1], ESC_EOP)
+    return(body + tail)
+
+def unstuff(data):
+    """ Desfaz stuff num datagrama já separado pelo EOP (ver Deframer)
+
+    Levanta ValueError se houver um escape inválido.
+    """
+    # Todo ESC inicia um par de escape, então os replaces não se sobrepõem
+    if data.count(ESC) != data.count(ESC_ESC) + data.count(ESC_EOP):
+        raise ValueError("escape inválido")
+    return(data.replace(ESC_EOP, EOP[:1]).replace(ESC_ESC, ESC))
+
 #################################
 # Interface com a camada física #
 #################################
-class fisica(object):
+class Transporte(abc.ABC):
+    """ Interface que o enlace espera da camada física
+
+    fisica implementa sobre uma porta serial real; transporte.py
+    traz implementações em memória e por pseudo-terminal (pty).
+    Uma implementação que não tenha todos os métodos abstratos
+    falha já ao ser criada, não no meio de uma transferência.
+
+    metrics é o Metricas do enlace; implementações que não contam
+    nada deixam None e o enlace cria um.
+
+    baudrate é a velocidade atual; implementações sem velocidade
+    (memória sem emulação, multiplex, bonding) deixam None e não
+    oferecem nenhuma em baudrates.
+    """
+    metrics  = None
+    baudrate = None
+
+    @abc.abstractmethod
+    def open(self):
+        pass
+
+    @abc.abstractmethod
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def flush(self):
+        pass
+
+    @abc.abstractmethod
+    def inWaiting(self):
+        pass
+
+    @abc.abstractmethod
+    def setEncoding(self, encoding):
+        pass
+
+    @abc.abstractmethod
+    def write(self, txBuffer):
+        """ Escreve um datagrama e só retorna com ele enviado
+
+        Não tem parâmetro de flush: só a fila do TX sabe se há mais
+        vindo, e ela usa writeFrames.
+        """
+        pass
+
+    def writeFrames(self, frames, flush=True):
+        """ Escreve vários datagramas em ordem (fila do TX)
+
+        Implementações que conseguem juntar tudo numa escrita só
+        sobrescrevem; flush=False indica que há mais vindo logo.
+        """
+        return(sum(self.write(frame) for frame in frames))
+
+    def baudrates(self):
+        """ Velocidades para as quais setBaudrate pode trocar
+        """
+        return([])
+
+    @abc.abstractmethod
+    def setBaudrate(self, baudrate):
+        """ Troca para baudrate, uma das velocidades de baudrates()
+        """
+        pass
+
+    def realign(self):
+        """ Chegam bytes mas nunca o preâmbulo esperado (ver
+            Deframer.getSynced): desloca a leitura, se a codificação
+            tiver alinhamento. Sem alinhamento não faz nada.
+        """
+        pass
+
+    def stuffed(self):
+        """ Se read entrega o fluxo ainda com byte-stuffing: o Deframer
+            então separa os datagramas pelo EOP antes de desfazê-lo
+        """
+        return(False)
+
+    @abc.abstractmethod
+    def read(self, nBytes):
+        """ Retorna (dados, bytes lidos do fio)
+        """
+        pass
+
+class fisica(Transporte):
     def __init__(self, name):
         self.name        = name
         self.port        = None
@@ -26,6 +160,10 @@ class fisica(object):
         self.stop        = serial.STOPBITS_ONE
         self.timeout     = 0.1
         self.rxRemain    = b""
+        self.encoding    = 'hex'    # 'hex' ou 'binary', ver setEncoding
+        self.skipChar    = False    # Descartar o próximo caractere hex, ver realign
+        self.maxBaudrate = MAX_BAUDRATE
+        self.metrics     = Metricas()
 
     def open(self):
         self.port = serial.Serial(self.name,
@@ -43,13 +181,60 @@ class fisica(object):
         self.port.flushInput()
         self.port.flushOutput()
 
+    def inWaiting(self):
+        """ Bytes já recebidos pela porta e ainda não lidos
+        """
+        return(self.port.in_waiting)
+
+    def setEncoding(self, encoding):
+        """ Troca a codificação usada no fio
+
+        'hex'    : cada byte vira 2 caracteres ASCII (compatível com o
+                   controle de fluxo por software do arduino)
+        'binary' : bytes crus com byte-stuffing, ver stuff/unstuff; read
+                   entrega o fluxo como chegou (ver stuffed)
+        """
+        if encoding not in ('hex', 'binary'):
+            raise ValueError("codificação desconhecida: {}".format(encoding))
+        self.encoding = encoding
+        self.rxRemain = b""
+
+    def baudrates(self):
+        return([rate for rate in BAUDRATES if rate <= self.maxBaudrate])
+
+    def setBaudrate(self, baudrate):
+        """ Troca a velocidade da porta aberta (pyserial reconfigura a UART na hora)
+
+        Meio caractere hex da velocidade antiga não se junta com a nova.
+        """
+        self.baudrate = baudrate
+        self.port.baudrate = baudrate
+        self.rxRemain = b""
+        self.metrics.count('fisica.baud_changes')
+
+    def stuffed(self):
+        return(self.encoding == 'binary')
+
+    def realign(self):
+        """ No modo hex, lixo com um número ímpar de caracteres deixa
+            cada byte formado por metades de dois: a próxima leitura
+            descarta um caractere para mudar o pareamento
+        """
+        if self.encoding == 'hex':
+            self.skipChar = True
+            self.metrics.count('fisica.realigns')
+
     def encode(self, data):
+        if self.encoding == 'binary' and not isinstance(data, EmHex):
+            return(stuff(data))
         encoded = binascii.hexlify(data)
         return(encoded)
 
     def decode(self, data):
         """ RX ASCII data after reception
         """
+        if self.encoding == 'binary':
+            return(unstuff(data))
         decoded = binascii.unhexlify(data)
         return(decoded)
 
@@ -62,8 +247,24 @@ class fisica(object):
         Software flow control between both
         sides of communication.
         """
-        nTx = self.port.write(self.encode(txBuffer))
-        self.port.flush()
+        return(self.writeFrames([txBuffer]))
+
+    def writeFrames(self, frames, flush=True):
+        """ Codifica cada datagrama e escreve todos com um port.write
+
+        A codificação é por datagrama: o stuffing só deixa cru o EOP
+        do fim de cada um. port.flush() (esperar a UART esvaziar) só
+        com flush, quando a fila do TX acabou.
+        """
+        encoded = b"".join([self.encode(frame) for frame in frames])
+        nTx = self.port.write(encoded)
+        if flush:
+            self.port.flush()
+        nBytes = sum(len(frame) for frame in frames)
+        self.metrics.count('fisica.tx_bytes', nBytes)
+        self.metrics.count('fisica.tx_wire_bytes', len(encoded))
+        if self.encoding == 'binary':
+            return(nBytes)
         return(nTx/2)
 
     def read(self, nBytes):
@@ -72,9 +273,23 @@ class fisica(object):
         Nem toda a leitura retorna múltiplo de 2
         devemos verificar isso para evitar que a funcao
         self.decode seja chamada com números ímpares.
+
+        No modo binário os bytes saem como chegaram: o stuffing só é
+        desfeito depois que o Deframer acha o EOP de cada datagrama,
+        então um escape corrompido perde só o datagrama em que está.
         """
         rxBuffer = self.port.read(nBytes)
+        if self.encoding == 'binary':
+            nRx = len(rxBuffer)
+            if nRx:
+                self.metrics.count('fisica.rx_wire_bytes', nRx)
+                # Cada ESC é um byte a mais no fio
+                self.metrics.count('fisica.rx_bytes', nRx - rxBuffer.count(ESC))
+            return(rxBuffer, nRx)
         rxBufferConcat = self.rxRemain + rxBuffer
+        if self.skipChar and rxBufferConcat:
+            rxBufferConcat = rxBufferConcat[1:]
+            self.skipChar = False
         nValid = (len(rxBufferConcat)//2)*2
         rxBufferValid = rxBufferConcat[0:nValid]
         self.rxRemain = rxBufferConcat[nValid:]
@@ -85,8 +300,13 @@ class fisica(object):
             "muitas vezes um flush no inicio resolve!"
             rxBufferDecoded = self.decode(rxBufferValid)
             nRx = len(rxBuffer)
+            if nRx:
+                self.metrics.count('fisica.rx_wire_bytes', nRx)
+                self.metrics.count('fisica.rx_bytes', len(rxBufferDecoded))
             return(rxBufferDecoded, nRx)
-        except :
+        except binascii.Error:
             print("[ERRO] interfaceFisica, read, decode. buffer : {}".format(rxBufferValid))
+            self.metrics.count('fisica.rx_wire_bytes', len(rxBuffer))
+            self.metrics.count('fisica.decode_errors')
+            self.metrics.count('fisica.decode_dropped_bytes', len(rxBufferValid))
             return(b"", 0)
-
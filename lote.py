@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Envio de um diretório inteiro numa sessão
+####################################################
+"""
+Lote negociado no handshake (FLAG_BATCH): o cliente manda um único
+fluxo com o manifesto e, em seguida, o conteúdo de todos os arquivos,
+na ordem do manifesto:
+
+  HEADER: 'LOTE', versão (1 byte), número de arquivos (4 bytes)
+  ENTRY : tamanho (8 bytes), CRC-32 (4 bytes), tamanho do nome (2 bytes)
+          + nome relativo em UTF-8, com '/'
+
+Para o protocolo o lote é um arquivo como outro qualquer: a janela, a
+compressão, o FEC e a retomada valem para o lote inteiro, e um arquivo
+emenda no seguinte dentro do mesmo pacote, sem handshake nem espera
+por arquivo. Lote lê o fluxo direto dos arquivos do diretório, sem
+montar uma cópia; o servidor grava o fluxo como um arquivo só e, no
+fim, extract separa e confere cada arquivo.
+
+Uso:
+  python lote.py arquivo [destino]   # lista ou separa um lote recebido
+"""
+
+import os
+import sys
+import bisect
+import struct
+import binascii
+
+MAGIC   = b'LOTE'
+VERSION = 1
+HEADER  = struct.Struct('>4sBI')    # MAGIC, versão, número de arquivos
+ENTRY   = struct.Struct('>QIH')     # tamanho, CRC-32, tamanho do nome (+ nome)
+CHUNK   = 64 * 1024
+
+def file_crc(path):
+    """ CRC-32 do arquivo inteiro
+    """
+    digest = 0
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            digest = binascii.crc32(chunk, digest)
+    return(digest)
+
+def scan(directory):
+    """ (nome relativo com '/', caminho) de cada arquivo, em ordem
+    """
+    found = []
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if os.path.isfile(path):
+                found.append((os.path.relpath(path, directory).replace(os.sep, '/'), path))
+    return(found)
+
+def pack_manifest(entries):
+    """ Manifesto de entries, lista de (nome, tamanho, CRC-32)
+    """
+    parts = [HEADER.pack(MAGIC, VERSION, len(entries))]
+    for name, size, digest in entries:
+        encoded = name.encode()
+        parts.append(ENTRY.pack(size, digest, len(encoded)) + encoded)
+    return(b''.join(parts))
+
+def read_exactly(file, n):
+    data = file.read(n)
+    if len(data) != n:
+        raise ValueError("lote truncado")
+    return(data)
+
+def read_manifest(file):
+    """ Lê o manifesto do início de file; retorna [(nome, tamanho, CRC-32)]
+    """
+    magic, version, count = HEADER.unpack(read_exactly(file, HEADER.size))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("não é um lote")
+    entries = []
+    for _ in range(count):
+        size, digest, length = ENTRY.unpack(read_exactly(file, ENTRY.size))
+        entries.append((read_exactly(file, length).decode(errors='replace'), size, digest))
+    return(entries)
+
+def safe_path(directory, name):
+    """ Caminho de name dentro de directory; recusa nomes que saem dele
+    """
+    parts = name.split('/')
+    if '\\' in name or ':' in name or any(p in ('', '.', '..') for p in parts):
+        raise ValueError("nome inválido no lote: {!r}".format(name))
+    return(os.path.join(directory, *parts))
+
+class Lote(object):
+    """ Manifesto + arquivos de um diretório como um arquivo só de leitura
+
+    Tem a interface de arquivo usada por Packets e Compressor (seek,
+    read). Tamanhos e CRCs são lidos na criação; um arquivo que mudar
+    depois sai com o tamanho do manifesto (cortado ou completado com
+    zeros) e o servidor acusa o CRC.
+    """
+
+    def __init__(self, directory):
+        self.name     = os.path.basename(os.path.abspath(directory)) + '.lote'
+        self.entries  = []      # (nome, tamanho, CRC-32)
+        self.paths    = []
+        self.mtime_ns = 0       # Mais recente dos arquivos: identidade para a retomada
+        for name, path in scan(directory):
+            stat = os.stat(path)
+            self.entries.append((name, stat.st_size, file_crc(path)))
+            self.paths.append(path)
+            self.mtime_ns = max(self.mtime_ns, stat.st_mtime_ns)
+        self.manifest = pack_manifest(self.entries)
+        # Início de cada arquivo no fluxo, depois do manifesto
+        self.starts = [len(self.manifest)]
+        for _, size, _ in self.entries:
+            self.starts.append(self.starts[-1] + size)
+        self.length   = self.starts[-1]
+        self.position = 0
+        self.current  = None    # (índice, arquivo aberto)
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.length
+        self.position = max(0, offset)
+        return(self.position)
+
+    def read(self, size=-1):
+        end = self.length if size < 0 else min(self.length, self.position + size)
+        parts = []
+        while self.position < end:
+            if self.position < len(self.manifest):
+                part = self.manifest[self.position:end]
+            else:
+                i = bisect.bisect_right(self.starts, self.position) - 1
+                part = self.read_file(i, self.position - self.starts[i],
+                                      min(end, self.starts[i + 1]) - self.position)
+            parts.append(part)
+            self.position += len(part)
+        return(b''.join(parts))
+
+    def read_file(self, i, offset, n):
+        if self.current is None or self.current[0] != i:
+            self.close()
+            self.current = (i, open(self.paths[i], 'rb'))
+        f = self.current[1]
+        f.seek(offset)
+        return(f.read(n).ljust(n, b'\x00'))
+
+    def close(self):
+        if self.current is not None:
+            self.current[1].close()
+            self.current = None
+
+    def __enter__(self):
+        self.seek(0)
+        return(self)
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_source(source):
+    """ Abre para leitura um caminho ou um Lote
+    """
+    if isinstance(source, Lote):
+        return(source)
+    return(open(source, 'rb'))
+
+def identity(source):
+    """ Nome, tamanho e data de um caminho ou Lote (pedido de retomada)
+    """
+    if isinstance(source, Lote):
+        return(source.name, source.length, source.mtime_ns)
+    stat = os.stat(source)
+    return(os.path.basename(source), stat.st_size, stat.st_mtime_ns)
+
+def extract(path, directory):
+    """ Separa em directory os arquivos do lote gravado em path
+
+    Retorna (entradas do manifesto, nomes cujo tamanho ou CRC não bate).
+    """
+    bad = []
+    with open(path, 'rb') as f:
+        entries = read_manifest(f)
+        for name, size, digest in entries:
+            target = safe_path(directory, name)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            crc, left = 0, size
+            with open(target, 'wb') as out:
+                while left:
+                    chunk = f.read(min(left, CHUNK))
+                    if not chunk:
+                        break
+                    out.write(chunk)
+                    crc = binascii.crc32(chunk, crc)
+                    left -= len(chunk)
+            if left or crc != digest:
+                bad.append(name)
+    return(entries, bad)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        entries, bad = extract(sys.argv[1], sys.argv[2])
+        print("{} arquivos em {}, {} com erro {}".format(len(entries), sys.argv[2], len(bad), bad or ''))
+    else:
+        with open(sys.argv[1], 'rb') as f:
+            for name, size, digest in read_manifest(f):
+                print("{:>10} {:08x} {}".format(size, digest, name))
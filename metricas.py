@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Métricas do enlace
+####################################################
+"""
+Contadores, histogramas e medidores de um enlace. A fisica cria o seu
+Metricas, o enlace o repassa ao RX e ao TX, e client_new/server_new
+registram os eventos do protocolo em com.metrics:
+
+  fisica.*  bytes de payload e do fio nos dois sentidos, erros de decodificação
+  rx.*      ocupação do buffer (atual, pico, descartes), esperas no high-water
+  tx.*      tempo de escrita na porta (busy_s e o histograma write_s)
+  client.*  RTT por pacote, envios, retransmissões, timeouts, NACKs por motivo,
+            bytes de payload confirmados (goodput)
+  server.*  pacotes aceitos, bytes gravados, NACKs enviados por motivo,
+            duplicados, fora de ordem
+
+snapshot() devolve tudo num dict; startDump() grava um snapshot por
+intervalo, com as taxas (por segundo) dos contadores desde o anterior,
+uma linha JSON por vez.
+
+Exemplo:
+  com1.metrics.startDump(1.0, 'client_metrics.jsonl')
+  ...
+  print(com1.metrics.snapshot()['counters']['fisica.tx_wire_bytes'])
+"""
+
+import sys
+import json
+import math
+import time
+import threading
+
+class Histograma(object):
+    """ Distribuição em faixas exponenciais: low, 2*low, 4*low, ...
+
+    Guarda só contagens por faixa, então o custo não cresce com o
+    número de amostras; percentis são o limite superior da faixa.
+    """
+
+    def __init__(self, low=1e-4, buckets=24):
+        self.low    = low
+        self.counts = [0] * (buckets + 1)
+        self.count  = 0
+        self.sum    = 0.0
+        self.min    = None
+        self.max    = None
+
+    def observe(self, value):
+        if value <= self.low:
+            i = 0
+        else:
+            i = min(len(self.counts) - 1, int(math.log2(value / self.low)) + 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        if not self.count:
+            return(None)
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return(min(self.low * 2**i, self.max))
+        return(self.max)
+
+    def snapshot(self):
+        return({'count': self.count, 'sum': self.sum,
+                'mean': self.sum / self.count if self.count else None,
+                'min': self.min, 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90), 'p99': self.percentile(99)})
+
+class Metricas(object):
+
+    def __init__(self):
+        self.lock       = threading.Lock()
+        self.counters   = {}
+        self.histograms = {}
+        self.gauges     = {}    # Nome -> função lida no snapshot
+        self.t0         = time.monotonic()
+        self.dumpThread = None
+        self.dumpStop   = threading.Event()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def observe(self, name, value):
+        with self.lock:
+            h = self.histograms.get(name)
+            if h is None:
+                h = self.histograms[name] = Histograma()
+            h.observe(value)
+
+    def gauge(self, name, function):
+        """ Valor lido só no snapshot (ex.: ocupação do buffer), sem custo por evento
+        """
+        with self.lock:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        with self.lock:
+            counters = dict(self.counters)
+            histograms = {name: h.snapshot() for name, h in self.histograms.items()}
+            gauges = dict(self.gauges)
+        return({'elapsed_s': time.monotonic() - self.t0,
+                'counters': counters,
+                'gauges': {name: f() for name, f in gauges.items()},
+                'histograms': histograms})
+
+    ##############################
+    # Dump periódico             #
+    ##############################
+    def startDump(self, interval=1.0, path=None):
+        """ Grava um snapshot a cada interval segundos em path (ou stderr)
+        """
+        self.stopDump()
+        self.dumpStop.clear()
+        self.dumpThread = threading.Thread(target=self.dumper, args=(interval, path), daemon=True)
+        self.dumpThread.start()
+
+    def stopDump(self):
+        """ Para o dump periódico; o último snapshot é gravado antes de parar
+        """
+        if self.dumpThread is not None:
+            self.dumpStop.set()
+            self.dumpThread.join()
+            self.dumpThread = None
+
+    def dumper(self, interval, path):
+        out = open(path, 'a') if path else sys.stderr
+        last, lastT = {}, time.monotonic()
+        try:
+            while True:
+                stop = self.dumpStop.wait(interval)
+                snap = self.snapshot()
+                now = time.monotonic()
+                dt = max(now - lastT, 1e-9)
+                snap['rates'] = {name: (value - last.get(name, 0)) / dt
+                                 for name, value in snap['counters'].items()}
+                last, lastT = snap['counters'], now
+                out.write(json.dumps(snap) + "\n")
+                out.flush()
+                if stop:
+                    return
+        finally:
+            if path:
+                out.close()
@@ -0,0 +1,391 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Camada de Enlace - vários streams numa porta
+####################################################
+"""
+Multiplexador divide um enlace em streams independentes. Cada Stream é
+um Transporte (ver interfaceFisica), então enlace(nome, stream) roda
+client_new/server_new ou qualquer outro protocolo sobre ele sem mudar
+nada; vários streams dividem a mesma porta ao mesmo tempo.
+
+Tudo o que um stream escreve vai em quadros do tipo 8, com o mesmo HEAD
+de 12 bytes dos datagramas e os bytes reservados em uso:
+
+  [0:4]  posição no stream / limite   [9]  id do stream (0-255)
+  [4:6]  tamanho do payload           [10] flags (CREDIT, PROBE, FIN)
+  [6:8]  CRC do HEAD e do payload     [11] reservado
+  [8]    tipo 8
+
+Escalonamento: a cada volta cada stream com dados manda até QUANTUM
+bytes (round robin por bytes); streams abertos com priority=True são
+atendidos antes dos demais, então uma mensagem curta de controle espera
+no máximo um quadro do stream volumoso.
+
+Controle de fluxo por stream: cada quadro de dados leva a posição do
+seu primeiro byte no stream, e o receptor informa (CREDIT) até que
+posição pode receber: a maior posição já vista mais o espaço livre no
+seu buffer de STREAM_WINDOW bytes. Os valores são absolutos, então
+perder um quadro de dados ou um CREDIT não prende crédito; quem ficar
+sem crédito por PROBE_INTERVAL pergunta de novo (PROBE).
+
+O Multiplexador não reenvia nada: um quadro perdido some do stream e
+quem garante a entrega é o protocolo de cima (ACK/NACK).
+
+Os dois lados precisam usar o Multiplexador: um enlace comum não entende
+os quadros do tipo 8.
+
+Uso:
+  python multiplex.py   # transferência de arquivo e mensagens curtas no mesmo loopback
+"""
+
+# Importa pacote de tempo
+import time
+
+# Threads
+import threading
+
+import collections
+
+from interfaceFisica import Transporte
+from deframer import Deframer
+import protocolo
+
+EOP = protocolo.EOP
+
+MESSAGE_TYPE  = 8           # Quadro de stream
+QUANTUM       = 1024        # Bytes por stream a cada volta do escalonador
+STREAM_WINDOW = 32 * 1024   # Bytes em voo por stream (buffer de recepção)
+PROBE_INTERVAL = 0.5        # Sem crédito por esse tempo: manda PROBE
+
+# Flags (byte 10)
+CREDIT = 0x01   # [0:4] = posição até onde o outro lado pode enviar
+PROBE  = 0x02   # Pede um CREDIT
+FIN    = 0x04   # O stream foi fechado por quem envia
+
+def create_frame(streamId, payload=b"", flags=0, position=0):
+    position %= 2**32
+    return(protocolo.encode(position >> 16, position & 0xFFFF, MESSAGE_TYPE, payload,
+                            streamId, flags, protect=True))
+
+def frame_position(fields):
+    """ Posição no stream / limite, dos campos de pacote e total (bytes 0-3)
+    """
+    return((fields[0] << 16) | fields[1])
+
+class Stream(Transporte):
+    """ Um stream do Multiplexador, com a interface de Transporte
+    """
+    def __init__(self, mux, streamId, priority=False, window=STREAM_WINDOW):
+        self.mux        = mux
+        self.name       = "{}#{}".format(mux.link.fisica.name, streamId)
+        self.streamId   = streamId
+        self.priority   = priority
+        self.window     = window
+        self.timeout    = 0.1   # Espera de read, como a porta serial
+        # Envio (protegido por mux.condition)
+        self.outbox     = bytearray()
+        self.sent       = 0       # Bytes já entregues ao enlace
+        self.peerLimit  = window  # Posição até onde o outro lado aceita
+        self.blockedAt  = None    # Desde quando está sem crédito
+        self.closing    = False
+        # Recepção
+        self.inbound    = bytearray()
+        self.seen       = 0       # Maior posição recebida (inclui perdas antes dela)
+        self.advertised = window  # Último limite informado ao outro lado
+        self.peerClosed = False
+        self.dropped    = 0     # Bytes recebidos além da janela
+        self.condition  = threading.Condition()
+
+    def open(self):
+        pass
+
+    def close(self):
+        # O que já foi escrito ainda sai, seguido do FIN
+        with self.mux.condition:
+            self.closing = True
+            self.mux.condition.notify_all()
+
+    def flush(self):
+        with self.mux.condition:
+            self.mux.condition.wait_for(lambda: not self.outbox or self.mux.threadStop)
+
+    def inWaiting(self):
+        return(len(self.inbound))
+
+    def setEncoding(self, encoding):
+        # A codificação é a do enlace de baixo, comum a todos os streams
+        pass
+
+    def setBaudrate(self, baudrate):
+        # Sem velocidade própria: baudrates() é vazio
+        raise ValueError("stream sem troca de velocidade: {}".format(baudrate))
+
+    def write(self, txBuffer):
+        """ Enfileira txBuffer; bloqueia enquanto a fila passar da janela
+        """
+        with self.mux.condition:
+            self.mux.condition.wait_for(lambda: len(self.outbox) < self.window or self.mux.threadStop)
+            self.outbox += txBuffer
+            self.mux.condition.notify_all()
+        return(len(txBuffer))
+
+    def read(self, nBytes):
+        with self.condition:
+            self.condition.wait_for(lambda: self.inbound or self.mux.threadStop, self.timeout)
+            data = bytes(self.inbound[:nBytes])
+            del self.inbound[:nBytes]
+            grant = self.grant()
+        if grant:
+            self.mux.sendCredit(self, grant)
+        return(data, len(data))
+
+    def limit(self):
+        """ Posição até onde o outro lado pode enviar (chamar com condition)
+        """
+        return(self.seen + self.window - len(self.inbound))
+
+    def grant(self):
+        """ Novo limite a informar, se avançou o bastante (chamar com condition)
+        """
+        limit = self.limit()
+        if limit - self.advertised < self.window // 4:
+            return(None)
+        self.advertised = limit
+        return(limit)
+
+    def credit(self):
+        """ Bytes que ainda podem ser enviados (chamar com mux.condition)
+        """
+        return(self.peerLimit - self.sent)
+
+    def received(self, position, payload):
+        with self.condition:
+            # position vem módulo 2**32; quadros anteriores perdidos só avançam seen
+            delta = (position - self.seen) % 2**32
+            if delta < 2**31:
+                self.seen += delta + len(payload)
+            room = self.window - len(self.inbound)
+            if len(payload) > room:
+                self.dropped += len(payload) - room
+                payload = payload[:room]
+            self.inbound += payload
+            self.condition.notify_all()
+            grant = self.grant()
+        if grant:
+            self.mux.sendCredit(self, grant)
+
+class Multiplexador(object):
+
+    def __init__(self, link, maxPayload=QUANTUM):
+        """ link: enlace já habilitado, usado só pelo Multiplexador
+        """
+        self.link       = link
+        self.streams    = {}
+        self.incoming   = collections.deque()   # Streams abertos pelo outro lado
+        self.control    = collections.deque()   # Quadros de controle, antes de tudo
+        self.turn       = collections.deque()   # Ordem do round robin
+        self.deframer   = Deframer(link.rx, maxPayload)
+        self.condition  = threading.Condition()
+        self.threadStop = False
+        self.stats      = {'frames': 0, 'bytes': 0, 'credits': 0, 'probes': 0, 'crcErrors': 0}
+        self.threads    = [threading.Thread(target=self.scheduler, daemon=True),
+                           threading.Thread(target=self.demux, daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def stream(self, streamId, priority=False, window=STREAM_WINDOW):
+        """ Abre (ou retorna) o stream streamId
+        """
+        with self.condition:
+            if streamId not in self.streams:
+                self.streams[streamId] = Stream(self, streamId, priority, window)
+                self.turn.append(streamId)
+            return(self.streams[streamId])
+
+    def accept(self, timeout=None):
+        """ Próximo stream aberto pelo outro lado, ou None no timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.incoming or self.threadStop, timeout)
+            return(self.incoming.popleft() if self.incoming else None)
+
+    def close(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.control and
+                                    not any(s.outbox for s in self.streams.values()), 2)
+            self.threadStop = True
+            self.condition.notify_all()
+        for s in list(self.streams.values()):
+            with s.condition:
+                s.condition.notify_all()
+        for t in self.threads:
+            t.join(1)
+
+    def sendCredit(self, stream, limit):
+        with self.condition:
+            self.control.append(create_frame(stream.streamId, flags=CREDIT, position=limit))
+            self.stats['credits'] += 1
+            self.condition.notify_all()
+
+    ##############################
+    # Envio                      #
+    ##############################
+    def nextFrame(self):
+        """ Escolhe o próximo quadro a enviar (chamar com condition)
+        """
+        if self.control:
+            return(self.control.popleft())
+        now = time.time()
+        streams = [self.streams[i] for i in self.turn]
+        for stream in [s for s in streams if s.priority] + [s for s in streams if not s.priority]:
+            if stream.outbox:
+                n = min(len(stream.outbox), QUANTUM, stream.credit())
+                if n <= 0:
+                    # Sem crédito: o CREDIT pode ter se perdido
+                    if stream.blockedAt is None:
+                        stream.blockedAt = now
+                    elif now - stream.blockedAt >= PROBE_INTERVAL:
+                        stream.blockedAt = now
+                        self.stats['probes'] += 1
+                        return(create_frame(stream.streamId, flags=PROBE))
+                    continue
+                stream.blockedAt = None
+                payload = bytes(stream.outbox[:n])
+                del stream.outbox[:n]
+                position = stream.sent
+                stream.sent += n
+                # Vai para o fim da fila do round robin
+                self.turn.remove(stream.streamId)
+                self.turn.append(stream.streamId)
+                self.condition.notify_all()
+                return(create_frame(stream.streamId, payload, position=position))
+            if stream.closing:
+                stream.closing = False
+                del self.streams[stream.streamId]
+                self.turn.remove(stream.streamId)
+                return(create_frame(stream.streamId, flags=FIN))
+        return(None)
+
+    def scheduler(self):
+        while True:
+            with self.condition:
+                frame = self.nextFrame()
+                while frame is None and not self.threadStop:
+                    self.condition.wait(PROBE_INTERVAL)
+                    frame = self.nextFrame()
+                if frame is None:
+                    return
+            self.link.sendData(frame)
+            self.stats['frames'] += 1
+            self.stats['bytes'] += len(frame)
+            self.link.tx.waitDone()
+            with self.condition:
+                self.condition.notify_all()
+
+    ##############################
+    # Recepção                   #
+    ##############################
+    def demux(self):
+        while not self.threadStop:
+            frame = self.deframer.getFrame(0.2)
+            if frame is None or not frame.endswith(EOP) or len(frame) < protocolo.OVERHEAD:
+                continue
+            fields = protocolo.HEAD.unpack_from(frame)
+            payload = protocolo.payload(frame)
+            if fields[4] != MESSAGE_TYPE or len(payload) != fields[2]:
+                continue
+            if fields[3] != protocolo.frame_crc(fields, payload, True):
+                self.stats['crcErrors'] += 1
+                continue
+            streamId, flags = fields[5], fields[6]
+            with self.condition:
+                stream = self.streams.get(streamId)
+                if stream is None:
+                    if flags & (CREDIT | PROBE | FIN):
+                        continue
+                    stream = Stream(self, streamId)
+                    self.streams[streamId] = stream
+                    self.turn.append(streamId)
+                    self.incoming.append(stream)
+                    self.condition.notify_all()
+                if flags & CREDIT:
+                    # Absoluto módulo 2**32: só avança
+                    delta = (frame_position(fields) - stream.peerLimit) % 2**32
+                    if delta < 2**31:
+                        stream.peerLimit += delta
+                    stream.blockedAt = None
+                    self.condition.notify_all()
+                    continue
+                if flags & PROBE:
+                    with stream.condition:
+                        limit = stream.limit()
+                    self.control.append(create_frame(streamId, flags=CREDIT, position=limit))
+                    self.condition.notify_all()
+                    continue
+            if flags & FIN:
+                with stream.condition:
+                    stream.peerClosed = True
+                    stream.condition.notify_all()
+                continue
+            stream.received(frame_position(fields), payload)
+
+def demo(fileSize=60000, baudrate=115200):
+    """ client_new/server_new no stream 1 e mensagens de status no stream 2
+    """
+    import os
+    import client_new
+    import server_new
+    import transporte
+    from enlace import enlace
+
+    content = os.urandom(fileSize)
+    with transporte.demoSession(content) as received:
+        a, b = transporte.loopbackPair(baudrate)
+        linkA, linkB = enlace(a.name, a), enlace(b.name, b)
+        linkA.enable()
+        linkB.enable()
+        linkA.setEncoding('binary')
+        linkB.setEncoding('binary')
+        muxA, muxB = Multiplexador(linkA), Multiplexador(linkB)
+        try:
+            client_new.com1 = enlace('arquivo', muxA.stream(1))
+            server_new.com2 = enlace('arquivo', muxB.stream(1))
+            status = muxA.stream(2, priority=True)
+
+            server = threading.Thread(target=server_new.main, daemon=True)
+            server.start()
+            client = threading.Thread(target=client_new.main, daemon=True)
+            client.start()
+
+            # O servidor só conhece o stream 2 quando o primeiro quadro chega
+            delays = []
+            for i in range(10):
+                time.sleep(0.5)
+                status.write(b"status %d" % i)
+                sentAt = time.time()
+                if i == 0:
+                    peer = muxB.accept(5)
+                data, n = b"", 0
+                while n == 0 and time.time() - sentAt < 5:
+                    data, n = peer.read(64)
+                delays.append(time.time() - sentAt)
+            client.join()
+            server.join()
+
+            with open(received, 'rb') as f:
+                same = f.read() == content
+        finally:
+            muxA.close()
+            muxB.close()
+            linkA.disable()
+            linkB.disable()
+
+    print("arquivo recebido igual: {}".format(same))
+    print("atraso das mensagens de status: média {:.1f} ms, máximo {:.1f} ms".format(
+        1000 * sum(delays) / len(delays), 1000 * max(delays)))
+    print("quadros: {}".format(muxA.stats))
+
+if __name__ == "__main__":
+    demo()
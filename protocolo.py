@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Formato do datagrama
+####################################################
+"""
+Montagem e leitura do datagrama, num só lugar para client_new,
+server_new e bonding:
+
+  HEAD (12 bytes) + payload + EOP (AA BB CC)
+
+  HEAD: pacote (0-1), total de pacotes (2-3), tamanho do payload (4-5),
+        CRC (6-7), tipo (8), bytes 9-11 de cada tipo (motivo do NACK,
+        janela/capacidades/codec do handshake, ...)
+
+No handshake, sem CRC, os bytes 6-7 levam as velocidades (velocidade.py).
+
+O CRC é crc_hqx com 0xFFFF do payload ou, com FLAG_HEAD_CRC, do HEAD
+sem o campo de CRC seguido do payload (span_crc).
+
+O handshake e a sua resposta vão depois do preâmbulo SYNC: quem espera
+o handshake descarta tudo até ele, sem byte de sacrifício nem esperas
+fixas para a linha "limpar". Os 0x55 alternam os bits do byte. Pares
+antigos trocam LEGACY_HANDSHAKE e LEGACY_REPLY, sem preâmbulo.
+
+Os layouts são struct.Struct pré-compilados. encode monta o HEAD com
+um só pack, no lugar das concatenações de to_bytes, e junta payload e
+EOP numa concatenação: o resultado já é bytes, que o TX enfileira sem
+copiar. Montar num buffer pré-alocado (pack_into) foi medido e perde
+para isso: a cópia para bytes que a fila do TX precisa fazer custa
+mais que a alocação que ele evitaria.
+
+Na leitura, HEAD.unpack_from lê todos os campos de uma vez direto do
+datagrama, e payload() é uma memoryview: o payload só é copiado quando
+é gravado.
+
+Uso:
+  python protocolo.py [n]   # custo por pacote: concatenação x struct
+"""
+
+import sys
+import struct
+import timeit
+import binascii
+
+EOP        = b'\xAA\xBB\xCC'
+HEAD_SIZE  = 12
+OVERHEAD   = HEAD_SIZE + len(EOP)
+SYNC       = b'\x55\x55\xC3\x3C'  # Preâmbulo do handshake e da sua resposta, ver Deframer.getSynced
+
+HEAD  = struct.Struct('>HHHHBBBB')      # pacote, total, tamanho, CRC, tipo, bytes 9, 10, 11
+EMPTY = struct.Struct('>HHHHBBBB3s')    # HEAD + EOP: datagrama sem payload (ACK, NACK)
+SPAN  = struct.Struct('>HHHBBBB')       # O que o CRC do HEAD cobre: bytes 0-5 e 8-11
+HANDSHAKE = struct.Struct('>BxHxxHBBBB') # grupo do FEC, payload máximo, velocidades, tipo, janela, flags, codec
+RESUME_REQUEST = struct.Struct('>QQ')   # Payload do tipo 6: tamanho e data do arquivo (+ nome)
+RESUME         = struct.Struct('>QI')   # Payload do tipo 7: bytes já recebidos e seu CRC-32
+
+crc_hqx = binascii.crc_hqx
+
+def crc(data):
+    return(crc_hqx(data, 0xFFFF))
+
+def span_crc(packet_number, total_packets, size, message_type, byte9, byte10, byte11, payload=b''):
+    """ CRC dos campos do HEAD que SPAN cobre seguidos do payload (FLAG_HEAD_CRC)
+    """
+    return(crc_hqx(payload, crc_hqx(SPAN.pack(packet_number, total_packets, size, message_type,
+                                              byte9, byte10, byte11), 0xFFFF)))
+
+def frame_crc(fields, payload, protect):
+    """ CRC que um datagrama com os campos fields (HEAD.unpack_from) e
+        esse payload deveria trazer
+    """
+    if not protect:
+        return(crc(payload))
+    packet_number, total_packets, size, _, message_type, byte9, byte10, byte11 = fields
+    return(span_crc(packet_number, total_packets, size, message_type, byte9, byte10, byte11, payload))
+
+def encode(packet_number, total_packets, message_type, payload=b'',
+           byte9=0, byte10=0, byte11=0, protect=False, size=None):
+    """ Monta o datagrama; retorna bytes
+
+    protect: CRC do HEAD e do payload (FLAG_HEAD_CRC). size põe outro
+    valor no campo de tamanho (simulação de erro do cliente). O CRC do
+    HEAD sai dos próprios campos (SPAN), e o payload (bytes ou
+    memoryview) é lido uma vez para o CRC e uma para a cópia.
+    """
+    if size is None:
+        size = len(payload)
+    if protect:
+        value = span_crc(packet_number, total_packets, size, message_type, byte9, byte10, byte11, payload)
+    else:
+        value = crc(payload)
+    return(HEAD.pack(packet_number, total_packets, size, value, message_type, byte9, byte10, byte11)
+           + payload + EOP)
+
+def encode_empty(packet_number, message_type, byte9=0, protect=False):
+    """ Datagrama sem payload (ACK, NACK) com um único pack
+    """
+    value = span_crc(packet_number, 0, 0, message_type, byte9, 0, 0) if protect else 0
+    return(EMPTY.pack(packet_number, 0, 0, value, message_type, byte9, 0, 0, EOP))
+
+def encode_handshake(message_type, max_payload, window, flags, codec, fec_group, rates=0):
+    """ Handshake (tipo 1) ou sua resposta (tipo 2): sem payload nem CRC
+
+    rates é a máscara de velocidades dos bytes 6-7 (velocidade.py).
+    """
+    return(HANDSHAKE.pack(fec_group, max_payload, rates, message_type, window, flags, codec) + EOP)
+
+# Handshake e resposta dos pares sem preâmbulo (stop-and-wait): sempre zerados e sem SYNC
+LEGACY_HANDSHAKE = encode_handshake(1, 0, 0, 0, 0, 0)
+LEGACY_REPLY     = encode_handshake(2, 0, 0, 0, 0, 0)
+
+def payload(datagram):
+    """ Payload do datagrama, sem copiar
+    """
+    return(memoryview(datagram)[HEAD_SIZE:-len(EOP)])
+
+##############################
+# Benchmark                  #
+##############################
+def concat_datagram(packet_number, total_packets, payload, protect):
+    """ Montagem por concatenação, como era feita em client_new
+    """
+    head = (packet_number.to_bytes(2, 'big') +
+            total_packets.to_bytes(2, 'big') +
+            len(payload).to_bytes(2, 'big') +
+            crc(payload).to_bytes(2, 'big') +
+            (3).to_bytes(1, 'big') +
+            b'\x00'*3)
+    if protect:
+        head = head[:6] + crc(head[0:6] + head[8:12] + payload).to_bytes(2, 'big') + head[8:]
+    return(head + payload + EOP)
+
+def concat_ack(packet_number, protect):
+    """ ACK por concatenação, como era feito em server_new
+    """
+    head = packet_number.to_bytes(2, 'big') + b'\x00'*6 + (4).to_bytes(1, 'big') + b'\x00'*3
+    if protect:
+        head = head[:6] + crc(head[0:6] + head[8:12]).to_bytes(2, 'big') + head[8:]
+    return(head + EOP)
+
+def concat_parse(datagram, protect):
+    """ Leitura por fatias e int.from_bytes, como era feita em server_new
+    """
+    head = datagram[:12]
+    packet_number = int.from_bytes(head[0:2], 'big')
+    total_packets = int.from_bytes(head[2:4], 'big')
+    payload_size = int.from_bytes(head[4:6], 'big')
+    crc_received = int.from_bytes(head[6:8], 'big')
+    message_type = head[8]
+    data = datagram[12:-3]
+    ok = crc_received == (crc(head[0:6] + head[8:12] + data) if protect else crc(data))
+    return(packet_number, total_packets, payload_size, message_type, ok)
+
+def struct_parse(datagram, protect):
+    fields = HEAD.unpack_from(datagram)
+    ok = fields[3] == frame_crc(fields, payload(datagram), protect)
+    return(fields[0], fields[1], fields[2], fields[4], ok)
+
+def benchmark(n=20000, sizes=(50, 1024)):
+    """ Tempo por operação (µs) das duas implementações
+    """
+    results = []
+    for size in sizes:
+        data = bytes(range(256)) * (size // 256) + bytes(size % 256)
+        for protect in (False, True):
+            datagram = concat_datagram(7, 100, data, protect)
+            assert encode(7, 100, 3, data, protect=protect) == datagram
+            assert concat_ack(7, protect) == encode_empty(7, 4, protect=protect)
+            assert concat_parse(datagram, protect) == struct_parse(datagram, protect)
+            cases = [
+                ('dados',   lambda: concat_datagram(7, 100, data, protect),
+                            lambda: encode(7, 100, 3, data, protect=protect)),
+                ('ack',     lambda: concat_ack(7, protect),
+                            lambda: encode_empty(7, 4, protect=protect)),
+                ('leitura', lambda: concat_parse(datagram, protect),
+                            lambda: struct_parse(datagram, protect)),
+            ]
+            for name, old, new in cases:
+                t_old = min(timeit.repeat(old, number=n, repeat=3)) / n * 1e6
+                t_new = min(timeit.repeat(new, number=n, repeat=3)) / n * 1e6
+                results.append((name, size, protect, t_old, t_new))
+    return(results)
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    print("{:8} {:>7} {:>9} {:>12} {:>10} {:>8}".format('operação', 'payload', 'head_crc',
+                                                        'concat (µs)', 'struct (µs)', 'ganho'))
+    for name, size, protect, t_old, t_new in benchmark(n):
+        print("{:8} {:>7} {:>9} {:>12.2f} {:>10.2f} {:>7.2f}x".format(name, size, str(protect),
+                                                                    t_old, t_new, t_old / t_new))
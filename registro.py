@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Registro de eventos em segundo plano
+####################################################
+"""
+Registro de eventos (envio/recepção de datagramas) para client_new e
+server_new, fora do caminho de cada pacote: event() só põe uma tupla
+numa fila limitada e uma thread grava os eventos em lotes. Com a fila
+cheia o evento é descartado (e contado) em vez de atrasar o envio.
+
+Os instantes vêm de time.monotonic(), que não anda para trás se o
+relógio do sistema mudar; o horário de parede só entra uma vez, no
+início, e na exportação.
+
+Formatos:
+  text   : o formato de sempre dos logs (padrão: client_log.txt e
+           server_log.txt), linha por evento
+           "data hora / envio / tipo / tamanho [/ pacote / total / CRC]"
+  binary : registros de RECORD.size bytes (o mais compacto, .bin);
+           cada execução começa com um registro SESSION cujo t é o
+           horário de parede do instante 0
+  jsonl  : um objeto JSON por linha (maior, mas fácil de analisar)
+
+Com LOG_FORMAT = 'binary' em client_new/server_new o log vira
+client_log.bin/server_log.bin, e o comando abaixo o converte para o
+texto de sempre.
+
+Uso:
+  python registro.py client_log.bin [saida.txt]   # exporta para o texto antigo
+"""
+
+import sys
+import json
+import time
+import queue
+import atexit
+import struct
+import datetime
+import threading
+
+RECORD      = struct.Struct('<dBBIHHHB')   # t, evento, tipo, tamanho, pacote, total, CRC, tem pacote
+SESSION     = 255       # Evento do registro de início de execução
+QUEUE_SIZE  = 10000     # Eventos aguardando a thread
+BATCH_SIZE  = 256       # Eventos por escrita
+FLUSH_AFTER = 0.5       # Segundos até gravar um lote incompleto
+
+EVENTS = ('envio', 'receb')
+EXTENSIONS = {'binary': '.bin', 'jsonl': '.jsonl', 'text': '.txt'}
+
+class Registro(object):
+
+    def __init__(self, base, format='text'):
+        """ base: nome do arquivo sem extensão (ex.: 'client_log')
+        """
+        if format not in EXTENSIONS:
+            raise ValueError("formato desconhecido: {}".format(format))
+        self.path    = base + EXTENSIONS[format]
+        self.format  = format
+        self.queue   = queue.Queue(QUEUE_SIZE)
+        self.thread  = None
+        self.lock    = threading.Lock()
+        self.dropped = 0    # Eventos descartados com a fila cheia
+        self.t0      = time.monotonic()
+        self.wall0   = time.time()
+
+    def event(self, event_type, message_type, size, packet_number=None, total_packets=None, crc=None):
+        """ Registra um evento; não bloqueia
+        """
+        if self.thread is None:
+            self.start()
+        try:
+            self.queue.put_nowait((time.monotonic() - self.t0, event_type, message_type, size,
+                                   packet_number, total_packets, crc))
+        except queue.Full:
+            self.dropped += 1
+
+    def start(self):
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.thread = threading.Thread(target=self.writer, daemon=True)
+            self.thread.start()
+            atexit.register(self.close)
+
+    def flush(self):
+        """ Espera a thread gravar tudo o que já foi registrado
+        """
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        """ Grava o que falta e encerra a thread (um novo event() a reinicia)
+        """
+        with self.lock:
+            thread, self.thread = self.thread, None
+            if thread is None:
+                return
+            atexit.unregister(self.close)
+        self.queue.put(None)
+        thread.join()
+        if self.dropped:
+            print("Registro: {} eventos descartados com a fila cheia ({})".format(self.dropped, self.path))
+            self.dropped = 0
+
+    ##############################
+    # Thread de gravação         #
+    ##############################
+    def writer(self):
+        with open(self.path, 'ab') as f:
+            if self.format == 'binary':
+                f.write(RECORD.pack(self.wall0, SESSION, 0, 0, 0, 0, 0, 0))
+            stop = False
+            while not stop:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + FLUSH_AFTER
+                while len(batch) < BATCH_SIZE and batch[-1] is not None:
+                    try:
+                        batch.append(self.queue.get(timeout=max(0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+                if batch[-1] is None:
+                    stop = True
+                    batch.pop()
+                f.write(b''.join(self.encode(e) for e in batch))
+                f.flush()
+                for _ in range(len(batch) + stop):
+                    self.queue.task_done()
+
+    def encode(self, e):
+        t, event_type, message_type, size, packet_number, total_packets, crc = e
+        if self.format == 'binary':
+            full = packet_number is not None and total_packets is not None and crc is not None
+            return(RECORD.pack(t, EVENTS.index(event_type), message_type, size,
+                               packet_number or 0, total_packets or 0, crc or 0, full))
+        if self.format == 'jsonl':
+            record = {'t': round(self.wall0 + t, 6), 'event': event_type, 'type': message_type, 'size': size}
+            if packet_number is not None and total_packets is not None and crc is not None:
+                record.update({'packet': packet_number, 'total': total_packets, 'crc': crc})
+            return((json.dumps(record) + "\n").encode())
+        return((text_line(self.wall0 + t, event_type, message_type, size,
+                          packet_number, total_packets, crc) + "\n").encode())
+
+def text_line(wall, event_type, message_type, size, packet_number=None, total_packets=None, crc=None):
+    """ Linha no formato antigo de client_log.txt/server_log.txt
+    """
+    timestamp = datetime.datetime.fromtimestamp(wall).strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
+    line = f"{timestamp} / {event_type} / {message_type} / {size}"
+    if packet_number is not None and total_packets is not None and crc is not None:
+        line += f" / {packet_number} / {total_packets} / {crc:04X}"
+    return(line)
+
+def read(path):
+    """ Gera (horário, evento, tipo, tamanho, pacote, total, CRC) de um
+        registro binário ou jsonl
+    """
+    if path.endswith('.jsonl'):
+        with open(path) as f:
+            for line in f:
+                r = json.loads(line)
+                yield (r['t'], r['event'], r['type'], r['size'], r.get('packet'), r.get('total'), r.get('crc'))
+        return
+    wall0 = 0.0
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(RECORD.size)
+            if len(data) < RECORD.size:
+                return  # Fim (ou última escrita interrompida)
+            t, event, message_type, size, packet_number, total_packets, crc, full = RECORD.unpack(data)
+            if event == SESSION:
+                wall0 = t
+            elif full:
+                yield (wall0 + t, EVENTS[event], message_type, size, packet_number, total_packets, crc)
+            else:
+                yield (wall0 + t, EVENTS[event], message_type, size, None, None, None)
+
+def export(path, out):
+    """ Escreve em out o registro de path no formato de texto antigo
+    """
+    for e in read(path):
+        out.write(text_line(*e) + "\n")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+    if len(sys.argv) > 2:
+        with open(sys.argv[2], 'w') as out:
+            export(sys.argv[1], out)
+    else:
+        export(sys.argv[1], sys.stdout)
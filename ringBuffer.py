@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Camada de Enlace - buffer circular de recepção
+####################################################
+
+# Class
+class RingBuffer(object):
+    """ Buffer circular de capacidade fixa
+
+    A memória é alocada uma única vez (bytearray) e acessada via
+    memoryview, então escrever e consumir não realocam nem copiam
+    o restante do buffer. Não é thread-safe: quem compartilha o
+    buffer entre threads deve proteger as chamadas com um lock.
+
+    overflow define o que fazer quando uma escrita não cabe:
+      'drop'      descarta os bytes novos que não couberem
+      'overwrite' descarta os bytes mais antigos
+      'raise'     levanta BufferError sem escrever nada
+    """
+
+    POLICIES = ('drop', 'overwrite', 'raise')
+
+    def __init__(self, capacity, highWater=None, overflow='drop'):
+        if overflow not in self.POLICIES:
+            raise ValueError("overflow deve ser um de {}".format(self.POLICIES))
+        self.capacity  = capacity
+        self.highWater = capacity if highWater is None else min(highWater, capacity)
+        self.overflow  = overflow
+        self.data      = bytearray(capacity)
+        self.view      = memoryview(self.data)
+        self.head      = 0      # Índice do byte mais antigo
+        self.size      = 0      # Bytes armazenados
+        self.dropped   = 0      # Bytes perdidos por overflow
+        self.peak      = 0      # Maior ocupação observada
+
+    def __len__(self):
+        return(self.size)
+
+    def free(self):
+        return(self.capacity - self.size)
+
+    def isAboveHighWater(self):
+        return(self.size >= self.highWater)
+
+    def write(self, data):
+        """ Copia data para o buffer e retorna quantos bytes entraram
+        """
+        n = len(data)
+        if n > self.free():
+            if self.overflow == 'raise':
+                raise BufferError("RingBuffer cheio: {} livres, {} recebidos".format(self.free(), n))
+            elif self.overflow == 'overwrite':
+                if n > self.capacity:
+                    self.dropped += n - self.capacity
+                    data = memoryview(data)[n - self.capacity:]
+                    n    = self.capacity
+                lost = n - self.free()
+                self.consume(lost)
+                self.dropped += lost
+            else:
+                self.dropped += n - self.free()
+                n = self.free()
+        if n == 0:
+            return(0)
+
+        src   = memoryview(data)
+        tail  = (self.head + self.size) % self.capacity
+        first = min(n, self.capacity - tail)
+        self.view[tail:tail + first] = src[:first]
+        if first < n:
+            self.view[0:n - first] = src[first:n]
+        self.size += n
+        self.peak  = max(self.peak, self.size)
+        return(n)
+
+    def peekViews(self, nData):
+        """ Retorna até nData bytes como (view1, view2) sem copiar
+
+        view2 só não é vazia quando os dados dão a volta no fim
+        do buffer. As views ficam válidas até o próximo consume, ou
+        até o próximo write com overflow='overwrite'; com outra thread
+        escrevendo, use peek (uma cópia) com o mesmo lock.
+        """
+        n     = min(nData, self.size)
+        first = min(n, self.capacity - self.head)
+        return(self.view[self.head:self.head + first], self.view[0:n - first])
+
+    def peek(self, nData):
+        """ Retorna uma cópia de até nData bytes sem consumi-los
+        """
+        a, b = self.peekViews(nData)
+        if len(b) == 0:
+            return(bytes(a))
+        return(bytes(a) + bytes(b))
+
+    def consume(self, nData):
+        """ Descarta até nData bytes do início sem copiar
+        """
+        n = min(nData, self.size)
+        self.head = (self.head + n) % self.capacity
+        self.size -= n
+        if self.size == 0:
+            self.head = 0
+        return(n)
+
+    def read(self, nData):
+        b = self.peek(nData)
+        self.consume(len(b))
+        return(b)
+
+    def clear(self):
+        self.head = 0
+        self.size = 0
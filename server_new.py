@@ -1,138 +1,679 @@
+import os
+import sys
+import json
+import shutil
 import time
-import datetime
 import binascii
+import tempfile
+import itertools
+import collections
 from enlace import *
+from deframer import Deframer
+from interfaceFisica import EmHex
+import registro
+import compressao
+import fec
+import protocolo
+import lote
+import velocidade
 
 serialName = "COM6"  # Altere para a porta correta
 com2 = enlace(serialName)
 
-EOP = b'\xAA\xBB\xCC'  # 3 bytes
+# Registro de eventos: 'text' (server_log.txt), 'binary' (server_log.bin) ou 'jsonl'
+LOG_FORMAT = 'text'
+log = registro.Registro('server_log', LOG_FORMAT)
+
+EOP = protocolo.EOP  # 3 bytes
+MAX_PAYLOAD = 4096       # Maior payload aceito no handshake (o campo do HEAD vai até 65535)
+MAX_WINDOW = 16          # Maior janela (selective repeat) aceita no handshake
+LINGER_TIME = 6          # Silêncio (s) exigido antes de encerrar; cobre o timeout de 5 s do cliente
+OUTPUT_FILE = 'arquivo_recebido.txt'
+CHECKPOINT_INTERVAL = 1.0  # Segundos entre gravações do checkpoint
+BATCH_SUFFIX = '.lote-'   # Diretório do lote separado: <OUTPUT_FILE sem extensão>.lote-XXXXXXXX
+IDLE_TIMEOUT = 30        # Espera (s) pelo handshake, que pode chegar antes de a sessão começar
+SYNC_WAIT = 1.0          # Bytes sem preâmbulo por esse tempo: realinha a leitura (fisica.realign)
+REPLY_INTERVAL = 1.0     # Espera (s) sem pacote do cliente antes de repetir a resposta do handshake
+REPLY_REPEATS = 8        # Repetições da resposta; cobrem as tentativas do cliente (~9 s)
+
+# Capacidades do byte 10 do handshake
+FLAG_BINARY = 0x01       # Codificação binária com byte-stuffing no fio
+FLAG_HEAD_CRC = 0x02     # CRC cobre também o HEAD (inclusive de ACK/NACK)
+FLAG_RESUME = 0x04       # Pedido de retomada (tipo 6) antes dos dados
+FLAG_COMPRESS = 0x08     # Payloads comprimidos; o codec vai no byte 11
+FLAG_FEC = 0x10          # Paridade XOR a cada k pacotes; k vai no byte 0
+FLAG_BATCH = 0x20        # Manifesto + vários arquivos num fluxo só (ver lote.py)
+FLAG_BAUD = 0x40         # Troca de velocidade; as velocidades vão nos bytes 6-7 (ver velocidade.py)
+FLAG_SYNC = 0x80         # Resposta do handshake repetida até o primeiro pacote (ver expect_handshake)
+SUPPORTED_FLAGS = (FLAG_BINARY | FLAG_HEAD_CRC | FLAG_RESUME | FLAG_COMPRESS | FLAG_FEC | FLAG_BATCH |
+                   FLAG_BAUD | FLAG_SYNC)
+
+# Motivo do NACK, no byte 9 (clientes antigos ignoram)
+NACK_ORDER = 1
+NACK_SIZE = 2
+NACK_CRC = 3
+NACK_NAMES = {NACK_ORDER: 'order', NACK_SIZE: 'size', NACK_CRC: 'crc'}
+
+# Snapshot periódico de com2.metrics (ver metricas.py); None desliga
+METRICS_INTERVAL = None
+METRICS_FILE = 'server_metrics.jsonl'
+
+# Velocidade da sessão atual (velocidade.Velocidade); None sem FLAG_BAUD
+speed = None
+
+# O que a última sessão recebeu (OUTPUT_FILE ou o diretório do lote); None se nada
+received_path = None
+
+# Resposta do handshake (HandshakeReply) enquanto o cliente pode não a ter
+# recebido; None depois do primeiro pacote dele (ver expect_handshake)
+handshake_reply = None
 
 def is_datagram_complete(data):
     """Verifica se o datagrama está completo (HEAD + EOP)"""
-    return data[-3:] == EOP
+    return len(data) >= protocolo.OVERHEAD and data[-3:] == EOP
+
+def send_nack(packet_number, cause=0, protect=False):
+    nack_datagram = create_nack_datagram(packet_number, cause, protect)
+    com2.sendData(nack_datagram, priority=True)
+    com2.metrics.count('server.nack.' + NACK_NAMES.get(cause, 'other'))
+    log_event('envio', 5, len(nack_datagram))
+
+def send_ack(packet_number, protect=False):
+    ack_datagram = create_ack_datagram(packet_number, protect)
+    com2.sendData(ack_datagram, priority=True)
+    log_event('envio', 4, len(ack_datagram))
+
+def send_baud(operation, index, payload=b''):
+    baud_datagram = protocolo.encode(0, 0, velocidade.MESSAGE_TYPE, payload, index, operation, protect=True)
+    com2.sendData(baud_datagram, priority=True)
+    log_event('envio', velocidade.MESSAGE_TYPE, len(baud_datagram))
+
+class Checkpoint:
+    """Progresso de uma recepção gravado ao lado do arquivo parcial
+
+    Como os payloads são gravados em ordem, o que foi verificado é sempre
+    um prefixo do arquivo: basta guardar seu tamanho e um CRC-32 corrente,
+    que o cliente confere contra o próprio arquivo antes de retomar.
+    """
+    def __init__(self, path):
+        self.path = path + '.ckpt'
+        self.data_path = path
+        self.identity = None    # Nome, tamanho e data do arquivo do cliente
+        self.size = 0
+        self.offset = 0         # Bytes verificados e gravados
+        self.digest = 0         # CRC-32 desses bytes
+        self.packets = 0        # Pacotes recebidos, somando todas as sessões
+        self.start = 0          # offset/digest no início desta sessão
+        self.start_digest = 0
+        self.saved_at = 0
+
+    def load(self, identity, size, restart=False):
+        """Retoma o checkpoint de identity, se houver um válido"""
+        self.identity, self.size = identity, size
+        self.offset = self.digest = self.packets = 0
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+            if (not restart and saved['identity'] == identity and
+                    os.path.getsize(self.data_path) >= saved['offset']):
+                self.offset, self.digest, self.packets = saved['offset'], saved['digest'], saved['packets']
+        except (OSError, ValueError, KeyError):
+            pass
+        self.start, self.start_digest = self.offset, self.digest
+
+    def advance(self, payload):
+        self.offset += len(payload)
+        self.digest = binascii.crc32(payload, self.digest)
+        self.packets += 1
+
+    def save(self, force=False):
+        """Grava o checkpoint (no máximo a cada CHECKPOINT_INTERVAL)"""
+        if not force and time.time() - self.saved_at < CHECKPOINT_INTERVAL:
+            return
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump({'identity': self.identity, 'size': self.size, 'offset': self.offset,
+                       'digest': self.digest, 'packets': self.packets}, f)
+        os.replace(self.path + '.tmp', self.path)
+        self.saved_at = time.time()
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+def send_resume(checkpoint, protect=False):
+    resume_datagram = create_resume_datagram(checkpoint.start, checkpoint.start_digest, protect)
+    com2.sendData(resume_datagram)
+    log_event('envio', 7, len(resume_datagram))
+
+def negotiate_resume(deframer, checkpoint, head_crc):
+    """Responde pedidos de retomada (tipo 6) até chegar o primeiro pacote de dados
 
-def calculate_crc(payload):
-    crc = binascii.crc_hqx(payload, 0xFFFF)
-    return crc
+    Retorna esse pacote, b"" se o arquivo já estiver completo ou None se
+    o RX for parado.
+    """
+    for datagram in watch_speed(deframer):
+        if not is_datagram_complete(datagram):
+            continue
+        fields = protocolo.HEAD.unpack_from(datagram)
+        payload = datagram[12:-3]
+        if fields[4] == 3:
+            return datagram
+        if fields[4] == velocidade.MESSAGE_TYPE and speed:
+            receive_baud(datagram, deframer)
+            continue
+        if fields[4] != 6 or len(payload) < 16:
+            continue
+        if fields[3] != protocolo.frame_crc(fields, payload, head_crc):
+            print('Servidor: Pedido de retomada corrompido, ignorando')
+            continue
+        log_event('receb', 6, len(datagram))
+        size, mtime = protocolo.RESUME_REQUEST.unpack_from(payload)
+        identity = [payload[16:].decode(errors='replace'), size, mtime]
+        checkpoint.load(identity, size, restart=fields[5] == 1)
+        if checkpoint.start:
+            print(f'Servidor: Retomando {identity[0]} a partir do byte {checkpoint.start}')
+        send_resume(checkpoint, head_crc)
+        if checkpoint.start == size:
+            return b""
+    return None
 
-def receive_file():
-    """Recebe um arquivo fragmentado em pacotes"""
-    all_data = bytearray()
+def receive_file(window_size=1, max_payload=MAX_PAYLOAD, head_crc=False, resume=False, codec=0,
+                 fec_group=0):
+    """Recebe um arquivo fragmentado em pacotes
+
+    Com window_size > 1 (selective repeat), pacotes que chegam fora de ordem
+    dentro da janela ficam guardados e são confirmados individualmente.
+
+    Com head_crc o cliente pode variar o tamanho dos pacotes: total_packets
+    passa a ser uma estimativa e o último pacote é o que traz
+    packet_number == total_packets.
+
+    Os payloads vão para o disco assim que chegam em ordem; só os que
+    chegam adiantados (no máximo uma janela) ficam em memória.
+
+    Com resume, o cliente primeiro pergunta de onde continuar; o progresso
+    fica num Checkpoint e a numeração dos pacotes recomeça em 1 a partir
+    do primeiro byte que falta.
+
+    Com codec, os payloads são o fluxo de compressao.Compressor e só os
+    blocos já completos são gravados (e contam no checkpoint).
+
+    Com fec_group, um pacote corrompido ou perdido é reconstruído pela
+    paridade do seu grupo quando possível (ver fec.py).
+
+    Retorna True se o arquivo chegou inteiro.
+    """
+    # A paridade do FEC tem fec.PARITY_HEAD bytes a mais que o maior pacote
+    frame_payload = max_payload + fec.PARITY_HEAD if fec_group else max_payload
+    deframer = Deframer(com2.rx, frame_payload)
+    decoder = compressao.Descompressor(codec) if codec else None
+    checkpoint = None
+    first = None
+    if resume:
+        checkpoint = Checkpoint(OUTPUT_FILE)
+        first = negotiate_resume(deframer, checkpoint, head_crc)
+        if first is None:
+            return False
+    with open(OUTPUT_FILE, 'r+b' if checkpoint and checkpoint.start else 'wb') as output:
+        if checkpoint:
+            output.truncate(checkpoint.start)
+            output.seek(checkpoint.start)
+        if first == b"":
+            last_packet = 0  # Nada falta: o cliente não manda pacotes
+        else:
+            last_packet = write_packets(output, deframer, first, window_size, head_crc, checkpoint, decoder,
+                                        fec_group)
+    if decoder and last_packet is not None and not decoder.complete():
+        print("Servidor: Fluxo comprimido terminou no meio de um bloco")
+    if checkpoint and last_packet is not None:
+        checkpoint.remove()
+    linger(last_packet, frame_payload, head_crc, checkpoint)
+    return last_packet is not None
+
+def store(output, payload, checkpoint=None, decoder=None):
+    """Grava um payload recebido em ordem (descomprimido, se for o caso)"""
+    data = decoder.feed(payload) if decoder else payload
+    output.write(data)
+    com2.metrics.count('server.payload_bytes', len(data))
+    if checkpoint:
+        checkpoint.advance(data)
+
+def with_injected(frames, injected):
+    """Entrega os pacotes reconstruídos pelo FEC logo depois do pacote
+    que permitiu reconstruí-los, como se tivessem chegado"""
+    for datagram in frames:
+        yield datagram
+        while injected:
+            yield injected.popleft()
+
+def write_packets(output, deframer, first, window_size, head_crc, checkpoint=None, decoder=None,
+                  fec_group=0):
+    """Recebe os pacotes e grava os payloads em output
+
+    first é um pacote já lido do deframer (ou None). Retorna o número do
+    último pacote, ou None se o RX for parado antes do fim.
+    """
     expected_packet = 1
     total_packets = None
+    last_packet = None      # Número do último pacote, quando conhecido
+    out_of_order = {}       # Pacote -> payload aguardando os anteriores
+    nacked_gap = None       # Último pacote faltante já pedido por NACK
+    recovery = fec.Recuperador(fec_group) if fec_group else None
+    injected = collections.deque()  # Pacotes reconstruídos pelo FEC
+    frames = watch_speed(deframer)
+    if first is not None:
+        frames = itertools.chain([first], frames)
+    frames = with_injected(frames, injected)
 
-    while True:
-        datagram, _ = com2.getData(1024)  # Ajuste o tamanho do buffer conforme necessário
-        
+    for datagram in frames:
         if is_datagram_complete(datagram):
-            head = datagram[:12]
-            packet_number = int.from_bytes(head[0:2], 'big')
-            total_packets = int.from_bytes(head[2:4], 'big') if total_packets is None else total_packets
-            payload_size = int.from_bytes(head[4:6], 'big')
-            crc_received = int.from_bytes(head[6:8], 'big')
-            message_type = head[8]
-            payload = datagram[12:-3]  # Exclui o EOP
+            fields = protocolo.HEAD.unpack_from(datagram)
+            message_type = fields[4]
+            if message_type == 6 and checkpoint:
+                # A resposta de retomada se perdeu: o cliente pergunta de novo
+                send_resume(checkpoint, head_crc)
+                continue
+            if message_type == fec.MESSAGE_TYPE and recovery:
+                receive_parity(datagram, recovery, expected_packet, injected)
+                nack_overdue(recovery)
+                continue
+            if message_type == velocidade.MESSAGE_TYPE and speed:
+                receive_baud(datagram, deframer)
+                continue
+            if message_type != 3:
+                continue
+            packet_number, total_field, payload_size, crc_received = fields[:4]
+            total_packets = total_field if total_packets is None or head_crc else total_packets
+            if not head_crc:
+                last_packet = total_packets
+            payload = protocolo.payload(datagram)  # Exclui o EOP, sem copiar
 
             log_event('receb', message_type, len(datagram), packet_number, total_packets, crc_received)
-            
-            # Verificar se o pacote está fora de ordem
-            if packet_number != expected_packet:
+
+            # Pacote já entregue (ACK perdido): confirma de novo
+            if packet_number < expected_packet:
+                print(f'Servidor: Pacote {packet_number} duplicado, reenviando ACK')
+                com2.metrics.count('server.duplicates')
+                send_ack(packet_number, head_crc)
+                continue
+
+            # Verificar se o pacote está fora da janela
+            if packet_number >= expected_packet + window_size:
                 print(f'Servidor: Erro na ordem dos pacotes. Esperado {expected_packet}, recebido {packet_number}')
-                nack_datagram = create_nack_datagram(expected_packet)
-                com2.sendData(nack_datagram)
-                log_event('envio', 5, len(nack_datagram))
+                send_nack(expected_packet, NACK_ORDER, head_crc)
                 continue  # Aguarda o reenvio do pacote correto
 
+            # Com FEC, o NACK de um pacote ruim espera a paridade do grupo
+            hold_nack = recovery is not None and recovery.hold(packet_number)
+
             # Verificar se o tamanho do payload é correto
             if len(payload) != payload_size:
                 print(f'Servidor: Erro no tamanho do payload. Recebido {len(payload)}, esperado {payload_size}')
-                nack_datagram = create_nack_datagram(expected_packet)
-                com2.sendData(nack_datagram)
-                log_event('envio', 5, len(nack_datagram))
+                if not hold_nack:
+                    send_nack(packet_number, NACK_SIZE, head_crc)
                 continue  # Aguarda o reenvio do pacote correto
 
-            # Calcular o CRC do payload
-            crc_calculated = calculate_crc(payload)
+            # Calcular o CRC do payload (e do HEAD, se negociado)
+            crc_calculated = protocolo.frame_crc(fields, payload, head_crc)
             if crc_received != crc_calculated:
                 print(f'Servidor: Erro no CRC. Recebido {crc_received}, calculado {crc_calculated}')
-                nack_datagram = create_nack_datagram(expected_packet)
-                com2.sendData(nack_datagram)
-                log_event('envio', 5, len(nack_datagram))
+                if not hold_nack:
+                    send_nack(packet_number, NACK_CRC, head_crc)
                 continue  # Aguarda o reenvio do pacote correto
 
-            # Se o pacote está correto, adiciona o payload e envia ACK
-            all_data.extend(payload)
+            # Se o pacote está correto, envia ACK
             print(f'Servidor: Pacote {packet_number}/{total_packets} recebido corretamente.')
+            com2.metrics.count('server.packets')
+            send_ack(packet_number, head_crc)
+            if packet_number == total_packets:
+                last_packet = packet_number
+            if recovery:
+                rebuilt = recovery.received(packet_number, total_packets, payload)
+                if rebuilt:
+                    inject(injected, *rebuilt)
+                nack_overdue(recovery)
 
-            # Enviar ACK
-            ack_datagram = create_ack_datagram(packet_number)
-            com2.sendData(ack_datagram)
-            log_event('envio', 4, len(ack_datagram))
+            if packet_number != expected_packet:
+                # Fora de ordem mas dentro da janela: guarda e pede só o que falta
+                out_of_order[packet_number] = payload
+                com2.metrics.count('server.out_of_order')
+                if nacked_gap != expected_packet and not (recovery and recovery.waiting(expected_packet)):
+                    print(f'Servidor: Pacote {expected_packet} faltando, guardando {packet_number}')
+                    send_nack(expected_packet, NACK_ORDER, head_crc)
+                    nacked_gap = expected_packet
+                continue
 
-            if packet_number == total_packets:
+            store(output, payload, checkpoint, decoder)
+            expected_packet += 1
+            while expected_packet in out_of_order:
+                store(output, out_of_order.pop(expected_packet), checkpoint, decoder)
+                expected_packet += 1
+            output.flush()  # Uma queda não perde o que já foi confirmado
+            if checkpoint:
+                checkpoint.save()
+            if recovery:
+                recovery.release(expected_packet)
+
+            if last_packet is not None and expected_packet > last_packet:
                 print("Servidor: Todos os pacotes recebidos")
-                break
+                if recovery:
+                    counters = com2.metrics.snapshot()['counters']
+                    nacks = sum(v for name, v in counters.items() if name.startswith('server.nack.'))
+                    print(f'Servidor: FEC reconstruiu {recovery.recovered} pacotes; '
+                          f'{recovery.unrecoverable} grupos não bastaram; {nacks} NACKs enviados')
+                return last_packet
 
-            expected_packet += 1
+    if checkpoint:
+        checkpoint.save(force=True)
+    return None
+
+def receive_parity(datagram, recovery, expected_packet, injected):
+    """Trata um pacote de paridade do FEC
+
+    Se só um pacote do grupo falta, ele é reconstruído e vai para
+    injected; senão, pede por NACK cada um que falta.
+    """
+    fields = protocolo.HEAD.unpack_from(datagram)
+    first, count, size, crc_received = fields[:4]
+    payload = protocolo.payload(datagram)
+    log_event('receb', fec.MESSAGE_TYPE, len(datagram))
+    if len(payload) != size or crc_received != protocolo.frame_crc(fields, payload, True):
+        print('Servidor: Paridade corrompida, ignorando')
+        return
+    rebuilt, missing = recovery.parity(first, count, payload, expected_packet)
+    if rebuilt:
+        inject(injected, *rebuilt)
+    elif missing:
+        com2.metrics.count('server.fec_unrecoverable')
+        print(f'Servidor: Paridade do grupo {first} não basta, faltam {missing}')
+        for packet_number in missing:
+            if packet_number >= expected_packet:
+                send_nack(packet_number, NACK_ORDER, True)
+
+def intact(datagram):
+    """Se o datagrama chegou com tamanho e CRC (com o HEAD) corretos"""
+    if not is_datagram_complete(datagram):
+        return False
+    fields = protocolo.HEAD.unpack_from(datagram)
+    payload = protocolo.payload(datagram)
+    return len(payload) == fields[2] and fields[3] == protocolo.frame_crc(fields, payload, True)
+
+class HandshakeReply(object):
+    """Resposta do handshake, montada uma vez e enviada sempre em hex
+    (EmHex): o cliente que não a recebeu continua lendo em hex, mesmo
+    que este lado já tenha passado para o modo binário"""
+
+    def __init__(self, datagram, repeats=0):
+        self.datagram = EmHex(datagram)
+        self.repeats = repeats      # Repetições que ainda podem ser enviadas
+        self.sent_at = None
+
+    def send(self):
+        com2.sendData(self.datagram)
+        log_event('envio', 2, len(self.datagram))
+        self.sent_at = time.time()
+
+def expect_handshake(deframer, timeout=None):
+    """deframer.getFrame(timeout), mas repetindo a resposta do handshake
+    a cada REPLY_INTERVAL enquanto o cliente pode não a ter recebido
+
+    O cliente só manda dados, retomada ou velocidade depois de receber
+    a resposta: o primeiro desses datagramas encerra as repetições. Os
+    handshakes repetidos pelo cliente não são procurados; no modo
+    binário eles nem chegam como datagramas."""
+    global handshake_reply
+    deadline = None if timeout is None else time.time() + timeout
+    while handshake_reply is not None and handshake_reply.repeats:
+        due = handshake_reply.sent_at + REPLY_INTERVAL
+        wait = max(0, due - time.time())
+        if deadline is not None:
+            wait = min(wait, max(0, deadline - time.time()))
+        datagram = deframer.getFrame(wait)
+        if datagram is not None:
+            if is_datagram_complete(datagram) and datagram[8] in (3, 6, velocidade.MESSAGE_TYPE):
+                handshake_reply = None
+            return datagram
+        if com2.rx.threadStop or (deadline is not None and time.time() >= deadline):
+            return None
+        if time.time() >= due:
+            print('Servidor: Nenhum pacote depois do handshake, repetindo a resposta')
+            com2.metrics.count('server.handshake_repeats')
+            handshake_reply.repeats -= 1
+            handshake_reply.send()
+    return deframer.getFrame(None if deadline is None else max(0, deadline - time.time()))
+
+def watch_speed(deframer):
+    """Os datagramas de deframer.frames(), mas fora da velocidade do
+    handshake volta para ela se nenhum datagrama íntegro chegar em
+    velocidade.SILENCE (o cliente faz o mesmo)
+
+    Até o primeiro pacote, repete a resposta do handshake (ver
+    expect_handshake)."""
+    heard = time.time()
+    while True:
+        tuned = speed is not None and speed.tuned()
+        timeout = max(0, heard + velocidade.SILENCE - time.time()) if tuned else None
+        datagram = expect_handshake(deframer, timeout)
+        if datagram is None:
+            if not tuned or com2.rx.threadStop:
+                return
+            print(f'Servidor: Nada íntegro a {speed.rate()} baud em {velocidade.SILENCE} s, '
+                  f'voltando para {speed.base}')
+            speed.fallback()
+            heard = time.time()
+            continue
+        ok = not tuned or intact(datagram)
+        yield datagram
+        if ok:
+            heard = time.time()
+
+def receive_baud(datagram, deframer):
+    """Trata um datagrama de velocidade (tipo 11, ver velocidade.py)
+
+    Um REQUEST é confirmado com ACCEPT ainda na velocidade atual; depois
+    da troca, o PROBE precisa chegar íntegro em SWITCH_TIMEOUT, senão
+    volta para a velocidade anterior. Um PROBE repetido (o ECHO se
+    perdeu) é ecoado de novo.
+    """
+    if not intact(datagram):
+        print('Servidor: Pedido de velocidade corrompido, ignorando')
+        return
+    log_event('receb', velocidade.MESSAGE_TYPE, len(datagram))
+    _, _, _, _, _, index, operation, _ = protocolo.HEAD.unpack_from(datagram)
+    if operation == velocidade.PROBE:
+        send_baud(velocidade.ECHO, index, protocolo.payload(datagram))
+        return
+    if operation != velocidade.REQUEST or index >= len(velocidade.RATES) or \
+            velocidade.RATES[index] not in speed.rates:
+        return
+    previous, rate = speed.rate(), velocidade.RATES[index]
+    send_baud(velocidade.ACCEPT, index)
+    speed.set(rate)
+    deadline = time.time() + velocidade.SWITCH_TIMEOUT
+    while True:
+        probe = deframer.getFrame(max(0, deadline - time.time()))
+        if probe is None:
+            break
+        if not intact(probe):
+            continue
+        _, _, _, _, message_type, probe_index, operation, _ = protocolo.HEAD.unpack_from(probe)
+        if message_type == velocidade.MESSAGE_TYPE and operation == velocidade.PROBE and probe_index == index:
+            send_baud(velocidade.ECHO, index, protocolo.payload(probe))
+            print(f'Servidor: Velocidade {rate} baud')
+            return
+    print(f'Servidor: Sem probe a {rate} baud, voltando para {previous}')
+    speed.set(previous)
+
+def nack_overdue(recovery):
+    """Pede os pacotes ruins cujo NACK esperava uma paridade perdida"""
+    for packet_number in recovery.overdue():
+        send_nack(packet_number, NACK_CRC, True)
 
-    # Salvar o arquivo recebido
-    with open('arquivo_recebido.txt', 'wb') as f:
-        f.write(all_data)
+def inject(injected, packet_number, total_packets, payload):
+    """Devolve ao laço de recepção um pacote reconstruído pelo FEC"""
+    print(f'Servidor: Pacote {packet_number} reconstruído pela paridade')
+    com2.metrics.count('server.fec_recovered')
+    injected.append(protocolo.encode(packet_number, total_packets, 3, payload, protect=True))
 
-def create_ack_datagram(packet_number):
+def linger(last_packet, max_payload, head_crc, checkpoint=None):
+    """O último ACK pode ter se perdido: continua confirmando reenvios até
+    o cliente ficar LINGER_TIME em silêncio"""
+    deframer = Deframer(com2.rx, max_payload)
+    while True:
+        datagram = deframer.getFrame(LINGER_TIME)
+        if datagram is None:
+            break
+        if not is_datagram_complete(datagram):
+            continue
+        packet_number, _, _, _, message_type, _, _, _ = protocolo.HEAD.unpack_from(datagram)
+        if message_type == 6 and checkpoint:
+            send_resume(checkpoint, head_crc)
+        elif message_type == velocidade.MESSAGE_TYPE and speed:
+            receive_baud(datagram, deframer)
+        elif message_type == 3:
+            if packet_number <= last_packet:
+                print(f'Servidor: Reenvio do pacote {packet_number} após o fim, reenviando ACK')
+                send_ack(packet_number, head_crc)
+
+def wait_handshake(timeout):
+    """Descarta o que chegar até o preâmbulo (protocolo.SYNC) e retorna
+    (datagrama de 15 bytes que vem depois, True), ou None no timeout
+
+    O handshake fixo de um cliente antigo, sem preâmbulo
+    (protocolo.LEGACY_HANDSHAKE), também vale: retorna (ele, False)."""
+    deframer = Deframer(com2.rx)
+    deadline = time.time() + timeout
+    options = [(protocolo.SYNC, protocolo.OVERHEAD), (protocolo.LEGACY_HANDSHAKE, 0)]
+    while time.time() < deadline:
+        discarded = deframer.discarded
+        sync, datagram = deframer.getSyncedAny(options, min(SYNC_WAIT, max(0, deadline - time.time())))
+        if sync is None:
+            if deframer.discarded > discarded:
+                # Chegaram bytes mas nenhum preâmbulo: lixo ou, no modo hex, desalinhamento
+                com2.fisica.realign()
+            continue
+        if sync == protocolo.LEGACY_HANDSHAKE:
+            return protocolo.LEGACY_HANDSHAKE, False
+        if is_datagram_complete(datagram):
+            return datagram, True
+        print('Servidor: Preâmbulo sem um datagrama completo, procurando o próximo')
+    return None
+
+def extract_batch():
+    """Separa o lote recebido em OUTPUT_FILE num diretório novo ao lado
+    dele (BATCH_SUFFIX); o fluxo só é apagado se todos os arquivos
+    conferem, senão o diretório é removido e o fluxo fica para a
+    retomada. Retorna o diretório, ou None se o lote não conferiu"""
+    stem = os.path.splitext(OUTPUT_FILE)[0]
+    directory = tempfile.mkdtemp(prefix=os.path.basename(stem) + BATCH_SUFFIX,
+                                 dir=os.path.dirname(stem) or '.')
+    try:
+        entries, bad = lote.extract(OUTPUT_FILE, directory)
+    except (ValueError, OSError) as e:
+        print(f'Servidor: Lote inválido: {e}')
+        shutil.rmtree(directory, ignore_errors=True)
+        return None
+    com2.metrics.count('server.batch_files', len(entries))
+    if bad:
+        print(f'Servidor: {len(bad)} arquivos do lote com tamanho ou CRC errado: {bad}')
+        shutil.rmtree(directory, ignore_errors=True)
+        return None
+    print(f'Servidor: Lote com {len(entries)} arquivos separado em {directory}')
+    os.remove(OUTPUT_FILE)
+    return directory
+
+def create_ack_datagram(packet_number, protect=False):
     """Cria um datagrama ACK"""
     message_type = 4  # ACK
-    head = (packet_number.to_bytes(2, 'big') +
-            b'\x00'*6 +
-            message_type.to_bytes(1, 'big') +
-            b'\x00'*3)
-    return head + EOP
-
-def create_nack_datagram(expected_packet):
-    """Cria um datagrama NACK solicitando o pacote correto"""
+    return protocolo.encode_empty(packet_number, message_type, protect=protect)
+
+def create_nack_datagram(expected_packet, cause=0, protect=False):
+    """Cria um datagrama NACK solicitando o pacote correto (motivo no byte 9)"""
     message_type = 5  # NACK
-    head = (expected_packet.to_bytes(2, 'big') +
-            b'\x00'*6 +
-            message_type.to_bytes(1, 'big') +
-            b'\x00'*3)
-    return head + EOP
+    return protocolo.encode_empty(expected_packet, message_type, cause, protect)
+
+def create_resume_datagram(offset, digest, protect=False):
+    """Cria a resposta de retomada: bytes já recebidos e seu CRC-32"""
+    message_type = 7  # Resposta de retomada
+    payload = protocolo.RESUME.pack(offset, digest)
+    return protocolo.encode(0, 0, message_type, payload, protect=protect)
 
 def log_event(event_type, message_type, size, packet_number=None, total_packets=None, crc=None):
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-    with open('server_log.txt', 'a') as log_file:
-        line = f"{timestamp} / {event_type} / {message_type} / {size}"
-        if packet_number is not None and total_packets is not None and crc is not None:
-            line += f" / {packet_number} / {total_packets} / {crc:04X}"
-        log_file.write(line + "\n")
+    """Registra o evento em segundo plano (ver registro.py)"""
+    log.event(event_type, message_type, size, packet_number, total_packets, crc)
 
 def main():
+    """Atende um handshake e recebe um arquivo em OUTPUT_FILE
+
+    Retorna True se o arquivo chegou inteiro, False se a recepção
+    falhou e None se nenhum handshake chegou.
+    """
+    global speed, handshake_reply, received_path
+    speed = handshake_reply = received_path = None
+    received = None
     try:
         com2.enable()
-        
-        # Receber byte de sacrifício e limpar buffer
-        print("Servidor: esperando 1 byte de sacrifício")
-        rxBuffer, nRx = com2.getData(1)
-        com2.rx.clearBuffer()
-        time.sleep(0.1)
+        if METRICS_INTERVAL:
+            com2.metrics.startDump(METRICS_INTERVAL, METRICS_FILE)
         
         print("Servidor: Aguardando handshake...\n")
 
-        # Aguardar handshake do cliente
-        datagram, _ = com2.getData(15)
-        if is_datagram_complete(datagram):
-            head = datagram[:12]
-            message_type = head[8]
+        # Aguardar handshake do cliente; o lixo antes do preâmbulo é descartado
+        handshake = wait_handshake(IDLE_TIMEOUT)
+        if handshake:
+            datagram, synced = handshake
+            group, proposed_payload, proposed_rates, message_type, window, flags, proposed_codec = \
+                protocolo.HANDSHAKE.unpack_from(datagram)
             log_event('receb', message_type, len(datagram))
             if message_type == 1:
                 print("Servidor: Handshake recebido, pronto para receber arquivo")
-                # Enviar resposta de handshake
+                # Janela (byte 9) e capacidades (byte 10) pedidas pelo cliente;
+                # clientes antigos mandam 0 nos dois
+                window_size = max(1, min(MAX_WINDOW, window))
+                flags &= SUPPORTED_FLAGS
+                # Codec (byte 11): só aceita compressão com um codec conhecido
+                codec = proposed_codec if proposed_codec in compressao.CODECS.values() else 0
+                if not (flags & FLAG_COMPRESS and codec):
+                    flags &= ~FLAG_COMPRESS
+                    codec = 0
+                # Grupo do FEC (byte 0): a janela precisa caber dois grupos,
+                # senão um NACK segurado espera a janela inteira; e o CRC no
+                # HEAD protege o número do pacote
+                fec_group = min(group, window_size // 2, fec.MAX_GROUP)
+                if not (flags & FLAG_FEC and flags & FLAG_HEAD_CRC and fec_group > 1):
+                    flags &= ~FLAG_FEC
+                    fec_group = 0
+                # Payload máximo (bytes 2-3): limitado também pelo buffer do RX,
+                # que deve comportar uma janela inteira de datagramas
+                max_payload = proposed_payload or MAX_PAYLOAD
+                max_payload = min(max_payload, MAX_PAYLOAD,
+                                  com2.rx.buffer.capacity // window_size - 15)
+                # Velocidades (bytes 6-7): as que os dois lados suportam; o CRC
+                # no HEAD é o que mostra que uma velocidade não serve
+                rates = [rate for rate in velocidade.rates_of(proposed_rates) if rate in com2.fisica.baudrates()]
+                if not (flags & FLAG_BAUD and flags & FLAG_HEAD_CRC and rates):
+                    flags &= ~FLAG_BAUD
+                    rates = []
+                # Enviar resposta de handshake com o que foi aceito
                 message_type = 2  # Handshake response
-                response_head = b'\x00'*8 + message_type.to_bytes(1, 'big') + b'\x00'*3
-                ack_datagram = response_head + EOP
-                com2.sendData(ack_datagram)
-                log_event('envio', message_type, len(ack_datagram))
-                receive_file()
+                ack_datagram = protocolo.encode_handshake(message_type, max_payload, window_size, flags,
+                                                          codec, fec_group, velocidade.mask_of(rates))
+                # Com o mesmo preâmbulo do handshake: o cliente antigo lê 15 bytes
+                # exatos. Só quem anuncia FLAG_SYNC recebe as repetições
+                handshake_reply = HandshakeReply((protocolo.SYNC if synced else b'') + ack_datagram,
+                                                 REPLY_REPEATS if flags & FLAG_SYNC else 0)
+                handshake_reply.send()
+                if flags & FLAG_BINARY:
+                    com2.setEncoding('binary')
+                if flags & FLAG_BAUD:
+                    speed = velocidade.Velocidade(com2, rates)
+                received = receive_file(window_size, max_payload, bool(flags & FLAG_HEAD_CRC),
+                                        bool(flags & FLAG_RESUME), codec, fec_group)
+                if received and flags & FLAG_BATCH:
+                    received_path = extract_batch()
+                    received = received_path is not None
+                elif received:
+                    received_path = OUTPUT_FILE
             else:
                 print("Servidor: Mensagem recebida não é handshake")
         else:
@@ -143,6 +684,16 @@ def main():
     except Exception as e:
         print("Servidor: Ocorreu um erro:", e)
         com2.disable()
+        received = bool(received)
+    finally:
+        if speed and speed.tuned():
+            speed.set(speed.base)  # A próxima sessão começa na velocidade do handshake
+        com2.metrics.stopDump()
+        log.close()  # Grava os eventos que ainda estão na fila
+    return received
 
 if __name__ == "__main__":
+    # Porta opcional na linha de comando, ex.: um pty criado por transporte.py
+    if len(sys.argv) > 1:
+        com2 = enlace(sys.argv[1])
     main()
@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Servidor de recepção contínua, várias portas
+####################################################
+"""
+Processo de longa duração que recebe arquivos por várias portas ao
+mesmo tempo, cada porta com suas sessões (um handshake, um arquivo)
+independentes das outras.
+
+Cada sessão roda server_new.main num processo próprio: server_new
+guarda o estado da sessão em variáveis do módulo (com2, log,
+OUTPUT_FILE), e um processo pode ser encerrado sem afetar as outras
+portas. O laço principal varre as portas, inicia sessões (no máximo
+workers ao mesmo tempo), recolhe as que terminam e encerra as que
+passam do limite de tempo ou de memória (RSS lido de /proc; onde não
+há /proc, só o de tempo vale). O limite é sobre o RSS e não sobre
+RLIMIT_AS porque cada thread reserva dezenas de MB de endereços.
+
+Arquivos de cada porta em dir (tag = nome da porta sem o diretório):
+
+  <tag>.parcial               recepção em andamento (e .ckpt, com RESUME)
+  <tag>-AAAAMMDD-HHMMSS.bin   arquivo completo, renomeado no fim da sessão
+  <tag>-AAAAMMDD-HHMMSS/      arquivos de um lote (ver lote.py), idem
+  <tag>.lote-XXXXXXXX/        lote sendo separado pela sessão; o de uma sessão
+                              encerrada no meio é apagado pela seguinte
+  <tag>_log.txt               eventos de todas as sessões (registro.py)
+  <tag>.out                   mensagens das sessões
+
+O .parcial tem nome fixo: uma sessão interrompida (queda, limite de
+tempo) é retomada pela seguinte na mesma porta se o cliente usa RESUME.
+
+Uso:
+  python servidor.py [-d dir] [-w workers] [-m MB] [-t s] porta [porta ...]
+  python servidor.py -d recebidos '/dev/ttyACM*' '/dev/ttyUSB*'
+
+Padrões glob são varridos a cada SCAN_INTERVAL: portas conectadas
+depois também são atendidas.
+"""
+
+import os
+import sys
+import glob
+import shutil
+import time
+import argparse
+import multiprocessing
+
+import server_new
+import registro
+from enlace import enlace
+from metricas import Metricas
+
+SCAN_INTERVAL   = 0.5     # Segundos entre varreduras das portas e sessões
+IDLE_TIMEOUT    = 30      # Espera (s) de uma sessão pelo primeiro byte antes de reabrir a porta
+SESSION_TIMEOUT = 3600    # Duração máxima (s) de uma sessão, contando a espera; None desliga
+MEMORY_LIMIT    = 256     # MB de memória (RSS) por sessão; None desliga
+RETRY_DELAY     = 5       # Espera (s) para reabrir uma porta depois de uma falha
+
+# Código de saída do processo da sessão
+DONE   = 0    # Arquivo recebido inteiro
+FAILED = 1    # Recepção falhou (ou a porta não abriu)
+IDLE   = 2    # Nenhum handshake
+
+def port_tag(port):
+    """ Nome da porta usado nos arquivos da sessão
+    """
+    return(os.path.basename(port.rstrip('/\\')) or port)
+
+def memory_mb(pid):
+    """ RSS do processo pid em MB, ou None se não há /proc
+    """
+    try:
+        with open('/proc/{}/statm'.format(pid)) as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return(None)
+    return(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024))
+
+def run_session(port, directory, idle_timeout, result):
+    """ Corpo do processo de uma sessão: server_new.main sobre port
+
+    Antes de sair, manda por result (ponta de um multiprocessing.Pipe)
+    o código da sessão e o caminho do que foi recebido (arquivo ou
+    diretório do lote), ou None.
+    """
+    base = os.path.join(directory, port_tag(port))
+    sys.stdout = sys.stderr = open(base + '.out', 'a', buffering=1)
+    server_new.com2 = enlace(port)
+    server_new.OUTPUT_FILE = base + '.parcial'
+    server_new.METRICS_FILE = base + '_metrics.jsonl'
+    server_new.log = registro.Registro(base + '_log', server_new.LOG_FORMAT)
+    server_new.IDLE_TIMEOUT = idle_timeout
+    print("==== {} sessão em {}".format(time.strftime('%Y-%m-%d %H:%M:%S'), port))
+    # Lote separado por uma sessão encerrada antes de informar o resultado:
+    # o .parcial continua lá, e o lote é separado de novo quando completar
+    for stale in glob.glob(glob.escape(base) + server_new.BATCH_SUFFIX + '*'):
+        shutil.rmtree(stale, ignore_errors=True)
+    received = server_new.main()
+    code = {True: DONE, False: FAILED, None: IDLE}[received]
+    result.send((code, server_new.received_path))
+    result.close()
+    sys.stdout.flush()
+    sys.exit(code)
+
+class Servidor(object):
+    """ Supervisor das sessões de um conjunto de portas
+    """
+
+    def __init__(self, patterns, directory='.', workers=None, memory_limit=MEMORY_LIMIT,
+                 session_timeout=SESSION_TIMEOUT, idle_timeout=IDLE_TIMEOUT):
+        self.patterns        = patterns
+        self.directory       = directory
+        self.workers         = workers          # None: uma sessão por porta
+        self.memory_limit    = memory_limit
+        self.session_timeout = session_timeout
+        self.idle_timeout    = idle_timeout
+        self.sessions        = {}   # Porta -> (processo, início, ponta de leitura do resultado)
+        self.retry_at        = {}   # Porta -> quando pode ser reaberta
+        self.last_start      = {}   # Porta -> início da última sessão (rodízio)
+        self.files           = []   # Arquivos completos recebidos
+        self.metrics         = Metricas()
+        self.metrics.gauge('servidor.sessions_active', lambda: len(self.sessions))
+        os.makedirs(directory, exist_ok=True)
+
+    def ports(self):
+        """ Portas atuais: padrões glob são expandidos a cada chamada
+        """
+        found = set()
+        for pattern in self.patterns:
+            if glob.has_magic(pattern):
+                found.update(glob.glob(pattern))
+            else:
+                found.add(pattern)
+        return(sorted(found))
+
+    def start(self, port):
+        result, sender = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=run_session, name='sessao-' + port_tag(port),
+                                          args=(port, self.directory, self.idle_timeout, sender))
+        process.start()
+        sender.close()  # Só o processo escreve: se ele morrer, a leitura vê EOF
+        now = time.monotonic()
+        self.sessions[port] = (process, now, result)
+        self.last_start[port] = now
+        self.metrics.count('servidor.sessions')
+
+    def collect(self, port):
+        """ Tira port das sessões; retorna o (código, caminho) que o
+            processo informou, ou (FAILED, None) se ele foi encerrado
+            antes de informar
+        """
+        process, _, result = self.sessions.pop(port)
+        try:
+            code, path = result.recv() if result.poll() else (FAILED, None)
+        except EOFError:
+            code, path = FAILED, None
+        result.close()
+        return(code, path)
+
+    def finish(self, port, code, path=None):
+        """ Trata o fim da sessão de port: code e path são o que a sessão
+            informou (ver run_session)
+        """
+        if code == DONE and path and os.path.exists(path):
+            base = os.path.join(self.directory, port_tag(port))
+            name = "{}-{}".format(base, time.strftime('%Y%m%d-%H%M%S'))
+            if not os.path.isdir(path):
+                name += '.bin'  # Um lote chega como diretório, um arquivo como .parcial
+            os.replace(path, name)
+            self.files.append(name)
+            self.metrics.count('servidor.files')
+            print("Servidor: {} recebido por {}".format(name, port))
+        elif code != IDLE:
+            # Falha ou limite (memória, tempo): o .parcial fica para a retomada
+            self.retry_at[port] = time.monotonic() + RETRY_DELAY
+            self.metrics.count('servidor.failures')
+            print("Servidor: sessão em {} falhou (código {})".format(port, code))
+
+    def step(self):
+        """ Recolhe as sessões encerradas, aplica o limite de tempo e
+            inicia sessões nas portas livres
+        """
+        now = time.monotonic()
+        for port, (process, started, _) in list(self.sessions.items()):
+            if not process.is_alive():
+                self.finish(port, *self.collect(port))
+            elif self.session_timeout and now - started > self.session_timeout:
+                print("Servidor: sessão em {} passou de {} s, encerrando".format(port, self.session_timeout))
+                self.metrics.count('servidor.timeouts')
+                self.kill(port)
+            elif self.memory_limit and (memory_mb(process.pid) or 0) > self.memory_limit:
+                print("Servidor: sessão em {} passou de {} MB, encerrando".format(port, self.memory_limit))
+                self.metrics.count('servidor.memory_kills')
+                self.kill(port)
+        free = sorted((p for p in self.ports() if p not in self.sessions and self.retry_at.get(p, 0) <= now),
+                      key=lambda p: self.last_start.get(p, 0))
+        for port in free:
+            if self.workers is not None and len(self.sessions) >= self.workers:
+                break
+            self.start(port)
+
+    def kill(self, port):
+        process = self.sessions[port][0]
+        process.terminate()
+        process.join(1)
+        self.finish(port, *self.collect(port))
+
+    def run(self, duration=None):
+        """ Atende as portas até Ctrl+C (ou por duration segundos)
+        """
+        end = None if duration is None else time.monotonic() + duration
+        try:
+            while end is None or time.monotonic() < end:
+                self.step()
+                time.sleep(SCAN_INTERVAL)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self):
+        for port, (process, _, _) in self.sessions.items():
+            process.terminate()
+        for port, (process, _, _) in self.sessions.items():
+            process.join(1)
+        self.sessions.clear()
+        counters = self.metrics.snapshot()['counters']
+        print("Servidor: {} sessões, {} arquivos, {} falhas ({} por tempo, {} por memória)".format(
+            counters.get('servidor.sessions', 0), counters.get('servidor.files', 0),
+            counters.get('servidor.failures', 0), counters.get('servidor.timeouts', 0),
+            counters.get('servidor.memory_kills', 0)))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recebe arquivos por várias portas seriais")
+    parser.add_argument('ports', nargs='+', help="portas ou padrões glob (ex.: '/dev/ttyACM*')")
+    parser.add_argument('-d', '--dir', default='recebidos', help="diretório dos arquivos recebidos")
+    parser.add_argument('-w', '--workers', type=int, default=None, help="sessões simultâneas (padrão: uma por porta)")
+    parser.add_argument('-m', '--memory', type=int, default=MEMORY_LIMIT, help="MB por sessão (0 desliga)")
+    parser.add_argument('-t', '--time', type=float, default=SESSION_TIMEOUT, help="segundos por sessão (0 desliga)")
+    args = parser.parse_args()
+    Servidor(args.ports, args.dir, args.workers, args.memory or None, args.time or None).run()
@@ -0,0 +1,31 @@
+import os
+import sys
+
+import pytest
+
+# Os módulos ficam na raiz do repositório, sem pacote
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from enlaceRx import RX
+
+
+class FisicaFalsa(object):
+    """ Só o que o Deframer pergunta à fisica do RX
+    """
+    def __init__(self, stuffed):
+        self.isStuffed = stuffed
+
+    def stuffed(self):
+        return(self.isStuffed)
+
+
+@pytest.fixture
+def rx_hex():
+    """ RX de verdade, sem a thread: o teste escreve direto no buffer
+    """
+    return(RX(FisicaFalsa(False)))
+
+
+@pytest.fixture
+def rx_binary():
+    return(RX(FisicaFalsa(True)))
@@ -0,0 +1,40 @@
+import pytest
+
+from client_new import RTO
+
+
+def test_first_sample_sets_srtt_and_rttvar():
+    rto = RTO(initial=1.0, min_rto=0.01, max_rto=5.0)
+    rto.sample(0.2)
+    assert rto.srtt == 0.2
+    assert rto.rttvar == 0.1
+    assert rto.rto == pytest.approx(0.2 + 4 * 0.1)
+
+
+def test_later_samples_are_smoothed():
+    rto = RTO(initial=1.0, min_rto=0.01, max_rto=5.0)
+    rto.sample(0.2)
+    rto.sample(0.4)
+    assert rto.rttvar == pytest.approx(0.75 * 0.1 + 0.25 * 0.2)
+    assert rto.srtt == pytest.approx(0.875 * 0.2 + 0.125 * 0.4)
+    assert rto.rto == pytest.approx(rto.srtt + 4 * rto.rttvar)
+
+
+def test_rto_is_clamped():
+    rto = RTO(initial=1.0, min_rto=0.5, max_rto=2.0)
+    rto.sample(0.01)
+    assert rto.rto == 0.5
+    rto.sample(10)
+    assert rto.rto == 2.0
+
+
+def test_backoff_doubles_up_to_max():
+    rto = RTO(initial=0.5, min_rto=0.1, max_rto=3.0)
+    rto.backoff()
+    assert rto.rto == 1.0
+    rto.backoff()
+    rto.backoff()
+    assert rto.rto == 3.0
+    # A próxima medida válida desfaz o backoff
+    rto.sample(0.1)
+    assert rto.rto == pytest.approx(0.1 + 4 * 0.05)
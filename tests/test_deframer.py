@@ -0,0 +1,125 @@
+import threading
+
+import protocolo
+from deframer import Deframer
+from interfaceFisica import stuff
+
+
+def frames(n, size=20):
+    return([protocolo.encode(i + 1, n, 3, bytes([i]) * size) for i in range(n)])
+
+
+def feed_later(rx, chunks, delay=0.02):
+    """ Escreve os pedaços no buffer do RX aos poucos, como a thread da porta
+    """
+    def run():
+        for chunk in chunks:
+            threading.Event().wait(delay)
+            with rx.condition:
+                rx.buffer.write(chunk)
+                rx.condition.notify_all()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return(thread)
+
+
+def test_parse_whole_frames(rx_hex):
+    sent = frames(3)
+    rx_hex.buffer.write(b''.join(sent))
+    deframer = Deframer(rx_hex)
+    assert [deframer.getFrame(0.1) for _ in sent] == sent
+    assert deframer.getFrame(0.05) is None
+    assert deframer.resyncs == 0
+
+
+def test_parse_split_frames(rx_hex):
+    sent = frames(2)
+    stream = b''.join(sent)
+    # Cortes dentro do HEAD, do payload e do EOP
+    chunks = [stream[:5], stream[5:14], stream[14:33], stream[33:34], stream[34:]]
+    deframer = Deframer(rx_hex, stallTimeout=1.0)
+    feed_later(rx_hex, chunks)
+    assert deframer.getFrame(2) == sent[0]
+    assert deframer.getFrame(2) == sent[1]
+
+
+def test_parse_wrong_size_resyncs_to_next_eop(rx_hex):
+    first, second = frames(2)
+    bad = bytearray(first)
+    bad[5] += 4     # HEAD diz 4 bytes a mais
+    rx_hex.buffer.write(bytes(bad) + second)
+    deframer = Deframer(rx_hex, stallTimeout=0.05)
+    # O trecho até o EOP sai como está, e o seguinte não se perde
+    assert deframer.getFrame(0.5) == bytes(bad)
+    assert deframer.getFrame(0.5) == second
+    assert deframer.resyncs == 1
+
+
+def test_parse_discards_garbage_before_frame(rx_hex):
+    sent = frames(1)[0]
+    rx_hex.buffer.write(b'\xFF' * 5 + sent)
+    deframer = Deframer(rx_hex, maxPayload=64, stallTimeout=0.05)
+    frame = deframer.getFrame(0.5)
+    # Sem HEAD coerente o trecho até o EOP é entregue; quem recebe o rejeita
+    assert frame.endswith(sent)
+    assert deframer.resyncs == 1
+
+
+def test_parse_stuffed_split(rx_binary):
+    sent = [protocolo.encode(1, 2, 3, b'\xAA\xBB\xCC' * 10), protocolo.encode(2, 2, 3, b'\x7D' * 5)]
+    stream = b''.join(stuff(f) for f in sent)
+    chunks = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+    deframer = Deframer(rx_binary, stallTimeout=1.0)
+    feed_later(rx_binary, chunks)
+    assert deframer.getFrame(2) == sent[0]
+    assert deframer.getFrame(2) == sent[1]
+    assert deframer.resyncs == 0
+
+
+def test_parse_stuffed_invalid_escape_drops_one_frame(rx_binary):
+    first, second = frames(2)
+    bad = stuff(first)
+    bad = bad[:14] + b'\x7D\x00' + bad[16:]
+    rx_binary.buffer.write(bad + stuff(second))
+    deframer = Deframer(rx_binary)
+    assert deframer.getFrame(0.5) == second
+    assert deframer.badEscapes == 1
+
+
+def test_parse_stuffed_counts_size_mismatch(rx_binary):
+    bad = bytearray(frames(1)[0])
+    bad[5] += 1
+    rx_binary.buffer.write(stuff(bytes(bad)))
+    deframer = Deframer(rx_binary)
+    assert deframer.getFrame(0.5) == bytes(bad)
+    assert deframer.resyncs == 1
+
+
+def test_stall_stuffed_keeps_next_frame(rx_binary):
+    first, second = frames(2)
+    broken = stuff(first)[:-3] + b'\xAA\x00\xCC'   # EOP estragado
+    rest = stuff(second)
+    rx_binary.buffer.write(broken + rest[:5])
+    deframer = Deframer(rx_binary, stallTimeout=0.05)
+    assert deframer.getFrame(0.08) is None      # Um stall só
+    assert rx_binary.getBufferLen() == 5
+    rx_binary.buffer.write(rest[5:])
+    assert deframer.getFrame(0.5) == second
+    assert deframer.discarded == len(broken)
+
+
+def test_get_synced_skips_garbage(rx_hex):
+    handshake = protocolo.encode_handshake(1, 1024, 8, 0, 0, 0)
+    rx_hex.buffer.write(b'\x00\x55lixo' + protocolo.SYNC + handshake)
+    deframer = Deframer(rx_hex)
+    assert deframer.getSynced(protocolo.SYNC, len(handshake), 0.5) == handshake
+
+
+def test_get_synced_any_takes_first_in_stream(rx_hex):
+    reply = protocolo.encode_handshake(2, 1024, 8, 0, 0, 0)
+    rx_hex.buffer.write(b'lixo' + protocolo.LEGACY_REPLY + protocolo.SYNC + reply)
+    deframer = Deframer(rx_hex)
+    options = [(protocolo.SYNC, len(reply)), (protocolo.LEGACY_REPLY, 0)]
+    assert deframer.getSyncedAny(options, 0.5) == (protocolo.LEGACY_REPLY, b'')
+    assert deframer.getSyncedAny(options, 0.5) == (protocolo.SYNC, reply)
+    assert deframer.getSyncedAny(options, 0.05) == (None, None)
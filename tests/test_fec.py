@@ -0,0 +1,29 @@
+import fec
+
+
+def parity_of(packets):
+    acc = fec.Paridade()
+    for total_packets, payload in packets:
+        acc.add(total_packets, payload)
+    return(acc.payload())
+
+
+def test_recover_each_missing_packet():
+    packets = [(4, b'a' * 10), (4, b'bb' * 30), (4, b''), (4, b'\xAA\xBB\xCC')]
+    parity = parity_of(packets)
+    assert len(parity) == fec.PARITY_HEAD + 60
+    for i in range(len(packets)):
+        others = packets[:i] + packets[i + 1:]
+        assert fec.recover(parity, others) == packets[i]
+
+
+def test_recover_rejects_incoherent_data():
+    packets = [(3, b'um'), (3, b'dois'), (3, b'tres')]
+    parity = parity_of(packets)
+    # Dois faltando: o XOR não fecha num pacote só
+    assert fec.recover(parity, packets[:1]) is None
+    assert fec.recover(b'\x00\x01', []) is None
+
+
+def test_group_of():
+    assert [fec.group_of(n, 4) for n in range(1, 10)] == [1, 1, 1, 1, 5, 5, 5, 5, 9]
@@ -0,0 +1,38 @@
+import pytest
+
+from interfaceFisica import stuff, unstuff, EOP, ESC
+
+import protocolo
+
+
+@pytest.mark.parametrize('body', [
+    b'',
+    b'texto simples',
+    EOP * 3,
+    ESC * 4,
+    bytes(range(256)),
+    b'\xAA\x7D\xAA\xBB\xCC\x7D\x8A',
+])
+def test_stuff_round_trip(body):
+    datagram = body + EOP
+    stuffed = stuff(datagram)
+    # O EOP só aparece cru no fim
+    assert stuffed.find(EOP[:1]) == len(stuffed) - len(EOP)
+    assert unstuff(stuffed[:-len(EOP)]) + EOP == datagram
+
+
+def test_stuff_accepts_memoryview():
+    datagram = protocolo.encode(1, 1, 3, b'\xAA\xBB\xCC\x7D')
+    assert stuff(memoryview(datagram)) == stuff(datagram)
+
+
+def test_stuff_without_final_eop_escapes_everything():
+    stuffed = stuff(b'ab' + EOP)
+    assert stuff(b'ab\xAA') == b'ab\x7D\x8A'
+    assert stuffed.endswith(EOP)
+
+
+@pytest.mark.parametrize('bad', [b'\x7D', b'ab\x7D', b'\x7D\x00', b'a\x7D\x7Db'])
+def test_unstuff_rejects_invalid_escape(bad):
+    with pytest.raises(ValueError):
+        unstuff(bad)
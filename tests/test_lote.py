@@ -0,0 +1,15 @@
+import os
+
+import pytest
+
+from lote import safe_path
+
+
+def test_safe_path_joins_nested_name(tmp_path):
+    assert safe_path(str(tmp_path), 'a/b/c.txt') == os.path.join(str(tmp_path), 'a', 'b', 'c.txt')
+
+
+@pytest.mark.parametrize('name', ['..', 'a/../b', '/etc/passwd', 'a//b', '.', 'a/', '', 'a\\b', 'C:x'])
+def test_safe_path_rejects_escapes(tmp_path, name):
+    with pytest.raises(ValueError):
+        safe_path(str(tmp_path), name)
@@ -0,0 +1,54 @@
+import pytest
+
+import protocolo
+
+
+@pytest.mark.parametrize('protect', [False, True])
+@pytest.mark.parametrize('payload', [b'', b'abc', bytes(range(256)) * 4])
+def test_encode_round_trip(payload, protect):
+    datagram = protocolo.encode(7, 100, 3, payload, 1, 2, 3, protect=protect)
+    fields = protocolo.HEAD.unpack_from(datagram)
+    assert fields[:3] == (7, 100, len(payload))
+    assert fields[4:] == (3, 1, 2, 3)
+    assert bytes(protocolo.payload(datagram)) == payload
+    assert datagram.endswith(protocolo.EOP)
+    assert len(datagram) == protocolo.OVERHEAD + len(payload)
+    assert fields[3] == protocolo.frame_crc(fields, protocolo.payload(datagram), protect)
+
+
+def test_encode_matches_concatenation():
+    data = bytes(range(50))
+    for protect in (False, True):
+        assert protocolo.encode(7, 100, 3, data, protect=protect) == \
+            protocolo.concat_datagram(7, 100, data, protect)
+        assert protocolo.encode_empty(7, 4, protect=protect) == protocolo.concat_ack(7, protect)
+
+
+def test_head_crc_covers_head():
+    datagram = bytearray(protocolo.encode(1, 2, 3, b'dados', protect=True))
+    datagram[9] ^= 0x01     # Byte reservado, fora do payload
+    fields = protocolo.HEAD.unpack_from(datagram)
+    assert fields[3] != protocolo.frame_crc(fields, protocolo.payload(datagram), True)
+
+
+def test_size_override():
+    datagram = protocolo.encode(1, 1, 3, b'abcd', size=9)
+    assert protocolo.HEAD.unpack_from(datagram)[2] == 9
+    assert len(protocolo.payload(datagram)) == 4
+
+
+def test_handshake_fields():
+    datagram = protocolo.encode_handshake(1, 1024, 8, 0x83, 2, 4, rates=0x0110)
+    assert datagram.endswith(protocolo.EOP)
+    fec_group, max_payload, rates, message_type, window, flags, codec = \
+        protocolo.HANDSHAKE.unpack_from(datagram)
+    assert (fec_group, max_payload, rates, message_type, window, flags, codec) == \
+        (4, 1024, 0x0110, 1, 8, 0x83, 2)
+    # No HEAD comum: tipo no byte 8, payload vazio
+    assert protocolo.HEAD.unpack_from(datagram)[2] == 0
+    assert protocolo.HEAD.unpack_from(datagram)[4] == 1
+
+
+def test_legacy_handshake_is_zeroed():
+    assert protocolo.LEGACY_HANDSHAKE == bytes([0] * 8 + [1, 0, 0, 0]) + protocolo.EOP
+    assert protocolo.LEGACY_REPLY == bytes([0] * 8 + [2, 0, 0, 0]) + protocolo.EOP
@@ -0,0 +1,54 @@
+import binascii
+
+from server_new import Checkpoint
+
+IDENTITY = ['arquivo.txt', 10, 123]
+
+
+def saved(path, chunks):
+    with open(path, 'wb') as f:
+        f.write(b''.join(chunks))
+    checkpoint = Checkpoint(path)
+    checkpoint.load(IDENTITY, 10)
+    for chunk in chunks:
+        checkpoint.advance(chunk)
+    checkpoint.save(force=True)
+    return(checkpoint)
+
+
+def test_checkpoint_resumes(tmp_path):
+    path = str(tmp_path / 'arquivo.parcial')
+    saved(path, [b'abc', b'defg'])
+    checkpoint = Checkpoint(path)
+    checkpoint.load(IDENTITY, 10)
+    assert (checkpoint.offset, checkpoint.packets) == (7, 2)
+    assert checkpoint.digest == binascii.crc32(b'abcdefg')
+    assert (checkpoint.start, checkpoint.start_digest) == (7, checkpoint.digest)
+
+
+def test_checkpoint_starts_over(tmp_path):
+    path = str(tmp_path / 'arquivo.parcial')
+    saved(path, [b'abc', b'defg'])
+
+    other = Checkpoint(path)
+    other.load(['outro.txt', 10, 123], 10)
+    assert other.offset == 0
+
+    restart = Checkpoint(path)
+    restart.load(IDENTITY, 10, restart=True)
+    assert restart.offset == 0
+
+    # Arquivo parcial menor que o checkpoint: não dá para confiar
+    with open(path, 'wb') as f:
+        f.write(b'abc')
+    short = Checkpoint(path)
+    short.load(IDENTITY, 10)
+    assert (short.offset, short.digest, short.packets) == (0, 0, 0)
+
+
+def test_checkpoint_remove(tmp_path):
+    path = str(tmp_path / 'arquivo.parcial')
+    checkpoint = saved(path, [b'abc'])
+    checkpoint.remove()
+    assert not (tmp_path / 'arquivo.parcial.ckpt').exists()
+    checkpoint.remove()     # Sem checkpoint não é erro
@@ -0,0 +1,67 @@
+import multiprocessing
+import os
+import re
+
+import servidor
+from servidor import Servidor, DONE, FAILED, IDLE
+
+
+def test_finish_done_renames_file(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    partial = tmp_path / 'ttyUSB0.parcial'
+    partial.write_bytes(b'dados')
+    server.finish('/dev/ttyUSB0', DONE, str(partial))
+    assert len(server.files) == 1
+    name = os.path.basename(server.files[0])
+    assert re.fullmatch(r'ttyUSB0-\d{8}-\d{6}\.bin', name)
+    assert (tmp_path / name).read_bytes() == b'dados'
+    assert not partial.exists()
+
+
+def test_finish_done_keeps_directory_name(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    batch = tmp_path / 'lote.parcial'
+    batch.mkdir()
+    server.finish('/dev/ttyUSB1', DONE, str(batch))
+    assert re.fullmatch(r'ttyUSB1-\d{8}-\d{6}', os.path.basename(server.files[0]))
+    assert os.path.isdir(server.files[0])
+
+
+def test_finish_failed_schedules_retry(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    partial = tmp_path / 'ttyUSB0.parcial'
+    partial.write_bytes(b'dados')
+    server.finish('/dev/ttyUSB0', FAILED, str(partial))
+    assert server.files == []
+    assert partial.exists()
+    assert server.retry_at['/dev/ttyUSB0'] > 0
+    assert server.metrics.snapshot()['counters']['servidor.failures'] == 1
+
+
+def test_finish_idle_does_nothing(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    server.finish('/dev/ttyUSB0', IDLE)
+    assert server.files == [] and server.retry_at == {}
+
+
+def test_collect_without_result_is_failure(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    result, sender = multiprocessing.Pipe(duplex=False)
+    sender.close()
+    server.sessions['/dev/ttyUSB0'] = (None, 0, result)
+    assert server.collect('/dev/ttyUSB0') == (FAILED, None)
+    assert server.sessions == {}
+
+
+def test_collect_reads_reported_result(tmp_path):
+    server = Servidor([], directory=str(tmp_path))
+    result, sender = multiprocessing.Pipe(duplex=False)
+    sender.send((DONE, '/tmp/x.parcial'))
+    server.sessions['/dev/ttyUSB0'] = (None, 0, result)
+    assert server.collect('/dev/ttyUSB0') == (DONE, '/tmp/x.parcial')
+    sender.close()
+
+
+def test_port_tag():
+    assert servidor.port_tag('/dev/ttyUSB0') == 'ttyUSB0'
+    assert servidor.port_tag('COM3') == 'COM3'
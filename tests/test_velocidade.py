@@ -0,0 +1,15 @@
+from velocidade import RATES, mask_of, rates_of
+
+
+def test_mask_round_trip():
+    subset = [RATES[-1], RATES[0], RATES[len(RATES) // 2]]
+    mask = mask_of(subset)
+    assert bin(mask).count('1') == 3
+    assert rates_of(mask) == [r for r in RATES if r in subset]
+    assert rates_of(mask_of(RATES)) == list(RATES)
+
+
+def test_mask_ignores_unknown_rates():
+    assert mask_of([12345]) == 0
+    assert mask_of([12345, RATES[1]]) == 1 << 1
+    assert rates_of(0) == []
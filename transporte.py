@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Transportes para testes sem hardware
+####################################################
+"""
+Permite rodar client_new/server_new sem duas portas USB-serial.
+
+  loopbackPair() : dois LoopbackFisica ligados em memória, no mesmo
+                   processo (enlace(name, transporte=...))
+  PtyLink        : dois pseudo-terminais ligados por threads de relay;
+                   cada lado abre o nome do pty como uma porta serial
+  demoSession()  : arquivos temporários e globais de client_new/server_new
+                   para os demos (bonding, fec, multiplex), restaurados
+                   no fim
+
+Com baudrate, os dois emulam o tempo de transmissão de uma UART 8N1
+(10 bits por byte) sobre os bytes já codificados pela fisica. No
+loopback cada ponta pode trocar de velocidade (setBaudrate): enquanto
+as duas estão diferentes o que passa vira lixo, como numa UART real, e
+acima de maxBaudrate o cabo emulado estraga um byte a cada CHUNK.
+
+Uso:
+  python transporte.py pty                      # cria o par e imprime os nomes
+  python transporte.py loopback [baud [cabo]]   # roda server_new e client_new juntos
+"""
+
+# Importa pacote de tempo
+import time
+
+# Threads
+import threading
+
+import os
+import sys
+import select
+import contextlib
+
+from interfaceFisica import fisica
+
+# Bytes entregues por vez na emulação de baud rate
+CHUNK = 64
+
+class BaudEmulator(object):
+    """ Segura cada escrita pelo tempo que a UART levaria para enviá-la
+    """
+    def __init__(self, baudrate):
+        self.baudrate = baudrate
+        self.nextFree = 0.0
+
+    def wait(self, nBytes):
+        if not self.baudrate:
+            return
+        now = time.perf_counter()
+        self.nextFree = max(now, self.nextFree) + nBytes * 10 / self.baudrate
+        if self.nextFree > now:
+            time.sleep(self.nextFree - now)
+
+class LoopbackPort(object):
+    """ Ponta de um cano em memória com a API de serial.Serial usada pela fisica
+    """
+    def __init__(self, baudrate=None, timeout=0.1, maxBaudrate=None):
+        self.timeout     = timeout
+        self.peer        = None
+        self.rxBuffer    = bytearray()
+        self.condition   = threading.Condition()
+        self.baud        = BaudEmulator(baudrate)
+        self.maxBaudrate = maxBaudrate   # Limite do cabo emulado; None: sem limite
+        self.is_open     = True
+
+    @property
+    def in_waiting(self):
+        return(len(self.rxBuffer))
+
+    @property
+    def baudrate(self):
+        return(self.baud.baudrate)
+
+    @baudrate.setter
+    def baudrate(self, baudrate):
+        self.baud.baudrate = baudrate
+
+    def garble(self, chunk):
+        """ O que a outra ponta lê do chunk na velocidade atual das duas
+        """
+        if self.baud.baudrate != self.peer.baud.baudrate:
+            return(bytes(b ^ 0x5A for b in chunk))
+        if self.maxBaudrate and self.baud.baudrate > self.maxBaudrate:
+            return(chunk[:-1] + bytes([chunk[-1] ^ 0x01]))
+        return(chunk)
+
+    def write(self, data):
+        data = bytes(data)
+        for i in range(0, len(data), CHUNK):
+            chunk = self.garble(data[i:i + CHUNK])
+            self.baud.wait(len(chunk))
+            with self.peer.condition:
+                self.peer.rxBuffer += chunk
+                self.peer.condition.notify_all()
+        return(len(data))
+
+    def read(self, nBytes):
+        """ Como serial.Serial.read: espera nBytes ou o timeout
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: len(self.rxBuffer) >= nBytes or not self.is_open,
+                                    self.timeout)
+            b = bytes(self.rxBuffer[:nBytes])
+            del self.rxBuffer[:nBytes]
+        return(b)
+
+    def flush(self):
+        # write só retorna depois do tempo de transmissão
+        pass
+
+    def flushInput(self):
+        with self.condition:
+            self.rxBuffer.clear()
+
+    def flushOutput(self):
+        pass
+
+    def close(self):
+        with self.condition:
+            self.is_open = False
+            self.condition.notify_all()
+
+class LoopbackFisica(fisica):
+    """ fisica (mesma codificação hex/binária) sobre um LoopbackPort
+    """
+    def __init__(self, name, port):
+        fisica.__init__(self, name)
+        self.loopPort = port
+        self.baudrate = port.baud.baudrate
+
+    def open(self):
+        self.loopPort.is_open = True
+        self.port = self.loopPort
+
+    def baudrates(self):
+        # Sem emulação de baud rate a velocidade não muda nada
+        if not self.baudrate:
+            return([])
+        return(fisica.baudrates(self))
+
+def loopbackPair(baudrate=None, maxBaudrate=None):
+    """ Retorna dois LoopbackFisica ligados entre si
+
+    maxBaudrate: maior velocidade que o cabo emulado aguenta.
+    """
+    a = LoopbackPort(baudrate, maxBaudrate=maxBaudrate)
+    b = LoopbackPort(baudrate, maxBaudrate=maxBaudrate)
+    a.peer, b.peer = b, a
+    return(LoopbackFisica("loopA", a), LoopbackFisica("loopB", b))
+
+class PtyLink(object):
+    """ Par de pseudo-terminais ligados entre si
+
+    nameA e nameB podem ser abertos por fisica (pyserial) como
+    portas seriais comuns, inclusive por processos diferentes.
+    """
+    def __init__(self, baudrate=None):
+        import tty  # Só existe em sistemas POSIX
+        self.baudrate   = baudrate
+        self.masterA, slaveA = os.openpty()
+        self.masterB, slaveB = os.openpty()
+        for fd in (slaveA, slaveB):
+            tty.setraw(fd)
+        self.slaves     = (slaveA, slaveB)
+        self.nameA      = os.ttyname(slaveA)
+        self.nameB      = os.ttyname(slaveB)
+        self.threadStop = False
+        self.threads    = [threading.Thread(target=self.relay, args=(self.masterA, self.masterB), daemon=True),
+                           threading.Thread(target=self.relay, args=(self.masterB, self.masterA), daemon=True)]
+        for t in self.threads:
+            t.start()
+
+    def relay(self, src, dst):
+        baud = BaudEmulator(self.baudrate)
+        while not self.threadStop:
+            r, _, _ = select.select([src], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(src, CHUNK)
+            except OSError:
+                return
+            baud.wait(len(data))
+            os.write(dst, data)
+
+    def close(self):
+        self.threadStop = True
+        for t in self.threads:
+            t.join(1)
+        for fd in (self.masterA, self.masterB) + self.slaves:
+            os.close(fd)
+
+def runLoopback(baudrate=None, maxBaudrate=None):
+    """ Roda server_new e client_new no mesmo processo
+    """
+    import client_new
+    import server_new
+    from enlace import enlace
+    a, b = loopbackPair(baudrate, maxBaudrate)
+    client_new.com1 = enlace(a.name, a)
+    server_new.com2 = enlace(b.name, b)
+    server = threading.Thread(target=server_new.main)
+    server.start()
+    client_new.main()
+    server.join()
+
+@contextlib.contextmanager
+def demoSession(content, settings=None, quiet=True):
+    """ Prepara client_new/server_new para um demo no mesmo processo
+
+    Grava content num diretório temporário, fora do diretório atual
+    onde está o arquivo.txt de exemplo, e aponta SEND_PATH e
+    OUTPUT_FILE para ele. settings são outros globais de client_new
+    trocados durante o demo (ex.: {'WINDOW_SIZE': 8}), e com quiet o
+    print fica mudo. Na saída, mesmo com exceção, tudo volta ao que era
+    (inclusive com1 e com2) e o diretório é apagado.
+
+    Retorna o caminho do arquivo recebido.
+    """
+    import builtins
+    import tempfile
+    import client_new
+    import server_new
+    settings = dict(settings or {})
+    saved = ([(client_new, name, getattr(client_new, name)) for name in ['SEND_PATH', 'com1'] + list(settings)] +
+             [(server_new, name, getattr(server_new, name)) for name in ('OUTPUT_FILE', 'com2')] +
+             [(builtins, 'print', builtins.print)])
+    tmp = tempfile.TemporaryDirectory()
+    try:
+        client_new.SEND_PATH = os.path.join(tmp.name, 'arquivo.txt')
+        server_new.OUTPUT_FILE = os.path.join(tmp.name, 'arquivo_recebido.txt')
+        with open(client_new.SEND_PATH, 'wb') as f:
+            f.write(content)
+        for name, value in settings.items():
+            setattr(client_new, name, value)
+        if quiet:
+            builtins.print = lambda *args, **kwargs: None
+        yield server_new.OUTPUT_FILE
+    finally:
+        for module, name, value in saved:
+            setattr(module, name, value)
+        tmp.cleanup()
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "pty"
+    baudrate = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    if mode == "loopback":
+        runLoopback(baudrate, int(sys.argv[3]) if len(sys.argv) > 3 else None)
+    else:
+        link = PtyLink(baudrate)
+        print("Portas: {}  {}".format(link.nameA, link.nameB))
+        print("Ctrl+C para encerrar")
+        try:
+            while True:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            link.close()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#####################################################
+# Camada Física da Computação
+#  Negociação da velocidade (baud rate) do enlace
+####################################################
+"""
+Velocidade negociada no handshake (FLAG_BAUD): os bytes 6-7 levam a
+máscara das velocidades de RATES que cada lado suporta (bit i =
+RATES[i]); a resposta traz as que os dois suportam. A sessão começa
+na velocidade em que o handshake foi feito, a base.
+
+Antes dos dados o cliente sobe uma velocidade por vez com datagramas
+do tipo 11 (byte 9 = índice em RATES, byte 10 = operação, sempre com
+CRC no HEAD):
+
+  REQUEST (cliente): troque para RATES[i]
+  ACCEPT  (servidor, ainda na velocidade atual): aceito, trocando
+  PROBE   (cliente, já na nova): padrão de teste no payload
+  ECHO    (servidor, na nova): o mesmo padrão de volta
+
+Sem o PROBE íntegro em SWITCH_TIMEOUT o servidor volta à velocidade
+anterior; sem o ECHO o cliente também, e espera o servidor completar o
+SWITCH_TIMEOUT antes de mandar mais nada. A subida para na primeira
+velocidade que não passa.
+
+Durante a transferência o cliente desce uma velocidade (REQUEST para
+uma menor, até a base) se mais de ERROR_LIMIT dos últimos ERROR_WINDOW
+envios forem reenvios. E um lado que passa SILENCE segundos sem
+receber um datagrama íntegro fora da base volta para ela: como os dois
+lados fazem isso, um ECHO ou ACCEPT perdido não deixa o enlace mudo.
+"""
+
+import collections
+
+from interfaceFisica import BAUDRATES
+
+MESSAGE_TYPE = 11
+
+# Operação no byte 10 do tipo 11
+REQUEST = 0
+ACCEPT  = 1
+PROBE   = 2
+ECHO    = 3
+
+RATES = BAUDRATES   # Bit i da máscara é RATES[i]
+
+SWITCH_TIMEOUT = 2.0    # Espera do servidor pelo PROBE na nova velocidade
+SILENCE        = 6.0    # Segundos sem datagrama íntegro fora da base: volta para ela;
+                        # passa do MAX_RTO (5 s) do cliente, que pode ficar esse tempo quieto
+ERROR_WINDOW   = 32     # Envios observados para decidir a descida
+ERROR_LIMIT    = 0.25   # Fração de reenvios que faz descer uma velocidade
+
+# Bytes que forçam a UART: bits alternados, sequências longas de 0 e 1
+# e todas as posições de um bit isolado
+PATTERN = (bytes([0x55, 0xAA, 0x00, 0xFF, 0x0F, 0xF0, 0x33, 0xCC]) +
+           bytes(1 << i for i in range(8)) + bytes(0xFF ^ (1 << i) for i in range(8)))
+PROBE_SIZE = 64      # Até o payload máximo negociado
+
+def mask_of(rates):
+    """ Máscara dos bytes 6-7 do handshake com as velocidades de rates
+    """
+    mask = 0
+    for i, rate in enumerate(RATES):
+        if rate in rates:
+            mask |= 1 << i
+    return(mask)
+
+def rates_of(mask):
+    return([rate for i, rate in enumerate(RATES) if mask >> i & 1])
+
+def probe_pattern():
+    return((PATTERN * (PROBE_SIZE // len(PATTERN) + 1))[:PROBE_SIZE])
+
+class Velocidade(object):
+    """ Velocidade do enlace de um lado da sessão
+
+    rates são as velocidades negociadas; link é o enlace, que troca a
+    velocidade da fisica depois de esvaziar o TX. A base é a velocidade
+    do handshake.
+    """
+
+    def __init__(self, link, rates):
+        self.link    = link
+        self.base    = link.fisica.baudrate
+        self.rates   = sorted(set(rates) | {self.base})
+        self.history = collections.deque(maxlen=ERROR_WINDOW)   # True = reenvio
+
+    def rate(self):
+        return(self.link.fisica.baudrate)
+
+    def tuned(self):
+        """ Se está fora da velocidade do handshake
+        """
+        return(self.rate() != self.base)
+
+    def set(self, rate):
+        if rate != self.rate():
+            self.link.setBaudrate(rate)
+        self.reset()
+
+    def reset(self):
+        """ Esquece os envios observados (reenvios do que estava em voo
+            numa troca não dizem nada da velocidade nova)
+        """
+        self.history.clear()
+
+    def fallback(self):
+        self.set(self.base)
+        self.link.metrics.count('link.baud_fallbacks')
+
+    def higher(self):
+        """ Velocidades acima da atual, em ordem
+        """
+        return([r for r in self.rates if r > self.rate()])
+
+    def lower(self):
+        """ Velocidade logo abaixo da atual, sem passar da base: abaixo
+            dela a configurada já é a que se sabe que funciona
+        """
+        below = [r for r in self.rates if self.base <= r < self.rate()]
+        return(below[-1] if below else None)
+
+    def sent(self, retransmission):
+        self.history.append(retransmission)
+
+    def degraded(self):
+        """ Se os últimos envios tiveram reenvios demais
+        """
+        return(len(self.history) == ERROR_WINDOW and
+               sum(self.history) > ERROR_LIMIT * ERROR_WINDOW and self.lower() is not None)